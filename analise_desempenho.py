@@ -0,0 +1,197 @@
+import json
+import re
+
+import pandas as pd
+
+from analise_regex import extrair_regex
+
+# Limites por omissão para a análise de desempenho do formulário gerado
+LIMITES_PADRAO = {
+    "max_perguntas_field_list": 30,   # perguntas num grupo field-list (uma só página)
+    "max_tamanho_calculo": 1500,      # caracteres numa expressão calculation
+    "max_referencias_calculo": 60,    # ${...} numa só expressão
+    "max_dependentes": 40,            # linhas que referenciam a mesma variável
+    "max_profundidade": 8,            # cadeia mais longa de dependências entre variáveis
+    "max_tamanho_regex": 80,          # caracteres no padrão de um regex()
+    "max_linhas_lista_filtrada": 500, # linhas de uma lista de choices usada com choice_filter
+    "max_custo_regex_ms": 20          # pior tempo de um regex() com entradas adversárias (analise_regex)
+}
+
+COLUNAS_EXPRESSAO = ["relevant", "calculation", "constraint", "choice_filter"]
+
+PADRAO_REFERENCIA = re.compile(r"\$\{([^}]+)\}")
+
+
+def _texto(valor):
+    if pd.isna(valor):
+        return ""
+    return str(valor).strip()
+
+
+def _achado(regra, linha, nome, detalhe, valor, limite, severidade="aviso"):
+    return {
+        "regra": regra,
+        "severidade": severidade,
+        "linha": linha,
+        "name": nome,
+        "detalhe": detalhe,
+        "valor": valor,
+        "limite": limite
+    }
+
+
+def _analisar_field_lists(survey, limites, achados):
+    """Grupos field-list com demasiadas perguntas na mesma página."""
+    limite = limites["max_perguntas_field_list"]
+    pilha = []
+    for pos, (tipo, nome, appearance) in enumerate(zip(survey["type"], survey["name"], survey["appearance"])):
+        tipo = _texto(tipo)
+        if tipo == "begin_group":
+            pilha.append({"pos": pos, "name": _texto(nome), "field_list": "field-list" in _texto(appearance), "perguntas": 0})
+        elif tipo == "end_group":
+            if not pilha:
+                continue
+            grupo = pilha.pop()
+            if grupo["field_list"] and grupo["perguntas"] > limite:
+                achados.append(_achado("field_list_grande", grupo["pos"] + 2, grupo["name"],
+                                       f"Grupo field-list com {grupo['perguntas']} perguntas numa só página",
+                                       grupo["perguntas"], limite))
+            if pilha:
+                pilha[-1]["perguntas"] += grupo["perguntas"]
+        elif pilha and tipo not in ("calculate", ""):
+            pilha[-1]["perguntas"] += 1
+
+
+def _analisar_calculos(survey, limites, achados):
+    """Expressões calculation muito longas ou com demasiadas referências."""
+    for pos, (nome, calculo) in enumerate(zip(survey["name"], survey["calculation"])):
+        calculo = _texto(calculo)
+        if not calculo:
+            continue
+        if len(calculo) > limites["max_tamanho_calculo"]:
+            achados.append(_achado("calculo_longo", pos + 2, _texto(nome),
+                                   f"Cálculo com {len(calculo)} caracteres", len(calculo), limites["max_tamanho_calculo"]))
+        referencias = len(PADRAO_REFERENCIA.findall(calculo))
+        if referencias > limites["max_referencias_calculo"]:
+            achados.append(_achado("calculo_muitas_referencias", pos + 2, _texto(nome),
+                                   f"Cálculo com {referencias} referências ${{}}", referencias,
+                                   limites["max_referencias_calculo"]))
+
+
+def _analisar_dependencias(survey, limites, achados):
+    """Variáveis com muitos dependentes e cadeias de dependência profundas."""
+    posicoes = {}
+    depende_de = {}
+    dependentes = {}
+    for pos, linha in enumerate(survey[["name"] + COLUNAS_EXPRESSAO].itertuples(index=False, name=None)):
+        nome = _texto(linha[0])
+        if nome:
+            posicoes.setdefault(nome, pos)
+        referencias = set()
+        for expressao in linha[1:]:
+            referencias.update(PADRAO_REFERENCIA.findall(_texto(expressao)))
+        referencias.discard(nome)
+        if nome:
+            depende_de.setdefault(nome, set()).update(referencias)
+        for ref in referencias:
+            dependentes[ref] = dependentes.get(ref, 0) + 1
+
+    for ref, total in dependentes.items():
+        if total > limites["max_dependentes"]:
+            linha = posicoes[ref] + 2 if ref in posicoes else None
+            achados.append(_achado("muitos_dependentes", linha, ref,
+                                   f"{total} linhas são recalculadas quando esta variável muda", total,
+                                   limites["max_dependentes"]))
+
+    # Profundidade por memoização iterativa (sem recursão, protegida contra ciclos)
+    profundidade = {}
+    for inicio in depende_de:
+        if inicio in profundidade:
+            continue
+        pilha = [(inicio, iter(depende_de.get(inicio, ())))]
+        em_curso = {inicio}
+        while pilha:
+            nome, refs = pilha[-1]
+            ref = next(refs, None)
+            if ref is None:
+                pilha.pop()
+                em_curso.discard(nome)
+                profundidade[nome] = 1 + max((profundidade.get(r, 0) for r in depende_de.get(nome, ())
+                                              if r not in em_curso), default=0)
+            elif ref in depende_de and ref not in profundidade and ref not in em_curso:
+                em_curso.add(ref)
+                pilha.append((ref, iter(depende_de[ref])))
+
+    for nome, valor in profundidade.items():
+        if valor > limites["max_profundidade"]:
+            achados.append(_achado("dependencia_profunda", posicoes[nome] + 2, nome,
+                                   f"Cadeia de {valor} variáveis dependentes até esta", valor,
+                                   limites["max_profundidade"]))
+
+
+def _analisar_regex(survey, limites, achados):
+    """
+    regex() longos. O risco de backtracking e o custo de cada padrão ficam para
+    a etapa de analise_regex, para o mesmo padrão não ser reportado duas vezes.
+    """
+    for padrao, usos in extrair_regex(survey).items():
+        if len(padrao) <= limites["max_tamanho_regex"]:
+            continue
+        for linha, nome, _ in usos:
+            achados.append(_achado("regex_longo", linha, nome, f"regex() com {len(padrao)} caracteres: {padrao}",
+                                   len(padrao), limites["max_tamanho_regex"]))
+
+
+def _analisar_listas_filtradas(survey, choices, limites, achados):
+    """Listas de choices grandes filtradas no dispositivo."""
+    if choices is None or choices.empty:
+        return
+    tamanhos = choices.groupby("list_name").size()
+    limite = limites["max_linhas_lista_filtrada"]
+    for pos, (nome, tipo, choice_filter) in enumerate(zip(survey["name"], survey["type"], survey["choice_filter"])):
+        partes = _texto(tipo).split()
+        if len(partes) < 2 or partes[0] not in ("select_one", "select_multiple") or not _texto(choice_filter):
+            continue
+        linhas = int(tamanhos.get(partes[1], 0))
+        if linhas > limite:
+            achados.append(_achado("lista_filtrada_grande", pos + 2, _texto(nome),
+                                   f"choice_filter sobre a lista '{partes[1]}' com {linhas} linhas", linhas, limite))
+
+
+def analisar_desempenho(survey, choices=None, limites=None):
+    """
+    Analisa o XLSForm gerado à procura de construções caras no dispositivo.
+
+    Parâmetros:
+        survey (pd.DataFrame): aba survey final
+        choices (pd.DataFrame): aba choices final
+        limites (dict): substitui valores de LIMITES_PADRAO
+
+    Retorna:
+        dict: {"pontuacao": int, "limites": dict, "achados": [dict, ...]}
+    """
+    limites = {**LIMITES_PADRAO, **(limites or {})}
+    survey = survey.reset_index(drop=True)
+    for col in ["appearance"] + COLUNAS_EXPRESSAO:
+        if col not in survey.columns:
+            survey[col] = ""
+
+    achados = []
+    _analisar_field_lists(survey, limites, achados)
+    _analisar_calculos(survey, limites, achados)
+    _analisar_dependencias(survey, limites, achados)
+    _analisar_regex(survey, limites, achados)
+    _analisar_listas_filtradas(survey, choices, limites, achados)
+
+    # Pontuação de custo: cada achado pesa o quanto excede o limite (erros contam a dobrar)
+    pontuacao = 0
+    for achado in achados:
+        peso = 2 if achado["severidade"] == "erro" else 1
+        pontuacao += peso * max(1, round(achado["valor"] / max(achado["limite"], 1)))
+
+    return {"pontuacao": pontuacao, "limites": limites, "achados": achados}
+
+
+def relatorio_json(resultado):
+    """Serializa o resultado de analisar_desempenho em JSON."""
+    return json.dumps(resultado, ensure_ascii=False, indent=2)
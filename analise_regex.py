@@ -0,0 +1,197 @@
+import re
+import string
+import time
+
+import pandas as pd
+
+PADRAO_REGEX = re.compile(r"regex\(\s*[^,]+,\s*'((?:[^']|'')*)'\s*\)")
+# Formas com risco de backtracking catastrófico:
+# quantificador sobre um grupo que já tem quantificador, ex: (a+)+, (\w*)*, (.*?)+
+PADRAO_QUANTIFICADOR_ANINHADO = re.compile(r"\((?:[^()\\]|\\.)*[+*](?:[^()\\]|\\.)*\)[+*{]")
+# Dois quantificadores ilimitados seguidos sobre '.', ex: .*.* ou .+.*
+PADRAO_PONTOS_SEGUIDOS = re.compile(r"\.[+*]\??\s*\.[+*]")
+
+COLUNAS_REGEX = ["constraint", "relevant", "calculation"]
+# Tamanhos das entradas adversárias: passos pequenos onde o custo exponencial
+# explode, depois textos do tamanho de um campo de texto comum
+TAMANHOS_ENTRADA = list(range(4, 41, 2)) + [64, 128, 256]
+CARACTERES_BASE = "a0A _.-@"
+# Terminadores que fazem o padrão falhar no fim (forçam o backtracking)
+TERMINADORES = ["!", "\x00"]
+
+# Grupo com alternativas e quantificador, sem grupos dentro, ex: (a|aa)+ ou (\d|\w)*
+PADRAO_ALTERNATIVA_QUANTIFICADA = re.compile(r"\(((?:[^()\\]|\\.)*\|(?:[^()\\]|\\.)*)\)[+*{]")
+
+_cache_custos = {}
+
+
+def risco_backtracking(padrao):
+    """Devolve a descrição do risco de backtracking do padrão, ou None se não houver."""
+    if PADRAO_QUANTIFICADOR_ANINHADO.search(padrao):
+        return "quantificadores aninhados"
+    if PADRAO_PONTOS_SEGUIDOS.search(padrao):
+        return "quantificadores ilimitados seguidos"
+    return None
+
+
+def extrair_regex(survey):
+    """
+    Padrões dos regex() usados nas expressões do survey.
+
+    Retorna:
+        dict: {padrão: [(linha, name, coluna), ...]}, cada padrão uma só vez
+    """
+    padroes = {}
+    nomes = survey["name"].tolist() if "name" in survey.columns else [""] * len(survey)
+    for coluna in COLUNAS_REGEX:
+        if coluna not in survey.columns:
+            continue
+        for pos, expressao in enumerate(survey[coluna].tolist()):
+            if not isinstance(expressao, str) or "regex(" not in expressao:
+                continue
+            for padrao in PADRAO_REGEX.findall(expressao):
+                padrao = padrao.replace("''", "'")
+                nome = nomes[pos] if isinstance(nomes[pos], str) else ""
+                padroes.setdefault(padrao, []).append((pos + 2, nome, coluna))
+    return padroes
+
+
+def _alternativas(grupo):
+    """Divide o conteúdo de um grupo nas alternativas de topo (ignora '|' escapados ou dentro de [...])."""
+    alternativas, atual, classe, i = [], "", False, 0
+    while i < len(grupo):
+        c = grupo[i]
+        if c == "\\" and i + 1 < len(grupo):
+            atual += grupo[i:i + 2]
+            i += 2
+            continue
+        if c == "[":
+            classe = True
+        elif c == "]":
+            classe = False
+        if c == "|" and not classe:
+            alternativas.append(atual)
+            atual = ""
+        else:
+            atual += c
+        i += 1
+    alternativas.append(atual)
+    return [a.lstrip("?:") for a in alternativas]
+
+
+def alternativas_sobrepostas(padrao):
+    """
+    Procura grupos quantificados cujas alternativas aceitam o mesmo texto,
+    ex: (a|a)*, (\\d|\\w)+ ou (a|aa)+ — o motor tenta todas as divisões possíveis.
+
+    Retorna:
+        str: o grupo problemático, ou None
+    """
+    sondas = [c for c in string.printable if c not in "\r\n\x0b\x0c"]
+    for grupo in PADRAO_ALTERNATIVA_QUANTIFICADA.finditer(padrao):
+        alternativas = []
+        for alternativa in _alternativas(grupo.group(1)):
+            try:
+                alternativas.append((re.compile(f"(?:{alternativa})"), re.compile(f"(?:{alternativa})+")))
+            except re.error:
+                return None
+        for i, (simples, _) in enumerate(alternativas):
+            for j, (_, repetida) in enumerate(alternativas):
+                if i == j:
+                    continue
+                for c in sondas:
+                    for texto in (c, c + c):
+                        if simples.fullmatch(texto) and repetida.fullmatch(texto):
+                            return grupo.group(0)
+    return None
+
+
+def _alfabeto(padrao):
+    """Caracteres das entradas adversárias: os de CARACTERES_BASE e os literais do padrão."""
+    literais = [c for c in re.sub(r"\\.", "", padrao) if c.isalnum() and c.isascii()]
+    return list(dict.fromkeys(list(CARACTERES_BASE) + literais))[:20]
+
+
+def custo_regex(compilado, padrao, orcamento_ms):
+    """
+    Pior tempo de compilado.search() com entradas adversárias de tamanho crescente
+    (um caractere repetido e um terminador que faz o padrão falhar).
+
+    Para assim que uma entrada passa o orçamento, para que um padrão exponencial
+    não fique a correr minutos.
+
+    Retorna:
+        tuple: (pior tempo em ms, tamanho da entrada)
+    """
+    pior_ms, pior_tamanho = 0.0, 0
+    alfabeto = _alfabeto(padrao)
+    for tamanho in TAMANHOS_ENTRADA:
+        for c in alfabeto:
+            for terminador in TERMINADORES:
+                entrada = c * tamanho + terminador
+                inicio = time.perf_counter()
+                compilado.search(entrada)
+                ms = (time.perf_counter() - inicio) * 1000
+                if ms > orcamento_ms:
+                    # Medir outra vez, para uma pausa do sistema não contar como custo do padrão
+                    inicio = time.perf_counter()
+                    compilado.search(entrada)
+                    ms = min(ms, (time.perf_counter() - inicio) * 1000)
+                if ms > pior_ms:
+                    pior_ms, pior_tamanho = ms, len(entrada)
+                if pior_ms > orcamento_ms:
+                    return pior_ms, pior_tamanho
+    return pior_ms, pior_tamanho
+
+
+def analisar_padrao(padrao, orcamento_ms):
+    """
+    Compila e mede um padrão (o resultado fica em cache por padrão e orçamento).
+
+    Retorna:
+        dict: risco (forma perigosa ou erro de compilação), custo_ms, tamanho_entrada, severidade
+    """
+    chave = (padrao, orcamento_ms)
+    if chave in _cache_custos:
+        return _cache_custos[chave]
+    try:
+        compilado = re.compile(padrao)
+    except re.error as e:
+        resultado = {"risco": f"não compila: {e}", "custo_ms": None, "tamanho_entrada": None, "severidade": "erro"}
+    else:
+        risco = risco_backtracking(padrao)
+        sobreposta = alternativas_sobrepostas(padrao)
+        if sobreposta:
+            risco = f"alternativas sobrepostas em {sobreposta}" + (f"; {risco}" if risco else "")
+        custo_ms, tamanho = custo_regex(compilado, padrao, orcamento_ms)
+        severidade = "erro" if custo_ms > orcamento_ms else "aviso" if risco else ""
+        resultado = {"risco": risco or "", "custo_ms": round(custo_ms, 3), "tamanho_entrada": tamanho,
+                     "severidade": severidade}
+    _cache_custos[chave] = resultado
+    return resultado
+
+
+def analisar_regex(survey, orcamento_ms):
+    """
+    Verifica os regex() do survey: cada padrão é compilado uma vez, procuram-se
+    formas com risco de backtracking catastrófico e mede-se o pior tempo com
+    entradas adversárias (o dispositivo avalia o constraint a cada tecla).
+
+    Parâmetros:
+        survey (pd.DataFrame): aba survey final
+        orcamento_ms (float): tempo máximo de uma avaliação; acima dele o padrão é um erro
+
+    Retorna:
+        pd.DataFrame: um padrão por linha, com onde é usado, risco, custo e severidade
+    """
+    linhas = []
+    for padrao, usos in extrair_regex(survey).items():
+        linhas.append({
+            "padrao": padrao,
+            **analisar_padrao(padrao, orcamento_ms),
+            "usos": len(usos),
+            "linhas": ", ".join(str(linha) for linha, _, _ in usos[:10]) + (" ..." if len(usos) > 10 else ""),
+            "exemplo": usos[0][1]
+        })
+    return pd.DataFrame(linhas, columns=["padrao", "severidade", "risco", "custo_ms", "tamanho_entrada",
+                                         "usos", "linhas", "exemplo"])
@@ -0,0 +1,84 @@
+from io import BytesIO
+
+import pandas as pd
+
+# Quantos nomes correspondidos guardar por regra
+AMOSTRA_NOMES = 5
+
+
+def novo_relatorio():
+    """Relatório vazio: uma linha por regra avaliada e o dono atual de cada célula escrita."""
+    return {"regras": [], "donos": {}}
+
+
+def registar_regra(relatorio, arquivo, regra, nomes, segundos, indices=None, coluna=None):
+    """
+    Regista a avaliação de uma regra.
+
+    O dono de cada célula é guardado por coluna, seja qual for o arquivo da
+    regra: uma regra de regras_campos.yaml que escreve o constraint de uma
+    variável já escrito pelo regex.xlsx aparece como sobreposta a essa regra.
+
+    Parâmetros:
+        relatorio (dict): criado por novo_relatorio(); se None nada é registado
+        arquivo (str): origem da regra (regex.xlsx, selects.xlsx, regras_campos.yaml, ...)
+        regra (str): identificação da regra (ex: 'linha 5: nome_escola')
+        nomes (list): nomes das variáveis correspondidas
+        segundos (float): tempo gasto a avaliar e aplicar a regra
+        indices (iterable): linhas do survey escritas pela regra, identificadas pelo
+            name (o índice do DataFrame muda entre etapas, o name não)
+        coluna (str ou list): coluna(s) escrita(s), para detetar regras que se sobrepõem
+    """
+    if relatorio is None:
+        return
+    sobrepostas = set()
+    if indices is not None and coluna is not None:
+        dono = f"{arquivo} {regra}"
+        indices = list(indices)
+        for col in ([coluna] if isinstance(coluna, str) else coluna):
+            donos = relatorio["donos"].setdefault(col, {})
+            for idx in indices:
+                anterior = donos.get(idx)
+                if anterior is not None and anterior != dono:
+                    sobrepostas.add(anterior)
+                donos[idx] = dono
+
+    nomes = [str(n) for n in nomes]
+    relatorio["regras"].append({
+        "arquivo": arquivo,
+        "regra": regra,
+        "correspondencias": len(nomes),
+        "amostra_nomes": ", ".join(nomes[:AMOSTRA_NOMES]),
+        "regras_sobrepostas": ", ".join(sorted(sobrepostas)),
+        "segundos": round(segundos, 6)
+    })
+
+
+def tabela_cobertura(relatorio, total_linhas, fracao_ampla=0.2):
+    """
+    Tabela final com um alerta por regra: 'sem correspondências' ou
+    'demasiado ampla' (mais de fracao_ampla das linhas do survey).
+    """
+    tabela = pd.DataFrame(relatorio["regras"], columns=[
+        "arquivo", "regra", "correspondencias", "amostra_nomes", "regras_sobrepostas", "segundos"
+    ])
+    limite_amplo = max(1, int(total_linhas * fracao_ampla))
+    tabela["alerta"] = ""
+    tabela.loc[tabela["correspondencias"] == 0, "alerta"] = "sem correspondências"
+    tabela.loc[tabela["correspondencias"] > limite_amplo, "alerta"] = f"demasiado ampla (> {limite_amplo} linhas)"
+    return tabela
+
+
+def cobertura_para_excel(tabela):
+    """Escreve a tabela de cobertura num xlsx com uma aba de detalhe e outra de resumo por arquivo."""
+    resumo = tabela.groupby("arquivo").agg(
+        regras=("regra", "count"),
+        sem_correspondencias=("correspondencias", lambda c: int((c == 0).sum())),
+        segundos=("segundos", "sum")
+    ).reset_index()
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        tabela.to_excel(writer, sheet_name="regras", index=False)
+        resumo.to_excel(writer, sheet_name="resumo", index=False)
+    output.seek(0)
+    return output
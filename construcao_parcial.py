@@ -0,0 +1,72 @@
+import re
+
+import pandas as pd
+
+from renomear_variaveis import PADRAO_REFERENCIA
+
+# Passagens máximas a puxar para a seleção as variáveis referidas pelas regras
+MAX_PASSAGENS = 4
+
+
+def corresponde_prefixo(nome, prefixos):
+    """
+    Indica se o nome pertence a algum dos prefixos pedidos.
+
+    O prefixo pode incluir ou não o prefixo do questionário: 'DGE_SQE_B4'
+    corresponde a 'QEA_DGE_SQE_B4_P5_1_classe_m' e a 'DGE_SQE_B4_P1'.
+    """
+    if not isinstance(nome, str):
+        return False
+    for prefixo in prefixos:
+        if nome.startswith(prefixo) or re.match(rf"^[A-Za-z0-9]+_{re.escape(prefixo)}", nome):
+            return True
+    return False
+
+
+def ler_prefixos(texto):
+    """'DGE_SQE_B4, DGE_SQE_B1_P3' -> ['DGE_SQE_B4', 'DGE_SQE_B1_P3']"""
+    return [p.strip() for p in re.split(r"[,;\s]+", texto or "") if p.strip()]
+
+
+def recortar_grupos(groups_df, nomes_ordenados, selecionados):
+    """
+    Ajusta a definição dos grupos à seleção.
+
+    Um grupo que contém variáveis selecionadas passa a começar na primeira e a
+    acabar na última delas; os grupos sem nenhuma variável selecionada são retirados.
+
+    Parâmetros:
+        groups_df (pd.DataFrame): grupos com as colunas name, inicio, fim
+        nomes_ordenados (list): nomes de todas as variáveis lidas, pela ordem do questionário
+        selecionados (set): nomes selecionados
+
+    Retorna:
+        pd.DataFrame: grupos recortados
+    """
+    posicao = {}
+    for pos, nome in enumerate(nomes_ordenados):
+        posicao.setdefault(str(nome).strip(), pos)
+
+    linhas = []
+    for _, grupo in groups_df.dropna(subset=["inicio", "fim"]).iterrows():
+        inicio = posicao.get(str(grupo["inicio"]).strip())
+        fim = posicao.get(str(grupo["fim"]).strip())
+        if inicio is None or fim is None:
+            continue
+        dentro = [nomes_ordenados[pos] for pos in range(inicio, fim + 1) if nomes_ordenados[pos] in selecionados]
+        if dentro:
+            linhas.append({**grupo.to_dict(), "inicio": dentro[0], "fim": dentro[-1]})
+    return pd.DataFrame(linhas, columns=groups_df.columns)
+
+
+def referencias_em_falta(survey):
+    """Nomes referidos em ${...} em qualquer coluna do survey que não estão definidos nele."""
+    definidos = set(survey["name"].dropna().astype(str).str.strip())
+    referidos = set()
+    for col in survey.columns:
+        if col == "name" or pd.api.types.is_numeric_dtype(survey[col]):
+            continue
+        valores = survey[col][survey[col].map(lambda v: isinstance(v, str) and "${" in v)]
+        for valor in valores:
+            referidos.update(nome.strip() for nome in PADRAO_REFERENCIA.findall(valor))
+    return referidos - definidos
@@ -5,6 +5,8 @@ from io import BytesIO
 import pandas as pd
 import streamlit as st
 
+from registo import LOGGER, Preguicoso
+
 
 # Função para remover acentos
 def remove_accents(text):
@@ -136,11 +138,8 @@ def process_sheet(df, groups):
         start_mask = df["name"].str.strip().replace("\n", "").replace("\r", "") == group["start_field"].strip().replace("\n", "").replace("\r", "")
 
         
-        print("============= Group =============================")
-        print(group)
-        print("============= names =============================")
-        print(df["name"].to_json(orient="records", lines=True, indent=4))
-        print("=========================================")
+        # Só serializa os nomes com o nível DEBUG ligado (antes era uma vez por grupo, sempre)
+        LOGGER.debug("Grupo %s; nomes: %s", group, Preguicoso(lambda: df["name"].to_json(orient="records", lines=True)))
         
         if not start_mask.any():  # Se o campo não existir
             st.warning(f"Campo de início não encontrado: {group['start_field']} no grupo {group['name']}")
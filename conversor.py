@@ -1,68 +1,156 @@
+import argparse
+import hashlib
 import os
 import re
+import sys
+import time
 import unicodedata
 from io import BytesIO
 
 import pandas as pd
 import streamlit as st
+import yaml
+from streamlit import runtime
+
+from analise_desempenho import LIMITES_PADRAO, analisar_desempenho, relatorio_json
+from analise_regex import analisar_regex
+from cobertura_regras import cobertura_para_excel, novo_relatorio, registar_regra, tabela_cobertura
+from construcao_parcial import MAX_PASSAGENS, corresponde_prefixo, ler_prefixos, recortar_grupos, referencias_em_falta
+from diff_formularios import build_publicado, comparar_formularios, diferencas_para_excel, form_id_de, marcar_publicado, resumo_diferencas
+from empacotamento import e_pacote, empacotar_arquivos
+from formularios_divididos import construir_formularios_divididos
+from limpeza_labels import limpar_labels
+from pre_visualizacao import antepassados, indexar_survey, linhas_visiveis, procurar, surveys_do_resultado
+from prevalidacao import erros_nome_variavel, mensagem_erros, prevalidar_planilhas
+from renomear_variaveis import ler_regras_renomeacao, renomear_variaveis
+from media_anexos import processar_anexos
+from opcoes_conversao import MIN_TERMOS_SOMA, validar_max_termos
+from registo import LOGGER, Preguicoso, configurar_registo, registar_etapa
+from regras_campos import aplicar_regras_campos, carregar_regras_campos, compilar_regras_campos
+from servico_conversao import FilaCheia, baixar_resultado, enviar_conversao, estado_conversao
+from tarefas_conversao import ColetorMensagens, ConversaoInterrompida, SaidaStreamlit, TarefaConversao, coletar_mensagens
+from validacao_xlsform import validar_xlsform
+from versao_formulario import versao_por_conteudo
+
+# As mensagens das conversões em segundo plano (e do serviço) vão para o coletor da tarefa
+st = SaidaStreamlit(st)
+# Resumos por etapa (INFO) na página; DEBUG, consola e JSONL pelas variáveis CONVERSOR_LOG_*
+configurar_registo(st)
 
 # Criar um espaço vazio para "limpar" a tela
 placeholder = st.empty()
 
-def remover_grupos_vazios(df):
+ETAPAS_CONVERSAO = ("Ler planilhas", "Cálculos e regras", "Grupos e relevants", "Páginas e totais",
+                    "Choices", "Anexos", "Análise", "Gerar XLSForm")
+
+
+def _avancar(progresso, etapa, detalhe=None, parcial=0.0):
+    """Informa a etapa atual da conversão (e permite cancelá-la entre etapas)."""
+    if progresso:
+        fracao = (ETAPAS_CONVERSAO.index(etapa) + parcial) / len(ETAPAS_CONVERSAO)
+        progresso(f"{etapa} ({detalhe})" if detalhe else etapa, fracao)
+
+_cache_tabelas = {}
+
+
+def ler_tabela_regras(caminho, **kwargs):
     """
-    Remove grupos que estão vazios (apenas com begin_group e end_group consecutivos).
-    
+    Lê uma tabela de regras (regex.xlsx, selects.xlsx, relevante.xlsx, Choices.xlsx)
+    uma só vez por versão do arquivo. Devolve uma cópia, para que as alterações
+    de quem a usa não cheguem à cache.
+    """
+    caminho = os.path.abspath(caminho)
+    chave = (caminho, os.path.getmtime(caminho), tuple(sorted(kwargs.items())))
+    if chave not in _cache_tabelas:
+        for antiga in [c for c in _cache_tabelas if c[0] == caminho and c[2] == chave[2]]:
+            del _cache_tabelas[antiga]
+        _cache_tabelas[chave] = pd.read_excel(caminho, **kwargs)
+    return _cache_tabelas[chave].copy()
+
+TIPOS_ABERTURA = {"begin_group": "end_group", "begin_repeat": "end_repeat"}
+TIPOS_FECHO = set(TIPOS_ABERTURA.values())
+
+
+def estrutura_grupos(tipos, nomes):
+    """
+    Passagem única com pilha pela estrutura begin/end do survey.
+
+    Um grupo é vazio quando não sobra nenhuma linha dentro dele depois de
+    retirar os grupos vazios aninhados. Grupos desequilibrados são reportados
+    e nunca removidos.
+
     Parâmetros:
-        df (pd.DataFrame): DataFrame com os dados do formulário
-     
+        tipos (list): coluna 'type'
+        nomes (list): coluna 'name'
+
     Retorna:
-        pd.DataFrame: DataFrame sem os grupos vazios
+        tuple: (posições a remover, lista de problemas com a linha do Excel)
+    """
+    remover = []
+    problemas = []
+    pilha = []  # [posição do begin, tipo de fecho esperado, linhas mantidas dentro]
+    for pos, tipo in enumerate(tipos):
+        tipo = str(tipo).strip()
+        if tipo in TIPOS_ABERTURA:
+            pilha.append([pos, TIPOS_ABERTURA[tipo], 0])
+        elif tipo in TIPOS_FECHO:
+            if not pilha:
+                problemas.append(f"{tipo} sem abertura na linha {pos + 2}")
+                continue
+            inicio, fecho, conteudo = pilha.pop()
+            if tipo != fecho:
+                problemas.append(f"'{nomes[inicio]}' aberto na linha {inicio + 2} fechado com {tipo} na linha {pos + 2}")
+            if conteudo == 0 and tipo == fecho:
+                remover.extend([inicio, pos])
+            elif pilha:
+                pilha[-1][2] += 1
+        elif pilha:
+            pilha[-1][2] += 1
+    for inicio, fecho, _ in pilha:
+        problemas.append(f"'{nomes[inicio]}' aberto na linha {inicio + 2} sem {fecho}")
+    return remover, problemas
+
+
+def remover_grupos_vazios(df, etapa=""):
     """
-    # Identificar índices dos grupos vazios
-    indices_para_remover = []
-    grupo_aberto = None
+    Remove grupos vazios (também os que só continham grupos vazios) e avisa
+    sobre grupos desequilibrados.
 
-    for idx, row in df.iterrows():
-        if row['type'] == 'begin_group':
-            # Registrar início do grupo
-            grupo_aberto = {
-                'start': idx,
-                'name': row['name']
-            }
-        elif row['type'] == 'end_group' and grupo_aberto:
-            # Verificar se é o fechamento do mesmo grupo
-            if grupo_aberto['name'] == row.get('name', ''):
-                end_idx = idx
-                # Verificar se o grupo está vazio (sem outras linhas entre begin e end)
-                conteudo_grupo = df.iloc[grupo_aberto['start']+1:end_idx]
-                if conteudo_grupo.empty:
-                    indices_para_remover.extend([grupo_aberto['start'], end_idx])
-                grupo_aberto = None
-
-    # Remover grupos vazios e resetar índice
-    df_limpo = df.drop(indices_para_remover).reset_index(drop=True)
-    
-    return df_limpo
+    Parâmetros:
+        df (pd.DataFrame): DataFrame com os dados do formulário
+        etapa (str): etapa do pipeline, para identificar os avisos
+
+    Retorna:
+        tuple: (DataFrame sem os grupos vazios, lista de problemas de equilíbrio)
+    """
+    remover, problemas = estrutura_grupos(df["type"].tolist(), df["name"].tolist())
+    if problemas:
+        st.warning(f"Grupos desequilibrados{f' após {etapa}' if etapa else ''}: " + "; ".join(problemas))
+    if remover:
+        df = df.drop(df.index[remover]).reset_index(drop=True)
+    return df, problemas
  
 
  
 
-def aplicar_regex(df):
+def aplicar_regex(df, relatorio=None):
     arquivo_validacoes="regex.xlsx"
     # Carregar a tabela de validações
-    validacoes = pd.read_excel(arquivo_validacoes)
+    validacoes = ler_tabela_regras(arquivo_validacoes)
 
     # Garantir que as colunas necessárias estão presentes
     colunas_necessarias = {"padrao", "excepto", "constraint", "constraint_message"}
     if not colunas_necessarias.issubset(validacoes.columns):
         raise ValueError(f"O arquivo {arquivo_validacoes} deve conter as colunas: {colunas_necessarias}")
 
-    # Adiciona colunas de validação ao DataFrame original
-    df["constraint"] = None
-    df["constraint_message"] = None
+    # Adiciona colunas de validação ao DataFrame original, sem apagar as que outras
+    # regras (ex: regras_campos.yaml) já escreveram; só as linhas correspondidas mudam
+    for coluna in ("constraint", "constraint_message"):
+        if coluna not in df.columns:
+            df[coluna] = None
 
     for index, row in validacoes.iterrows():
+        inicio = time.perf_counter()
         padrao = row["padrao"].lower().strip()
         excepto = str(row["excepto"]).lower().strip() if pd.notna(row["excepto"]) else None
         constraint = row["constraint"]
@@ -84,19 +172,22 @@ def aplicar_regex(df):
         df.loc[mask, "constraint"] = constraint
         df.loc[mask, "constraint_message"] = constraint_message
         #df.loc[mask, "appearance"] = "w10"
+        registar_regra(relatorio, arquivo_validacoes, f"linha {index + 2}: {padrao}", df.loc[mask, "name"].tolist(),
+                       time.perf_counter() - inicio, indices=df.loc[mask, "name"],
+                       coluna=["constraint", "constraint_message"])
 
     return df
 
 
 
 
-def atualizar_df_com_relevant(df, caminho_relevants):
+def atualizar_df_com_relevant(df, caminho_relevants, relatorio=None):
     """
     Atualiza o DataFrame com os campos 'relevant' com base no arquivo relevants.xlsx.
     """
     try:
         # Ler o arquivo de relevants
-        relevants_df = pd.read_excel(caminho_relevants)
+        relevants_df = ler_tabela_regras(caminho_relevants)
 
         # Normalizar os nomes das colunas (remover espaços e converter para minúsculas)
         relevants_df.columns = relevants_df.columns.str.strip().str.lower()
@@ -113,7 +204,8 @@ def atualizar_df_com_relevant(df, caminho_relevants):
         novo_df = df.copy()
 
         # Iterar sobre as linhas do arquivo de relevants
-        for _, relevant_row in relevants_df.iterrows():
+        for linha, relevant_row in relevants_df.iterrows():
+            inicio = time.perf_counter()
             variavel = relevant_row["variavel"]
             relevant_value = relevant_row["relevante"]
                         # Criar a máscara
@@ -138,21 +230,88 @@ def atualizar_df_com_relevant(df, caminho_relevants):
                 # Atualizar o campo 'relevant'
                 novo_df.loc[mask, "relevant"] = relevant_final
                 #if (len(variavel) <= 5):print(f"✅ Atualizado '{variavel_original}' -> relevant: {relevant_final}")
+            registar_regra(relatorio, "relevante.xlsx", f"linha {linha + 2}: {variavel}", novo_df.loc[mask, "name"].tolist(),
+                           time.perf_counter() - inicio, indices=novo_df.loc[mask, "name"], coluna="relevant")
         return novo_df
     
     except Exception as e:
         raise ValueError(f"Erro ao processar o arquivo {caminho_relevants}: {str(e)}")
 
 
+def _relevant_vazio(valor):
+    return pd.isna(valor) or str(valor).strip() == ""
+
+
+def elevar_relevants_para_grupos(df):
+    """
+    Move para o begin_group o 'relevant' repetido em todas as linhas de um grupo.
+
+    Quando todas as linhas diretamente dentro de um begin_group/end_group têm o
+    mesmo relevant, ele passa para a linha do grupo (combinado com 'and' se o
+    grupo já tiver um) e é limpo nas linhas filhas. Os grupos são tratados do
+    mais interno para o mais externo, por isso a elevação pode subir vários
+    níveis. Não se eleva um relevant que dependa de uma variável do próprio grupo.
+
+    Retorna:
+        tuple: (DataFrame atualizado, número de expressões removidas)
+    """
+    df = df.copy()
+    tipos = df["type"].astype(str).str.strip().tolist()
+    nomes = df["name"].tolist()
+    relevants = df["relevant"].tolist()
+
+    removidas = 0
+    # Cada grupo aberto: posição do begin_group, posições dos filhos diretos, nomes contidos
+    pilha = []
+    for pos, tipo in enumerate(tipos):
+        if tipo == "begin_group":
+            if pilha:
+                pilha[-1]["filhos"].append(pos)
+            pilha.append({"inicio": pos, "filhos": [], "nomes": set()})
+            continue
+
+        if tipo == "end_group":
+            if not pilha:
+                continue
+            grupo = pilha.pop()
+            filhos = grupo["filhos"]
+            valores = {str(relevants[f]).strip() for f in filhos if not _relevant_vazio(relevants[f])}
+            todos_com_relevant = all(not _relevant_vazio(relevants[f]) for f in filhos)
+            if len(filhos) >= 2 and todos_com_relevant and len(valores) == 1:
+                expressao = valores.pop()
+                referencias = set(re.findall(r"\$\{([^}]+)\}", expressao))
+                if not referencias & grupo["nomes"]:
+                    atual = relevants[grupo["inicio"]]
+                    if _relevant_vazio(atual) or str(atual).strip() == expressao:
+                        relevants[grupo["inicio"]] = expressao
+                    else:
+                        relevants[grupo["inicio"]] = f"({str(atual).strip()}) and ({expressao})"
+                    for f in filhos:
+                        relevants[f] = ""
+                    removidas += len(filhos) - 1
+            if pilha:
+                pilha[-1]["nomes"] |= grupo["nomes"]
+                pilha[-1]["nomes"].add(nomes[grupo["inicio"]])
+            continue
+
+        if pilha:
+            pilha[-1]["filhos"].append(pos)
+            pilha[-1]["nomes"].add(nomes[pos])
+
+    df["relevant"] = relevants
+    registar_etapa("relevants", "Relevants elevados para os grupos: %d expressões removidas.", removidas, removidas=removidas)
+    return df, removidas
+
 
-def atualizar_df_com_selects(df, caminho_selects):
+
+def atualizar_df_com_selects(df, caminho_selects, relatorio=None):
     """
     Atualiza o DataFrame com os campos relevant, choice_filter e type
     com base no arquivo selects.xlsx.
     """
     try:
         # Ler o arquivo de selects
-        selects_df = pd.read_excel(caminho_selects)
+        selects_df = ler_tabela_regras(caminho_selects)
 
         # Normalizar os nomes das colunas (remover espaços e converter para minúsculas)
         selects_df.columns = selects_df.columns.str.strip().str.lower()
@@ -169,7 +328,8 @@ def atualizar_df_com_selects(df, caminho_selects):
         novo_df = df.copy()
 
         # Iterar sobre as linhas do arquivo de selects
-        for _, select_row in selects_df.iterrows():
+        for linha, select_row in selects_df.iterrows():
+            inicio = time.perf_counter()
             variavel = select_row["variavel"]
             tipo = select_row["type"]
             choice_filter = select_row.get("choice_filter", "")  # Usar get para evitar KeyError
@@ -192,6 +352,9 @@ def atualizar_df_com_selects(df, caminho_selects):
                     choice_final = choice_filter.replace("(prefixo)", f"{prefixo}")
                     
                     novo_df.loc[mask, "choice_filter"] = f"{choice_final}"  
+            registar_regra(relatorio, "selects.xlsx", f"linha {linha + 2}: {variavel}", novo_df.loc[mask, "name"].tolist(),
+                           time.perf_counter() - inicio, indices=novo_df.loc[mask, "name"],
+                           coluna=["type", "choice_filter"] if pd.notna(choice_filter) else "type")
             
         return novo_df
 
@@ -254,21 +417,6 @@ def is_valid_variable_name(name):
 
 
 
-def adicionar_type_decimal(df):
-   
-    # Altera o tipo para 'decimal' nas variáveis específicas
-    variaveis_para_decimal = [
-        "Q2CG_DGE_SQE_B4_P2_distancia_aproximada_escola_secretaria_municipal_educacao",
-        "Q2CG_DGE_SQE_B4_P3_distancia_aproximada_escola_gabinete_secretaria_provincial_educacao"
-    ]
-    
-    for index, row in df.iterrows():
-        if row['name'] in variaveis_para_decimal:
-            df.at[index, 'type'] = 'decimal'
-    
-    return df
-
-
 def adicionar_geolocalizacao_da_escola(df):
     """
     Adiciona variáveis de geolocalização ao formulário, permitindo que o usuário escolha se deseja capturar a localização.
@@ -355,6 +503,8 @@ def adicionar_campos_exibicao_totais(df):
 
     for index, row in df.iterrows():
         if row["type"] == "calculate" and ("_total" in row["name"].lower() or "total_" in row["name"].lower()):
+            if row["name"].startswith(PREFIXO_SOMA_PARCIAL):
+                continue
             campo_exibicao = {
                 "type": "note",
                 "name": f"exibir_{row['name']}",
@@ -380,7 +530,7 @@ def adicionar_campos_exibicao_totais(df):
 def check_variable_names(df):
     """Verifica nomes de variáveis e retorna os inválidos destacando o erro dentro da string"""
 
-    st.write("Verificando nomes das variáveis...")
+    LOGGER.debug("Verificando nomes das variáveis (%d linhas)...", len(df))
 
     if 'name' not in df.columns:
         st.error("Coluna 'name' não encontrada no dataset!")
@@ -391,57 +541,14 @@ def check_variable_names(df):
     invalid_vars = []
 
     for idx, row in df.iterrows():
-        var_name = str(row['name']).strip()
-        
-        if pd.isna(row['name']) or var_name == "":
-            invalid_vars.append({
-                'linha': idx + 2,
-                'nome_original': var_name,
-                'nome_formatado': "(ERRO->Vazio)",
-                'erro': 'Nome da variável está vazio ou nulo'
-            })
-            continue
-
-        erro_detectado = False
-        nome_formatado = var_name
-
-        # Verificar se começa com número
-        if re.match(r'^\d', var_name):
-            nome_formatado = f"(ERRO->{var_name[0]})" + var_name[1:]
-            invalid_vars.append({
-                'linha': idx + 2,
-                'nome_original': var_name,
-                'nome_formatado': nome_formatado,
-                'erro': f"Nome não pode começar com número ('{var_name[0]}')"
-            })
-            erro_detectado = True
-
-        # Verificar caracteres inválidos
-        for char in re.finditer(r'[^a-zA-Z0-9_]', var_name):
-            pos = char.start()
-            nome_formatado = var_name[:pos] + f"(ERRO->{char.group()})" + var_name[pos+1:]
-            invalid_vars.append({
-                'linha': idx + 2,
-                'nome_original': var_name,
-                'nome_formatado': nome_formatado,
-                'erro': f"Caractere inválido '{char.group()}'"
-            })
-            erro_detectado = True
-
-        # Verificar espaços
-        if ' ' in var_name:
-            pos = var_name.find(" ")
-            nome_formatado = var_name[:pos] + "(ERRO-> )" + var_name[pos+1:]
+        var_name = "" if pd.isna(row['name']) else str(row['name']).strip()
+        for nome_formatado, erro in erros_nome_variavel(var_name):
             invalid_vars.append({
                 'linha': idx + 2,
                 'nome_original': var_name,
                 'nome_formatado': nome_formatado,
-                'erro': "Nome contém espaços"
+                'erro': erro
             })
-            erro_detectado = True
-
-        if erro_detectado:
-            continue
 
     # Exibir erros formatados
     if invalid_vars:
@@ -485,7 +592,7 @@ def process_sheet(df,sheet_name):
     missing_columns = [col for col in expected_columns if col not in lista]
     
     if missing_columns:
-        st.write(f"As seguintes colunas não foram encontradas nesta planilha ({sheet_name}): {missing_columns}. Pulando...")
+        LOGGER.info("As seguintes colunas não foram encontradas nesta planilha (%s): %s. Pulando...", sheet_name, missing_columns)
         return None
     
     df = df.dropna(how='all').dropna(axis=1, how='all')
@@ -532,7 +639,8 @@ def process_sheet(df,sheet_name):
     "calculation",
     "constraint_message",
     "relevant",
-    "choice_filter"
+    "choice_filter",
+    "media"
 ]
     
     for col in survey_columns:
@@ -544,7 +652,6 @@ def process_sheet(df,sheet_name):
 def add_groups(survey_df, groups_df):
     groups_df = groups_df.dropna(subset=['inicio', 'fim'])
     existing_groups = set()
-    st.write("======================= ADICIONANDO GUPOS ==========================")
     #st.write(f"Variaveis existentes no config.xls: {survey_df['name'].tolist()}")
     for _ in range(2):  # Duas verificações
         for _, group in groups_df.iterrows():
@@ -605,106 +712,337 @@ def add_groups(survey_df, groups_df):
             survey_df = survey_df.sort_index().reset_index(drop=True)
             
     return survey_df
+
+
+# Token da pergunta no nome da variável, ex: DGE_SQE_B4_P5_1_classe_m -> P5
+PADRAO_TOKEN_PERGUNTA = re.compile(r"_(P\d+)(?:_|$)")
+
+COLUNAS_CUSTO = ["relevant", "constraint", "calculation", "choice_filter"]
+
+
+def _custo_linha(row):
+    """Custo aproximado de uma linha: 1 por expressão mais 1 por cada ${} referenciado."""
+    custo = 0
+    for col in COLUNAS_CUSTO:
+        valor = row.get(col)
+        if pd.notna(valor) and str(valor).strip():
+            custo += 1 + str(valor).count("${")
+    return custo
+
+
+def dividir_grupos_field_list(df, max_perguntas=None, max_custo=None, label_col='label::Portugues (pt)'):
+    """
+    Divide grupos 'field-list' demasiado grandes em páginas numeradas.
+
+    O grupo original fica como grupo externo (mantém name, label e relevant, mas
+    perde o appearance field-list) e os seus filhos são distribuídos por
+    sub-grupos '<grupo>_parte_<n>' com appearance field-list. Os cortes só
+    acontecem onde muda o token da pergunta (P1, P2, ...) no nome da variável;
+    um grupo aninhado conta como um único bloco.
+
+    Retorna:
+        pd.DataFrame: DataFrame com os grupos divididos
+    """
+    if not max_perguntas and not max_custo:
+        return df
+
+    linhas = df.to_dict("records")
+    antes = {}  # posição -> linhas a inserir antes dela
+    divididos = 0
+
+    def token(pos):
+        m = PADRAO_TOKEN_PERGUNTA.search(str(linhas[pos].get("name", "")))
+        return m.group(1) if m else None
+
+    def excede(perguntas, custo):
+        return (max_perguntas and perguntas > max_perguntas) or (max_custo and custo > max_custo)
+
+    pilha = []
+    for pos, linha in enumerate(linhas):
+        tipo = str(linha.get("type", "")).strip()
+        if tipo == "begin_group":
+            pilha.append({"inicio": pos, "filhos": [], "perguntas": 0, "custo": _custo_linha(linha)})
+            continue
+        if tipo != "end_group":
+            e_pergunta = tipo not in ("calculate", "", "nan")
+            if pilha:
+                pilha[-1]["filhos"].append((pos, pos, int(e_pergunta), _custo_linha(linha)))
+            continue
+        if not pilha:
+            continue
+
+        grupo = pilha.pop()
+        total_perguntas = sum(f[2] for f in grupo["filhos"])
+        total_custo = sum(f[3] for f in grupo["filhos"])
+        if pilha:
+            pilha[-1]["filhos"].append((grupo["inicio"], pos, total_perguntas, total_custo + grupo["custo"]))
+
+        begin = linhas[grupo["inicio"]]
+        appearance = str(begin.get("appearance", "") if pd.notna(begin.get("appearance")) else "")
+        if "field-list" not in appearance or not excede(total_perguntas, total_custo):
+            continue
+
+        # Juntar filhos consecutivos com o mesmo token de pergunta em blocos indivisíveis
+        blocos = []
+        for filho in grupo["filhos"]:
+            t = token(filho[0])
+            if blocos and (t is None or t == blocos[-1]["token"]):
+                blocos[-1]["filhos"].append(filho)
+            else:
+                blocos.append({"token": t, "filhos": [filho]})
+
+        paginas = []
+        for bloco in blocos:
+            perguntas = sum(f[2] for f in bloco["filhos"])
+            custo = sum(f[3] for f in bloco["filhos"])
+            if paginas and not excede(paginas[-1]["perguntas"] + perguntas, paginas[-1]["custo"] + custo):
+                paginas[-1]["filhos"].extend(bloco["filhos"])
+                paginas[-1]["perguntas"] += perguntas
+                paginas[-1]["custo"] += custo
+            else:
+                paginas.append({"filhos": list(bloco["filhos"]), "perguntas": perguntas, "custo": custo})
+
+        if len(paginas) < 2:
+            continue
+
+        nome_grupo = begin.get("name")
+        label = begin.get(label_col)
+        label = "" if pd.isna(label) else str(label)
+        begin["appearance"] = " ".join(a for a in appearance.split() if a != "field-list")
+        for n, pagina in enumerate(paginas, start=1):
+            primeira = pagina["filhos"][0][0]
+            antes.setdefault(primeira, []).append({
+                "type": "begin_group",
+                "name": f"{nome_grupo}_parte_{n}",
+                label_col: f"{label} ({n}/{len(paginas)})".strip(),
+                "appearance": "field-list"
+            })
+            # O end_group da página fica antes da primeira linha da página seguinte (ou do end_group externo)
+            fim = paginas[n]["filhos"][0][0] if n < len(paginas) else pos
+            antes.setdefault(fim, []).append({"type": "end_group"})
+        divididos += 1
+
+    if not divididos:
+        return df
+
+    novas_linhas = []
+    for pos, linha in enumerate(linhas):
+        novas_linhas.extend(antes.get(pos, []))
+        novas_linhas.append(linha)
+
+    registar_etapa("paginas", "Grupos field-list divididos em páginas: %d", divididos, divididos=divididos)
+    return pd.DataFrame(novas_linhas, columns=df.columns)
  
 #=========================================================================
-# 📌 Dicionário de regras sem os prefixos (mapeia somente o sufixo real da variável)
-
-# 📌 Dicionário de regras sem os prefixos
-REGRAS = {
-    "DGE_SQE_B0_P0_id_questionario": {
-        "constraint": "regex(., '^[0-9]{1,10}$')",
-        "constraint_msg": "Deve conter somente dígitos e ter no máximo 10 caracteres.",
-        "calculation": "substr(uuid(), 0, 8)",
-        "label_varavel": "ID do questionário"
-    },
-    "DGE_SQE_B0_P1_codigo_escola": {
-        "constraint": "regex(., '^[0-9]{1,11}$')",
-        "constraint_msg": "Deve conter somente dígitos e ter no máximo 11 caracteres.",
-        "calculation": "substr(uuid(), 0, 8)",
-        "label_varavel": "Código da escola"
-    },
-    "DGE_SQE_B0_P2_inicio_ano_lectivo": {
-        "calculation": "2024",
-        "constraint": "",
-        "constraint_msg": "",
-        "label_varavel": "Início do ano letivo"
-    },
-    "DGE_SQE_B0_P3_fim_ano_lectivo": {
-        "calculation": lambda var_name: f"${{{var_name.replace('fim', 'inicio').replace('P3', 'P2')}}} + 1",
-        "constraint": "",
-        "constraint_msg": "",
-        "label_varavel": "fim do ano letivo"
-    }
-}
+# Campos que identificam a submissão e são repetidos em todas as partes de um formulário dividido
+CAMPOS_IDENTIFICACAO = ['DGE_SQE_B0_P0_id_questionario', 'DGE_SQE_B0_P1_codigo_escola']
 
-def gerar_campos_automaticos(df, variaveis):
+def gerar_campos_automaticos(df, regras=None, relatorio=None, avisar_em_falta=True):
     """
-    Modifica variáveis existentes para 'calculate' e cria 'notes' correspondentes.
-    Agora funciona para qualquer variável automática sem depender dos prefixos do questionário.
+    Aplica as regras de regras_campos.yaml: tipos (ex: decimal), campos
+    'calculate' automáticos e as 'notes' que os mostram.
+
+    As regras de sufixo funcionam para qualquer variável automática sem
+    depender dos prefixos do questionário.
+
+    Parâmetros:
+        df (pd.DataFrame): survey
+        regras (dict): regras compiladas; por omissão as de regras_campos.yaml
+        relatorio (dict): relatório de cobertura das regras (opcional)
+        avisar_em_falta (bool): avisar quando nenhuma variável termina com um sufixo
+
+    Retorna:
+        pd.DataFrame: survey com as regras aplicadas
     """
-    df = df.copy()
+    if regras is None:
+        regras = carregar_regras_campos()
 
     # 🔹 Remove valores NaN na coluna "name"
     df = df.dropna(subset=["name"])
 
-    for var_sufixo in reversed(variaveis):
-        # 🔍 Encontra qualquer variável que termine exatamente com o nome esperado
-        match_indices = df.index[df['name'].str.endswith(var_sufixo, na=False)].tolist()
+    df, aplicadas = aplicar_regras_campos(df, regras)
+
+    # Sufixos primeiro: quando uma regra exata e uma de sufixo escrevem a mesma
+    # célula, a exata prevalece e aparece como sobreposta à de sufixo
+    for seccao in ("sufixos", "exatos"):
+        for chave in regras[seccao]:
+            aplicada = aplicadas[(seccao, chave)]
+            if avisar_em_falta and seccao == "sufixos" and not aplicada["nomes"]:
+                st.warning(f"Variável terminando com '{chave}' não encontrada. Pulando...")
+            registar_regra(relatorio, "regras_campos.yaml", f"{seccao}: {chave}", aplicada["nomes"],
+                           aplicada["segundos"], indices=aplicada["nomes"], coluna=aplicada["colunas"])
+    return df
 
-        if not match_indices:
-            st.warning(f"Variável terminando com '{var_sufixo}' não encontrada. Pulando...")
-            continue
 
-        # Pega o primeiro índice correspondente
-        idx = match_indices[0]
-        var_name = df.at[idx, 'name']
-
-        # Aplica regras, se existirem
-        if var_sufixo in REGRAS:
-            regra = REGRAS[var_sufixo]
-            calculation = regra["calculation"] if isinstance(regra["calculation"], str) else regra["calculation"](var_name)
-            constraint = regra["constraint"]
-            constraint_msg = regra["constraint_msg"]
-            label_varavel=regra["label_varavel"]
-        else:
-            st.warning(f"Regras para '{var_sufixo}' não encontradas. Pulando...")
-            continue
 
-        # Modifica a linha existente (calculate)
-        df.at[idx, 'type'] = 'calculate'
-        df.at[idx, 'calculation'] = calculation
-        df.at[idx, 'constraint'] = constraint
-        df.at[idx, 'constraint_message'] = constraint_msg
-        df.at[idx, 'label::Portugues (pt)'] = f'Valor gerado automaticamente para {var_sufixo.replace("_", " ")}'
-
-        # Criar uma linha "note" dinâmica abaixo
-        note_row = {
-            'type': 'note',
-            'name': f'show_aux_{var_sufixo}',
-            'label::Portugues (pt)': f'{label_varavel} : ${{{var_name}}}',
-            'hint::Portugues (pt)': '',
-            'required': 'false',
-            'appearance': '',
-            'constraint': '',
-            'calculation': '',
-            'constraint_message': '',
-            'relevant': '',
-            'choice_filter': ''
-        }
+#=========================================================================
+
+def deduplicar_listas_choices(survey, choices):
+    """
+    Junta listas de choices idênticas numa única list_name canónica.
+
+    Cada lista é identificada por um hash das suas linhas (name, label e colunas
+    de filtro, pela ordem original). Listas com o mesmo hash passam a usar a
+    list_name da primeira ocorrência e os 'type' do survey são reescritos.
+
+    Retorna:
+        tuple: (survey, choices, linhas_poupadas)
+    """
+    colunas_conteudo = [col for col in choices.columns if col != "list_name"]
+    conteudo = choices[colunas_conteudo].astype(str).where(choices[colunas_conteudo].notna(), "")
+
+    canonica_por_hash = {}
+    renomear = {}
+    for list_name, linhas in conteudo.groupby(choices["list_name"], sort=False):
+        assinatura = hashlib.sha1(
+            "\x1f".join("\x1e".join(linha) for linha in linhas.itertuples(index=False, name=None)).encode("utf-8")
+        ).hexdigest()
+        canonica = canonica_por_hash.setdefault(assinatura, list_name)
+        if canonica != list_name:
+            renomear[list_name] = canonica
+
+    if not renomear:
+        return survey, choices, 0
+
+    duplicadas = choices["list_name"].isin(renomear.keys())
+    linhas_poupadas = int(duplicadas.sum())
+    choices = choices[~duplicadas].reset_index(drop=True)
+
+    # Reescrever 'select_one X' / 'select_multiple X' no survey
+    partes = survey["type"].astype(str).str.extract(r"^(select_one|select_multiple)\s+(\S+)(.*)$")
+    mask = partes[1].isin(renomear.keys())
+    survey = survey.copy()
+    survey.loc[mask, "type"] = partes.loc[mask, 0] + " " + partes.loc[mask, 1].map(renomear) + partes.loc[mask, 2]
+
+    registar_etapa("choices", "Listas de choices duplicadas unidas: %d (%d linhas poupadas).", len(renomear), linhas_poupadas,
+                   listas_unidas=len(renomear), linhas_poupadas=linhas_poupadas)
+    return survey, choices, linhas_poupadas
+
+
+def _valor_csv(valor):
+    """Converte um valor de choices para texto de CSV (121.0 -> '121', NaN -> '')."""
+    if pd.isna(valor):
+        return ""
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor).strip()
+
+
+def externalizar_listas_grandes(survey, choices, limite_linhas, label_col='label::Portugues (pt)'):
+    """
+    Move para CSVs externos as listas de choices com mais de 'limite_linhas' linhas
+    que são usadas em perguntas com choice_filter (selects em cascata).
+
+    O 'type' das perguntas passa a 'select_one_from_file <lista>.csv' (ou
+    'select_multiple_from_file'); o choice_filter continua igual, porque o CSV
+    mantém as colunas de filtro (provincia_selected, municipio_selected, ...).
+
+    Retorna:
+        tuple: (survey, choices, media) onde media é {nome_arquivo: bytes}
+    """
+    partes = survey["type"].astype(str).str.extract(r"^(select_one|select_multiple)\s+(\S+)(.*)$")
+    com_filtro = survey["choice_filter"].notna() & (survey["choice_filter"].astype(str).str.strip() != "")
+
+    tamanhos = choices.groupby("list_name").size()
+    listas_filtradas = set(partes.loc[com_filtro, 1].dropna())
+    listas_grandes = [lista for lista in listas_filtradas if tamanhos.get(lista, 0) > limite_linhas]
 
-        # Inserir a linha note logo abaixo
-        df.loc[idx + 0.5] = note_row
+    if not listas_grandes:
+        return survey, choices, {}
 
-    # Reordenar e resetar índices
-    return df.sort_index().reset_index(drop=True)
+    colunas_filtro = [col for col in choices.columns if col not in ("list_name", "name", label_col)]
+    media = {}
+    for lista in sorted(listas_grandes):
+        linhas = choices[choices["list_name"] == lista]
+        csv_df = pd.DataFrame({"name": linhas["name"].map(_valor_csv), "label": linhas[label_col].map(_valor_csv)})
+        for col in colunas_filtro:
+            if linhas[col].notna().any():
+                csv_df[col] = linhas[col].map(_valor_csv)
+        media[f"{lista}.csv"] = csv_df.to_csv(index=False).encode("utf-8")
 
+    # Reescrever o type de todas as perguntas que usam as listas externalizadas
+    survey = survey.copy()
+    mask = partes[1].isin(listas_grandes)
+    survey.loc[mask, "type"] = (partes.loc[mask, 0] + "_from_file " + partes.loc[mask, 1] + ".csv" + partes.loc[mask, 2])
+
+    choices = choices[~choices["list_name"].isin(listas_grandes)].reset_index(drop=True)
+
+    registar_etapa("csv_externo", "Listas movidas para CSV externo (> %d linhas): %s", limite_linhas,
+                   Preguicoso(lambda: ", ".join(sorted(listas_grandes))), listas=len(listas_grandes))
+    return survey, choices, media
 
 
 #=========================================================================
- 
+
+# Prefixo das variáveis intermédias criadas ao partir somas muito longas
+PREFIXO_SOMA_PARCIAL = "soma_parcial_"
+
+
+def _reutilizar_subtotais(somas):
+    """
+    Substitui, em cada soma, os termos já cobertos por outra soma (subtotal).
+
+    Uma soma U só é reutilizada na soma T quando as variáveis de U são um
+    subconjunto estrito das de T, o que garante que não se criam ciclos.
+    Os subtotais maiores são escolhidos primeiro e nunca se sobrepõem.
+
+    Retorna:
+        dict: {variavel_alvo: lista de termos (variáveis ou subtotais)}
+    """
+    conjuntos = {alvo: set(vars_somar) for alvo, vars_somar in somas.items()}
+    por_tamanho = sorted(conjuntos, key=lambda alvo: len(conjuntos[alvo]), reverse=True)
+
+    resultado = {}
+    for alvo, vars_somar in somas.items():
+        restantes = set(conjuntos[alvo])
+        cobertura = {}  # variável -> subtotal que a cobre
+        for candidato in por_tamanho:
+            conjunto = conjuntos[candidato]
+            if candidato == alvo or len(conjunto) < 2 or not conjunto < conjuntos[alvo]:
+                continue
+            if conjunto <= restantes:
+                restantes -= conjunto
+                cobertura.update(dict.fromkeys(conjunto, candidato))
+
+        # Manter a ordem original, colocando cada subtotal no lugar da sua primeira variável
+        termos = []
+        for var in vars_somar:
+            termo = cobertura.get(var, var)
+            if termo not in termos:
+                termos.append(termo)
+        resultado[alvo] = termos
+    return resultado
+
+
+def _dividir_cadeia(alvo, termos, max_termos):
+    """
+    Parte uma soma com mais de 'max_termos' termos em calculates intermédios.
+
+    Retorna:
+        tuple: (expressão final, lista de linhas 'calculate' auxiliares por ordem)
+    """
+    if not max_termos:
+        raise ValueError("max_termos tem de ser definido para partir uma soma")
+    validar_max_termos(max_termos)
+    linhas_auxiliares = []
+    nivel = 0
+    while len(termos) > max_termos:
+        nivel += 1
+        parciais = []
+        for i in range(0, len(termos), max_termos):
+            nome = f"{PREFIXO_SOMA_PARCIAL}{nivel}_{i // max_termos + 1}_{alvo}"
+            linhas_auxiliares.append({
+                'type': 'calculate',
+                'name': nome,
+                'calculation': '+'.join(f'coalesce(${{{var}}},0)' for var in termos[i:i + max_termos])
+            })
+            parciais.append(nome)
+        termos = parciais
+    return '+'.join(f'coalesce(${{{var}}},0)' for var in termos), linhas_auxiliares
+
+
 # Função para adicionar cálculos automáticos baseados em padrões de um Excel
-def adicionar_calculos_automaticos(df, excel_path):
-    st.write("Adicionando cálculos automáticos...")
+def adicionar_calculos_automaticos(df, excel_path, subtotais_hierarquicos=False, max_termos=None, relatorio=None):
     #st.json(df['name'].values.tolist())
     """
     Adiciona cálculos automáticos baseados em padrões de um Excel, evitando ciclos.
@@ -712,18 +1050,23 @@ def adicionar_calculos_automaticos(df, excel_path):
     Parâmetros:
         df (pd.DataFrame): DataFrame principal do formulário
         excel_path (str): Caminho para o Excel com os padrões
+        subtotais_hierarquicos (bool): Reutiliza somas já existentes (subtotais)
+            dentro das somas que as contêm, em vez de repetir os termos
+        max_termos (int): Se definido, somas com mais termos são partidas em
+            calculates intermédios (soma_parcial_*); 0 ou None desativa, senão >= 2
 
     Retorna:
         pd.DataFrame: DataFrame atualizado com os cálculos adicionados.
     """
+    validar_max_termos(max_termos)
     try:
         padroes_df = pd.read_excel(excel_path)
     except Exception as e:
-        print(f"Erro ao ler arquivo de padrões: {str(e)}")
+        LOGGER.error("Erro ao ler arquivo de padrões: %s", e)
         return df
 
     if not all(col in padroes_df.columns for col in ['name', 'pergunta', 'padrao', 'excepto']):
-        print("Arquivo de padrões deve conter as colunas: name, pergunta, padrao, excepto")
+        LOGGER.error("Arquivo de padrões deve conter as colunas: name, pergunta, padrao, excepto")
         return df
 
     existing_calculations = df.set_index('name')['calculation'].dropna().to_dict()
@@ -731,7 +1074,7 @@ def adicionar_calculos_automaticos(df, excel_path):
     def has_cycle(var, visited):
         """ Verifica se há um ciclo nos cálculos antes de adicionar. """
         if var in visited:
-            print(f"⚠️ Ciclo detectado: {var}")
+            LOGGER.debug("Ciclo detectado: %s", var)
             return True  # Ciclo detectado
         if var not in existing_calculations:
             return False  # Variável não tem cálculo ainda
@@ -744,19 +1087,19 @@ def adicionar_calculos_automaticos(df, excel_path):
         visited.remove(var)
         return False
 
-    for _, row in padroes_df.iterrows():
+    somas = {}
+    alvos_em_falta = 0
+    for linha, row in padroes_df.iterrows():
+        inicio = time.perf_counter()
         target_var = row['name']
         pergunta = str(row['pergunta']).strip()
         padroes = [p.strip().lower() for p in str(row['padrao']).split(',')]
         excepto = [e.strip().lower() for e in str(row['excepto']).split(',') if e.strip()]
-        #st.write(f"Variável alvo: {target_var}")
-        #st.write(f"Padroes: {padroes}")
-        #st.write(f"Excepto: {excepto}")
-        #st.write(f"Pergunta: {pergunta}")
-        #st.write(f"=============================================================")
 
         if target_var not in df['name'].values:
-            print(f"⚠️ Variável alvo '{target_var}' não encontrada no formulário.")
+            LOGGER.debug("Variável alvo '%s' não encontrada no formulário.", target_var)
+            alvos_em_falta += 1
+            registar_regra(relatorio, "somatorios", f"linha {linha + 2}: {target_var}", [], time.perf_counter() - inicio)
             continue
 
         # Filtrar variáveis da mesma pergunta
@@ -769,59 +1112,223 @@ def adicionar_calculos_automaticos(df, excel_path):
             var_clean = var.lower()
             if var_clean == target_var.lower():
                 continue
-                #st.write(f"Variavel DO RESULTADO DA SOMA : {target_var}")
-                #st.write(f"Variável somando: {var_clean}")
-                #st.write(f"Padrão está em var: {any(padrao in var_clean for padrao in padroes)}")
-                #st.write(f"Exceto está em var: {any(exc in var_clean for exc in excepto)}")
-                #st.write(f"LISTA DE padoes:{padroes}")
-                
+
             if any(padrao in var_clean for padrao in padroes)==True and not any(exc in var_clean for exc in excepto):
                 vars_somar.append(var)
          
+        registar_regra(relatorio, "somatorios", f"linha {linha + 2}: {target_var}", vars_somar, time.perf_counter() - inicio,
+                       indices=[target_var], coluna="calculation")
         if not vars_somar:
             #print(f"⚠️ Nenhuma variável encontrada para {target_var} com padrões: {', '.join(padroes)} (exceto: {', '.join(excepto)})")
             continue
 
-        new_calculation = '+'.join([f'coalesce(${{{var}}},0)' for var in vars_somar])
-        #new_calculation = ' + '.join([f"if(${{{var}}}='', 0, ${{{var}}})" for var in vars_somar])
-        
-        
         if has_cycle(target_var, set()):
-            print(f"❌ Cálculo ignorado para {target_var} para evitar ciclo.")
+            LOGGER.warning("Cálculo ignorado para %s para evitar ciclo.", target_var)
             continue
 
+        somas[target_var] = vars_somar
+
+    termos_por_alvo = _reutilizar_subtotais(somas) if subtotais_hierarquicos else somas
+
+    linhas_para_inserir = []
+    for target_var, termos in termos_por_alvo.items():
+        if max_termos and len(termos) > max_termos:
+            new_calculation, linhas_auxiliares = _dividir_cadeia(target_var, termos, max_termos)
+            target_idx = df.index[df['name'] == target_var][0]
+            linhas_para_inserir.append((target_idx, linhas_auxiliares))
+        else:
+            new_calculation = '+'.join([f'coalesce(${{{var}}},0)' for var in termos])
+
         # Atualizar o cálculo na variável alvo
         df.loc[df['name'] == target_var, 'calculation'] = new_calculation
         df.loc[df['name'] == target_var, 'type'] = 'calculate'
-    st.write("Cálculos automáticos adicionados com sucesso.")
-    st.write("==CONCLUÍDO==")
+
+    if subtotais_hierarquicos or max_termos:
+        termos_antes = sum(len(v) for v in somas.values())
+        termos_depois = sum(len(v) for v in termos_por_alvo.values())
+        registar_etapa("somas", "Somas: %d termos reduzidos para %d reutilizando subtotais; %d calculates intermédios criados.",
+                       termos_antes, termos_depois, sum(len(l) for _, l in linhas_para_inserir),
+                       termos_antes=termos_antes, termos_depois=termos_depois)
+
+    # Inserir os calculates intermédios logo antes da variável alvo
+    for target_idx, linhas_auxiliares in linhas_para_inserir:
+        for ordem, linha in enumerate(linhas_auxiliares, start=1):
+            df.loc[target_idx - 1 + ordem / (len(linhas_auxiliares) + 1)] = linha
+    if linhas_para_inserir:
+        df = df.sort_index().reset_index(drop=True)
+
+    registar_etapa("calculos", "Cálculos automáticos: %d somas de %d padrões (%d variáveis alvo não encontradas).",
+                   len(somas), len(padroes_df), alvos_em_falta,
+                   somas=len(somas), padroes=len(padroes_df), alvos_em_falta=alvos_em_falta)
     return df
 
+def mostrar_analise_desempenho(resultado):
+    """Mostra no Streamlit os achados da análise de desempenho e oferece o JSON."""
+    achados = resultado["achados"]
+    if not achados:
+        st.success("Análise de desempenho: nenhum problema encontrado.")
+        return
+    st.warning(f"Análise de desempenho: {len(achados)} achados (pontuação de custo {resultado['pontuacao']}).")
+    st.dataframe(pd.DataFrame(achados))
+    st.download_button(
+        label="Baixar análise de desempenho (JSON)",
+        data=relatorio_json(resultado),
+        file_name="analise_desempenho.json",
+        mime="application/json"
+    )
+
+
+def mostrar_validacao(resultado, max_mensagens=20, titulo="XLSForm"):
+    """Mostra os erros e avisos da validação do XLSForm."""
+    erros, avisos = resultado["erros"], resultado["avisos"]
+    if not erros and not avisos:
+        st.success(f"Validação do {titulo}: sem problemas ({resultado['segundos']} s).")
+        return
+    if erros:
+        mensagem = f"Validação do {titulo}: {len(erros)} erros que o servidor vai rejeitar:\n\n"
+        for erro in erros[:max_mensagens]:
+            mensagem += f"- {erro['aba']}, linha {erro['linha']} ({erro['name']}): {erro['erro']}\n"
+        if len(erros) > max_mensagens:
+            mensagem += f"- ... e mais {len(erros) - max_mensagens}\n"
+        st.error(mensagem)
+    if avisos:
+        st.warning(f"Validação do {titulo}: {len(avisos)} avisos.")
+    with st.expander(f"Problemas da validação do {titulo}"):
+        st.dataframe(pd.DataFrame(erros + avisos), hide_index=True)
+
+def mostrar_analise_regex(tabela, orcamento_ms, bloquear=False):
+    """
+    Mostra os regex() com risco de backtracking ou acima do orçamento de tempo.
+
+    Retorna:
+        bool: False se a conversão deve parar (bloquear e há padrões acima do orçamento ou inválidos)
+    """
+    if tabela.empty:
+        return True
+    erros = tabela[tabela["severidade"] == "erro"]
+    avisos = tabela[tabela["severidade"] == "aviso"]
+    for _, linha in erros.iterrows():
+        motivo = "; ".join(parte for parte in [
+            linha["risco"],
+            f"{linha['custo_ms']} ms com {int(linha['tamanho_entrada'])} caracteres" if pd.notna(linha["custo_ms"]) else ""
+        ] if parte)
+        mensagem = f"regex() '{linha['padrao']}' (linhas {linha['linhas']}): {motivo}; orçamento {orcamento_ms} ms"
+        if bloquear:
+            st.error(mensagem)
+        else:
+            st.warning(mensagem)
+    for _, linha in avisos.iterrows():
+        st.warning(f"regex() '{linha['padrao']}' (linhas {linha['linhas']}): {linha['risco']}")
+    with st.expander(f"Custo dos regex() ({len(tabela)} padrões)"):
+        st.dataframe(tabela.sort_values("custo_ms", ascending=False), hide_index=True)
+    return not (bloquear and len(erros))
+
+def mostrar_cobertura_regras(relatorio, total_linhas):
+    """Mostra quantas variáveis cada regra apanhou, o tempo gasto e as regras sem efeito ou demasiado amplas."""
+    tabela = tabela_cobertura(relatorio, total_linhas)
+    if tabela.empty:
+        return
+    alertas = tabela[tabela["alerta"] != ""]
+    if len(alertas):
+        st.warning(f"Cobertura das regras: {len(alertas)} de {len(tabela)} regras sem correspondências ou demasiado amplas.")
+    with st.expander("Cobertura e custo das regras"):
+        st.dataframe(tabela.sort_values("segundos", ascending=False))
+    st.download_button(
+        label="Baixar cobertura das regras",
+        data=cobertura_para_excel(tabela),
+        file_name="cobertura_regras.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+def converter_no_servico(url, data_file, groups_file, padroes_file, opcoes, anexos=None, regras_campos_file=None,
+                         progresso=None):
+    """
+    Envia a conversão ao serviço local (servico_conversao.py) e espera pelo resultado,
+    mostrando as mensagens, tabelas e downloads que o serviço recolheu.
+
+    Retorna:
+        BytesIO: XLSForm ou ZIP, ou None se a conversão falhar
+    """
+    arquivos = {"dados": data_file.getvalue(), "grupos": groups_file.getvalue(), "padroes": padroes_file.getvalue()}
+    if regras_campos_file:
+        arquivos["regras_campos"] = regras_campos_file.getvalue()
+    try:
+        trabalho = enviar_conversao(url, arquivos, anexos, opcoes)
+        while trabalho["estado"] in ("na_fila", "a_converter"):
+            if progresso:
+                progresso("Serviço: na fila" if trabalho["estado"] == "na_fila" else "Serviço: a converter")
+            time.sleep(0.5)
+            trabalho = estado_conversao(url, trabalho["id"])
+    except FilaCheia as e:
+        st.warning(str(e))
+        return None
+    except (ValueError, OSError) as e:
+        st.error(f"Serviço de conversão indisponível ou pedido recusado: {e}")
+        return None
+
+    # Mensagens, tabelas e downloads (análise de desempenho, cobertura, regex, validação) feitos no serviço
+    ColetorMensagens.de_serializado(trabalho.get("chamadas") or []).reproduzir(st)
+    if trabalho["estado"] == "erro":
+        st.error(f"Erro na conversão: {trabalho['erro']}")
+        return None
+    if trabalho["em_cache"]:
+        st.write("Resultado reutilizado da cache do serviço.")
+    return BytesIO(baixar_resultado(url, trabalho["id"]))
+
 # Função para converter os dados do Excel para XLSForm
-def convert_to_xlsform(data_file, groups_file, padroes_file):
+def convert_to_xlsform(data_file, groups_file, padroes_file, deduplicar_choices=True, limite_csv_externo=None,
+                       subtotais_hierarquicos=False, max_termos_soma=None, elevar_relevants=True,
+                       limites_desempenho=None, max_perguntas_pagina=None, max_custo_pagina=None,
+                       dividir_por=None, max_processos=None, anexos=None, max_px_imagem=1024,
+                       tamanho_alvo_imagem_kb=200, limpar_labels_regras=False, renomear=None,
+                       regras_campos=None, progresso=None, abas=None, prefixos=None, bloquear_regex_caros=False,
+                       form_id="form_pat", form_title="Formulário PAT", prevalidacao=None):
+    # Construção parcial: só as abas e/ou os prefixos de nome pedidos (mais o que as regras referirem)
+    parcial = bool(abas or prefixos)
+
+    # Pré-validação rápida (cabeçalhos e coluna Nome em streaming) antes da conversão completa;
+    # quem já a fez (ex: multi_questionario) passa o resultado, para não ler o arquivo outra vez
+    if prevalidacao is None:
+        prevalidacao = prevalidar_planilhas(data_file, abas=abas)
+    for aviso in prevalidacao["avisos"]:
+        st.warning(aviso)
+    if prevalidacao["erros"]:
+        st.error(mensagem_erros(prevalidacao["erros"]))
+        st.stop()
+        return None
+    registar_etapa("prevalidacao", "Pré-validação: %d variáveis em %d abas verificadas em %s s.",
+                   sum(prevalidacao["nomes_por_aba"].values()), len(prevalidacao["nomes_por_aba"]), prevalidacao["segundos"],
+                   variaveis=sum(prevalidacao["nomes_por_aba"].values()), segundos=prevalidacao["segundos"])
+
     # Processar dados principais
     xls = pd.ExcelFile(data_file)
-    all_surveys = []
-    
-    for sheet_name in xls.sheet_names:
-        #st.write(f"Processando planilha: {sheet_name}")
-        df = pd.read_excel(data_file, sheet_name=sheet_name, header=None)
-        processed = process_sheet(df,sheet_name)
-        if processed is not None:
-            #st.write(f"Planilha {sheet_name} processada com sucesso.")
-            all_surveys.append(processed)
-    
+    lidas = {}  # aba -> survey da aba (None se a aba não tiver o formato esperado)
+
+    def ler_abas(nomes_abas):
+        for n, sheet_name in enumerate(nomes_abas):
+            _avancar(progresso, "Ler planilhas", sheet_name, n / len(nomes_abas))
+            #st.write(f"Processando planilha: {sheet_name}")
+            df = pd.read_excel(data_file, sheet_name=sheet_name, header=None)
+            processed = process_sheet(df,sheet_name)
+            if processed is not None:
+                processed = remove_line_breaks(processed)
+                # Validação dos nomes das variáveis
+                if not check_variable_names(processed):
+                    st.stop()  # Interrompe a execução
+                    return False
+            lidas[sheet_name] = processed
+        return True
+
+    if not ler_abas([aba for aba in xls.sheet_names if not abas or aba in abas]):
+        return None
+    all_surveys = [lidas[aba] for aba in xls.sheet_names if lidas.get(aba) is not None]
     if not all_surveys:
         return None
     
-    survey = pd.concat(all_surveys, ignore_index=True)
-    survey=remove_line_breaks(survey)
-    # Validação dos nomes das variáveis
-    if not check_variable_names(survey):
-        st.stop()  # Interrompe a execução
+    base = pd.concat(all_surveys, ignore_index=True)
     
     
-    st.write("Planilhas processadas com sucesso.")
+    registar_etapa("planilhas", "Planilhas processadas com sucesso: %d linhas lidas.", len(base), linhas=len(base))
     # Processar grupos
     groups_df = pd.read_excel(groups_file)
     groups_df['name'] = groups_df['name'].apply(remove_accents)
@@ -830,17 +1337,70 @@ def convert_to_xlsform(data_file, groups_file, padroes_file):
     
     
     
-    #survey=remover_grupos_vazios(survey)
-    survey = adicionar_calculos_automaticos(survey, padroes_file)
-    survey=adicionar_type_decimal(survey)
-    # Lista de variáveis para automação
-    survey = gerar_campos_automaticos(survey, ['DGE_SQE_B0_P0_id_questionario', 'DGE_SQE_B0_P1_codigo_escola','DGE_SQE_B0_P2_inicio_ano_lectivo', 'DGE_SQE_B0_P3_fim_ano_lectivo'])
-    survey=aplicar_regex(survey) 
-    survey=atualizar_df_com_selects(survey, "selects.xlsx")
-    survey=adicionar_geolocalizacao_da_escola(survey)
-    survey = add_groups(survey, groups_df)
-    survey=atualizar_df_com_relevant(survey, "relevante.xlsx")
-    survey = adicionar_campos_exibicao_totais(survey)
+    if regras_campos is None:
+        regras_campos = carregar_regras_campos()
+
+    if parcial:
+        selecionados = set(base["name"])
+        if prefixos:
+            selecionados = {nome for nome in selecionados if corresponde_prefixo(nome, prefixos)}
+        if not selecionados:
+            st.error(f"Nenhuma variável corresponde à construção parcial (abas: {abas or 'todas'}, prefixos: {prefixos or 'todos'}).")
+            st.stop()
+            return None
+
+    # Na construção parcial, as variáveis referidas pelas regras e que ficaram fora da
+    # seleção são acrescentadas e o survey é montado outra vez (poucas passagens, survey pequeno)
+    for passagem in range(MAX_PASSAGENS if parcial else 1):
+        if parcial:
+            survey = base[base["name"].isin(selecionados)].reset_index(drop=True)
+            grupos = recortar_grupos(groups_df, base["name"].tolist(), selecionados)
+        else:
+            survey, grupos = base, groups_df
+
+        _avancar(progresso, "Cálculos e regras")
+        # Cobertura e custo de cada regra (regex, selects, relevants, somatórios, regras de campos)
+        relatorio_regras = novo_relatorio()
+        survey = adicionar_calculos_automaticos(survey, padroes_file, subtotais_hierarquicos=subtotais_hierarquicos,
+                                                max_termos=max_termos_soma, relatorio=relatorio_regras)
+        # Tipos, campos automáticos e notas de regras_campos.yaml (ou do arquivo enviado)
+        survey = gerar_campos_automaticos(survey, regras_campos, relatorio=relatorio_regras,
+                                          avisar_em_falta=not parcial)
+        survey=aplicar_regex(survey, relatorio=relatorio_regras) 
+        survey=atualizar_df_com_selects(survey, "selects.xlsx", relatorio=relatorio_regras)
+        survey=adicionar_geolocalizacao_da_escola(survey)
+        _avancar(progresso, "Grupos e relevants")
+        survey = add_groups(survey, grupos)
+        survey, _ = remover_grupos_vazios(survey, "a criação dos grupos")
+        survey=atualizar_df_com_relevant(survey, "relevante.xlsx", relatorio=relatorio_regras)
+        if elevar_relevants:
+            survey, _ = elevar_relevants_para_grupos(survey)
+        _avancar(progresso, "Páginas e totais")
+        survey = dividir_grupos_field_list(survey, max_perguntas_pagina, max_custo_pagina)
+        survey = adicionar_campos_exibicao_totais(survey)
+        survey, _ = remover_grupos_vazios(survey, "a divisão das páginas e os totais")
+
+        if not parcial:
+            break
+        em_falta = referencias_em_falta(survey)
+        if em_falta - set(base["name"]) and len(lidas) < len(xls.sheet_names):
+            # Referências a variáveis de abas não selecionadas: ler as restantes abas
+            if not ler_abas([aba for aba in xls.sheet_names if aba not in lidas]):
+                return None
+            base = pd.concat([lidas[aba] for aba in xls.sheet_names if lidas.get(aba) is not None], ignore_index=True)
+        novos = (em_falta & set(base["name"])) - selecionados
+        if not novos:
+            if em_falta:
+                st.warning(f"Construção parcial: referências a variáveis inexistentes: {', '.join(sorted(em_falta))}")
+            break
+        registar_etapa("parcial", "Construção parcial: %d variáveis referidas pelas regras acrescentadas à seleção.",
+                       len(novos), acrescentadas=len(novos))
+        selecionados |= novos
+    else:
+        if parcial:
+            st.warning(f"Construção parcial: ainda há referências fora da seleção ao fim de {MAX_PASSAGENS} passagens.")
+    if parcial:
+        registar_etapa("parcial", "Construção parcial: %d linhas no survey (sem os metadados).", len(survey), linhas=len(survey))
     
     # Adicionar linhas padrão
     standard_rows = [
@@ -867,6 +1427,15 @@ def convert_to_xlsform(data_file, groups_file, padroes_file):
 
     # Concatenar com survey
     survey = pd.concat([standard_rows_df, survey], ignore_index=True)
+
+    # Renomeação em massa (nomes exatos ou prefixos 'QEA_*' -> 'QEE_*') com as referências ${}
+    if renomear:
+        try:
+            survey, alteradas = renomear_variaveis(survey, renomear)
+        except ValueError as e:
+            st.error(str(e))
+            st.stop()
+        registar_etapa("renomeacao", "Renomeação: %d células alteradas.", alteradas, alteradas=alteradas)
     
     
     # Criar abas adicionais
@@ -875,16 +1444,93 @@ def convert_to_xlsform(data_file, groups_file, padroes_file):
     #    choices = survey[["choices"]].dropna().drop_duplicates()
     #    choices = choices.assign(list_name=choices["choices"], name=choices["choices"], label=choices["choices"])
         
+    _avancar(progresso, "Choices")
     # Carregar o arquivo choiceGood.xlsx
     caminho_choices = "Choices.xlsx"
     # Ler a aba "choices" do arquivo
-    choices = pd.read_excel(caminho_choices, sheet_name="choices")
+    choices = ler_tabela_regras(caminho_choices, sheet_name="choices")
     # Verificar se o arquivo foi carregado corretamente
     if choices.empty:
         raise ValueError("A aba 'choices' do arquivo formWithChoiceGood.xlsx está vazia!")
+
+    # Limpeza de labels/hints com as regras de limpeza_labels.xlsx
+    if limpar_labels_regras:
+        survey, alteradas_survey = limpar_labels(survey)
+        choices, alteradas_choices = limpar_labels(choices)
+        registar_etapa("labels", "Labels corrigidos: %d células no survey, %d nas choices.", alteradas_survey,
+                       alteradas_choices, survey=alteradas_survey, choices=alteradas_choices)
+
+    if deduplicar_choices:
+        survey, choices, _ = deduplicar_listas_choices(survey, choices)
+
+    media = {}
+    if limite_csv_externo:
+        survey, choices, media = externalizar_listas_grandes(survey, choices, limite_csv_externo)
+
+    # regex() avaliados a cada tecla no dispositivo: padrões caros bloqueiam a conversão ou dão aviso
+    orcamento_regex = {**LIMITES_PADRAO, **(limites_desempenho or {})}["max_custo_regex_ms"]
+    if not mostrar_analise_regex(analisar_regex(survey, orcamento_regex), orcamento_regex, bloquear_regex_caros):
+        st.stop()
+        return None
+
+    _avancar(progresso, "Anexos")
+    # Anexos (coluna 'Anexo'): desduplicar, reduzir imagens e gerar as colunas media::*
+    survey, media_anexos, relatorio_media = processar_anexos(
+        survey, anexos, max_px=max_px_imagem, tamanho_alvo_kb=tamanho_alvo_imagem_kb, max_processos=max_processos
+    )
+    media.update(media_anexos)
+    if relatorio_media["referencias"]:
+        registar_etapa("anexos", "Anexos: %d referências, %d arquivos únicos (%d processados, %d em cache).",
+                       relatorio_media["referencias"], relatorio_media["arquivos_unicos"], relatorio_media["processados"],
+                       relatorio_media["em_cache"], referencias=relatorio_media["referencias"],
+                       processados=relatorio_media["processados"], em_cache=relatorio_media["em_cache"])
+    if relatorio_media["em_falta"]:
+        st.warning(f"Anexos não encontrados (enviar à parte para o servidor): {', '.join(sorted(relatorio_media['em_falta']))}")
+    if relatorio_media["invalidos"]:
+        st.warning(f"Anexos com extensão de imagem que não abrem como imagem (enviados sem reduzir): "
+                   f"{', '.join(sorted(relatorio_media['invalidos']))}")
+    if relatorio_media["nao_suportados"]:
+        st.warning(f"Anexos ignorados, não são imagem, áudio nem vídeo: {', '.join(sorted(relatorio_media['nao_suportados']))}")
+
+    _avancar(progresso, "Análise")
+    mostrar_analise_desempenho(analisar_desempenho(survey, choices, limites_desempenho))
+    mostrar_cobertura_regras(relatorio_regras, len(survey))
     
-    settings = pd.DataFrame({"form_title": ["Formulário PAT"], "form_id": ["form_pat"],"allow_choice_duplicates": ["yes"]})
-    
+    _avancar(progresso, "Gerar XLSForm")
+    settings = pd.DataFrame({"form_title": [form_title], "form_id": [form_id],"allow_choice_duplicates": ["yes"]})
+    if parcial:
+        # Outro form_id, para a versão parcial não substituir o formulário completo no servidor
+        settings["form_title"] = f"{form_title} (parcial)"
+        settings["form_id"] = f"{form_id}_parcial"
+
+    # Validação local do formulário (o que o servidor rejeitaria no envio)
+    mostrar_validacao(validar_xlsform(survey, choices, settings, media))
+
+    # Formulário dividido por bloco/grupo: uma parte por XLSForm, geradas em paralelo
+    if dividir_por:
+        try:
+            partes, validacoes = construir_formularios_divididos(
+                survey, choices, settings, dividir_por, CAMPOS_IDENTIFICACAO,
+                labels_identificacao={sufixo: regras_campos["sufixos"][sufixo].get("rotulo", sufixo)
+                                      for sufixo in CAMPOS_IDENTIFICACAO if sufixo in regras_campos["sufixos"]},
+                max_processos=max_processos, media=media
+            )
+        except ValueError as e:
+            st.error(str(e))
+            st.stop()
+            return None
+        # Cada parte é um formulário à parte no servidor: só se mostram as partes com problemas
+        for nome_arquivo, validacao in validacoes.items():
+            if validacao["erros"] or validacao["avisos"]:
+                mostrar_validacao(validacao, titulo=nome_arquivo)
+        registar_etapa("dividir", "Formulário dividido em %d partes (%s).", len(partes) - 1, dividir_por, partes=len(partes) - 1)
+        return empacotar_arquivos({**partes, **media})
+
+    # A versão só muda quando muda o conteúdo, para os dispositivos não descarregarem o mesmo formulário
+    settings["version"] = versao_por_conteudo(survey, choices, settings, media)
+    registar_etapa("gerar", "Versão do formulário: %s", settings.at[0, "version"], versao=settings.at[0, "version"],
+                   linhas_survey=len(survey), linhas_choices=len(choices))
+
     output = BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
         survey.to_excel(writer, sheet_name='survey', index=False)
@@ -892,22 +1538,359 @@ def convert_to_xlsform(data_file, groups_file, padroes_file):
         settings.to_excel(writer, sheet_name='settings', index=False)
     
     output.seek(0)
+
+    # Com arquivos de media o resultado é um ZIP com o formulário e os CSVs lado a lado
+    if media:
+        return empacotar_arquivos({"formulario.xlsx": output.getvalue(), **media})
     return output
 
 
-os.system("cls")
-# Interface Streamlit
-st.title("Conversor de Excel para XLSForm")
-data_file = st.file_uploader("Arquivo principal com os dados", type=["xlsx"])
-groups_file = st.file_uploader("Arquivo com a definição dos grupos", type=["xlsx"])
-padroes_file = st.file_uploader("Arquivo com a definição dos somatorios", type=["xlsx"])
+def main():
+    """Interface Streamlit (streamlit run conversor.py)."""
+    os.system("cls")
+    # Interface Streamlit
+    st.title("Conversor de Excel para XLSForm")
+    data_file = st.file_uploader("Arquivo principal com os dados", type=["xlsx"])
+    groups_file = st.file_uploader("Arquivo com a definição dos grupos", type=["xlsx"])
+    padroes_file = st.file_uploader("Arquivo com a definição dos somatorios", type=["xlsx"])
+    anexos_files = st.file_uploader("Anexos referidos na coluna 'Anexo' (opcional)", accept_multiple_files=True)
+    regras_campos_file = st.file_uploader("Regras de campos automáticos em YAML (opcional, por omissão regras_campos.yaml)",
+                                          type=["yaml", "yml"])
+    renomear_file = st.file_uploader("Arquivo de renomeação de variáveis, colunas antigo/novo (opcional)", type=["xlsx"])
+    referencia_file = st.file_uploader(
+        "Formulário publicado, para comparar com o gerado (opcional; por omissão o último marcado como publicado)",
+        type=["xlsx", "zip"]
+    )
+    deduplicar_choices = st.checkbox("Unir listas de choices idênticas", value=True)
+    limite_csv_externo = st.number_input(
+        "Mover para CSV externo listas filtradas com mais de N linhas (0 = desativado)",
+        min_value=0, value=0, step=100
+    )
+    subtotais_hierarquicos = st.checkbox("Reutilizar subtotais nas somas automáticas", value=False)
+    max_termos_soma = st.number_input(
+        f"Partir somas com mais de N termos em cálculos intermédios (0 = desativado, senão >= {MIN_TERMOS_SOMA})",
+        min_value=0, value=0, step=10
+    )
+    if max_termos_soma == 1:
+        st.error(f"O número de termos por soma deve ser 0 (desativado) ou pelo menos {MIN_TERMOS_SOMA}.")
+    elevar_relevants = st.checkbox("Elevar relevants repetidos para o grupo", value=True)
+    limpar_labels_regras = st.checkbox("Limpar labels com as regras de limpeza_labels.xlsx", value=False)
+    bloquear_regex_caros = st.checkbox(
+        "Bloquear a conversão se algum regex() passar o orçamento de tempo (max_custo_regex_ms)", value=False
+    )
+    max_perguntas_pagina = st.number_input(
+        "Dividir grupos field-list com mais de N perguntas em páginas (0 = desativado)",
+        min_value=0, value=0, step=5
+    )
+    max_custo_pagina = st.number_input(
+        "Dividir grupos field-list com custo de expressões acima de N (0 = desativado)",
+        min_value=0, value=0, step=10
+    )
+    dividir_por = st.selectbox(
+        "Dividir o questionário em formulários separados",
+        options=[None, "bloco", "grupo"],
+        format_func=lambda opcao: "Não dividir" if opcao is None else f"Por {opcao}"
+    )
+    with st.expander("Construção parcial (só algumas abas ou blocos, para testar mais depressa)"):
+        nomes_abas = []
+        if data_file:
+            nomes_abas = pd.ExcelFile(data_file).sheet_names
+            data_file.seek(0)
+        abas_parciais = st.multiselect("Abas a converter (vazio = todas)", options=nomes_abas)
+        prefixos_parciais = st.text_input("Prefixos de nome, separados por vírgula (ex: DGE_SQE_B4)")
+    with st.expander("Limites da análise de desempenho"):
+        limites_desempenho = {
+            chave: st.number_input(chave, min_value=1, value=valor)
+            for chave, valor in LIMITES_PADRAO.items()
+        }
+
+    if data_file and groups_file and padroes_file and max_termos_soma != 1:
+        opcoes = dict(
+            deduplicar_choices=deduplicar_choices,
+            limite_csv_externo=limite_csv_externo or None,
+            subtotais_hierarquicos=subtotais_hierarquicos,
+            max_termos_soma=max_termos_soma or None,
+            elevar_relevants=elevar_relevants,
+            limites_desempenho=limites_desempenho,
+            max_perguntas_pagina=max_perguntas_pagina or None,
+            max_custo_pagina=max_custo_pagina or None,
+            dividir_por=dividir_por,
+            limpar_labels_regras=limpar_labels_regras,
+            bloquear_regex_caros=bloquear_regex_caros,
+            renomear=ler_regras_renomeacao(renomear_file) if renomear_file else None,
+            abas=abas_parciais or None,
+            prefixos=ler_prefixos(prefixos_parciais) or None
+        )
+        anexos = {f.name: f.getvalue() for f in anexos_files or []}
+        url_servico = os.environ.get("CONVERSOR_SERVICO")
+
+        # A conversão corre em segundo plano e fica na sessão: um rerun com as mesmas
+        # entradas mostra a mesma tarefa em vez de a recomeçar
+        entradas = [f.getvalue() for f in (data_file, groups_file, padroes_file, regras_campos_file) if f]
+        entradas += [nome.encode("utf-8") + conteudo for nome, conteudo in sorted(anexos.items())]
+        entradas.append(repr((sorted(opcoes.items()), url_servico)).encode("utf-8"))
+        assinatura = hashlib.sha256(b"\0".join(entradas)).hexdigest()
+
+        tarefa = st.session_state.get("tarefa_conversao")
+        if tarefa is None or tarefa.assinatura != assinatura:
+            if tarefa is not None:
+                tarefa.cancelar()
+            tarefa = iniciar_conversao(assinatura, url_servico, data_file, groups_file, padroes_file, opcoes,
+                                       anexos, regras_campos_file)
+            st.session_state["tarefa_conversao"] = tarefa
+        mostrar_tarefa(tarefa, referencia_file.getvalue() if referencia_file else None)
+
+
+def iniciar_conversao(assinatura, url_servico, data_file, groups_file, padroes_file, opcoes, anexos,
+                      regras_campos_file):
+    """Lança a conversão (local ou no serviço) numa TarefaConversao em segundo plano."""
+    # Cópias em memória: os arquivos enviados não são partilhados com a thread da tarefa
+    arquivos = [BytesIO(f.getvalue()) for f in (data_file, groups_file, padroes_file)]
+    if url_servico:
+        return TarefaConversao(converter_no_servico, url_servico, *arquivos, opcoes, anexos=anexos,
+                               regras_campos_file=regras_campos_file, assinatura=assinatura)
+
+    regras_campos = None
+    if regras_campos_file:
+        try:
+            regras_campos = compilar_regras_campos(yaml.safe_load(regras_campos_file.getvalue()), regras_campos_file.name)
+        except (ValueError, yaml.YAMLError) as e:
+            st.error(str(e))
+            st.stop()
+    return TarefaConversao(convert_to_xlsform, *arquivos, anexos=anexos, regras_campos=regras_campos,
+                           assinatura=assinatura, **opcoes)
+
+
+def mostrar_tarefa(tarefa, referencia=None):
+    """
+    Progresso, mensagens e resultado da conversão em segundo plano.
 
-if data_file and groups_file and padroes_file:
-    converted = convert_to_xlsform(data_file, groups_file, padroes_file)
-    if converted:
+    referencia (bytes): formulário publicado (XLSForm ou ZIP) para a comparação
+    """
+    if tarefa.a_correr:
+        st.progress(tarefa.fracao, text=f"{tarefa.etapa} — {tarefa.segundos:.0f} s")
+        if st.button("Cancelar conversão"):
+            tarefa.cancelar()
+        tarefa.coletor.reproduzir(st)
+        time.sleep(0.5)
+        st.rerun()
+
+    tarefa.coletor.reproduzir(st)
+    if tarefa.estado == "cancelada":
+        st.warning(f"Conversão cancelada ao fim de {tarefa.segundos:.0f} s.")
+    elif tarefa.estado == "erro":
+        st.error(f"Erro na conversão: {tarefa.erro}")
+    if tarefa.estado != "concluida":
+        if st.button("Converter novamente"):
+            del st.session_state["tarefa_conversao"]
+            st.rerun()
+        return
+
+    st.write(f"Conversão concluída em {tarefa.segundos:.1f} s.")
+    if e_pacote(tarefa.resultado):
+        st.download_button(
+            label="Baixar XLSForm (ZIP)",
+            data=tarefa.resultado,
+            file_name="formulario.zip",
+            mime="application/zip"
+        )
+    else:
         st.download_button(
             label="Baixar XLSForm",
-            data=converted,
+            data=tarefa.resultado,
             file_name="formulario.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
\ No newline at end of file
+        )
+    mostrar_diferencas(tarefa, referencia)
+    mostrar_pre_visualizacao(tarefa)
+
+def mostrar_diferencas(tarefa, referencia=None):
+    """
+    Compara o formulário gerado com o publicado e mostra as linhas adicionadas,
+    removidas, movidas e alteradas.
+
+    A referência de cada formulário é, pelo form_id, a do arquivo 'referencia'
+    enviado pelo utilizador ou, sem ele, o último build marcado como publicado
+    (guardado em PASTA_BUILDS, partilhado entre sessões e recarregamentos).
+    """
+    estado = st.session_state
+    if estado.get("diferencas_assinatura") != tarefa.assinatura:
+        estado["diferencas_form_ids"] = {nome_arquivo: form_id_de(dados)
+                                         for nome_arquivo, dados in surveys_do_resultado(tarefa.resultado).items()}
+        estado["diferencas_assinatura"] = tarefa.assinatura
+    form_ids = estado["diferencas_form_ids"]
+
+    if st.button("Marcar como publicado (referência das próximas comparações)"):
+        for nome_arquivo, dados in surveys_do_resultado(tarefa.resultado).items():
+            marcar_publicado(dados, form_ids[nome_arquivo])
+        st.success(f"Marcado como publicado: {', '.join(sorted(set(form_ids.values())))}.")
+
+    enviados = {}
+    if referencia:
+        assinatura_referencia = hashlib.sha256(referencia).hexdigest()
+        if estado.get("diferencas_referencia", (None, {}))[0] != assinatura_referencia:
+            estado["diferencas_referencia"] = (assinatura_referencia, {
+                form_id_de(dados): dados for dados in surveys_do_resultado(referencia).values()})
+        enviados = estado["diferencas_referencia"][1]
+    referencias = {nome_arquivo: enviados.get(form_id) or build_publicado(form_id)
+                   for nome_arquivo, form_id in form_ids.items()}
+    # As diferenças só são recalculadas quando muda o formulário gerado ou a referência
+    chave = hashlib.sha256(tarefa.assinatura.encode("utf-8") + b"\0".join(
+        hashlib.sha256(dados).digest() if dados else b"" for dados in referencias.values())).hexdigest()
+    if estado.get("diferencas_chave") != chave:
+        gerados = surveys_do_resultado(tarefa.resultado)
+        estado["diferencas"] = {nome_arquivo: comparar_formularios(anterior, gerados[nome_arquivo])
+                                for nome_arquivo, anterior in referencias.items() if anterior is not None}
+        estado["diferencas_chave"] = chave
+
+    diferencas = st.session_state["diferencas"]
+    if not diferencas:
+        return
+    with st.expander("Diferenças para o formulário publicado"):
+        for nome_arquivo, tabela in diferencas.items():
+            if tabela.empty:
+                st.write(f"{nome_arquivo}: sem diferenças.")
+                continue
+            st.write(f"{nome_arquivo}:")
+            st.dataframe(resumo_diferencas(tabela), hide_index=True)
+            st.dataframe(tabela, hide_index=True)
+            st.download_button(
+                label=f"Baixar diferenças ({nome_arquivo})",
+                data=diferencas_para_excel(tabela),
+                file_name=f"diferencas_{nome_arquivo}",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+
+# Linhas mostradas por página na pré-visualização e referências com botão por linha
+LINHAS_POR_PAGINA = 100
+MAX_REFERENCIAS_LINHA = 4
+
+def _ir_para_linha(indice, pos):
+    """Expande os grupos que contêm a linha, limpa a procura e abre a página onde ela fica."""
+    estado = st.session_state
+    estado["pv_recolhidos"] = estado.get("pv_recolhidos", set()) - set(antepassados(indice, pos))
+    estado["pv_procura"] = ""
+    estado["pv_destaque"] = pos
+    visiveis = linhas_visiveis(indice, estado["pv_recolhidos"])
+    estado["pv_pagina"] = visiveis.index(pos) // LINHAS_POR_PAGINA + 1
+
+def _alternar_grupo(pos):
+    recolhidos = set(st.session_state.get("pv_recolhidos", set()))
+    recolhidos.symmetric_difference_update({pos})
+    st.session_state["pv_recolhidos"] = recolhidos
+
+def mostrar_pre_visualizacao(tarefa):
+    """
+    Pré-visualização do survey gerado: grupos que se recolhem, procura por nome,
+    label e expressões, e as referências ${...} levam à linha onde a variável é definida.
+
+    Só a página atual é desenhada, para que formulários com dezenas de milhares
+    de linhas continuem rápidos; o índice é calculado uma vez por resultado.
+    """
+    surveys = surveys_do_resultado(tarefa.resultado)
+    if not surveys:
+        return
+    with st.expander("Pré-visualização do formulário"):
+        arquivo = next(iter(surveys))
+        if len(surveys) > 1:
+            arquivo = st.selectbox("Formulário", list(surveys), key="pv_arquivo")
+
+        chave = (tarefa.assinatura, arquivo)
+        if st.session_state.get("pv_chave") != chave:
+            survey = pd.read_excel(BytesIO(surveys[arquivo]), sheet_name="survey")
+            st.session_state["pv_indice"] = indexar_survey(survey)
+            st.session_state["pv_chave"] = chave
+            st.session_state["pv_recolhidos"] = set()
+            st.session_state["pv_pagina"] = 1
+            st.session_state.pop("pv_destaque", None)
+        indice = st.session_state["pv_indice"]
+        linhas = indice["linhas"]
+
+        consulta = st.text_input("Procurar (nome, label ou expressão)", key="pv_procura")
+        if consulta.strip():
+            posicoes = procurar(indice, consulta)
+            st.write(f"{len(posicoes)} linhas encontradas.")
+        else:
+            col1, col2 = st.columns(2)
+            if col1.button("Recolher todos os grupos"):
+                st.session_state["pv_recolhidos"] = set(indice["fim_grupo"])
+                st.session_state["pv_pagina"] = 1
+            if col2.button("Expandir todos os grupos"):
+                st.session_state["pv_recolhidos"] = set()
+            posicoes = linhas_visiveis(indice, st.session_state.get("pv_recolhidos", set()))
+        if not posicoes:
+            return
+
+        paginas = (len(posicoes) - 1) // LINHAS_POR_PAGINA + 1
+        if st.session_state.get("pv_pagina", 1) > paginas:
+            st.session_state["pv_pagina"] = paginas
+        pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, step=1, key="pv_pagina")
+        inicio = (pagina - 1) * LINHAS_POR_PAGINA
+
+        recolhidos = st.session_state.get("pv_recolhidos", set())
+        destaque = st.session_state.get("pv_destaque")
+        for pos in posicoes[inicio:inicio + LINHAS_POR_PAGINA]:
+            linha = linhas[pos]
+            col_linha, col_acoes = st.columns([3, 2])
+            recuo = "\u2003" * linha["nivel"]
+            texto = f"{recuo}`{pos + 2}` **{linha['tipo']}** {linha['nome']}"
+            if linha["label"]:
+                texto += f" — {linha['label'][:80]}"
+            if pos == destaque:
+                texto = f":orange-background[{texto}]"
+            col_linha.markdown(texto)
+            if linha["expressoes"]:
+                col_linha.caption(" · ".join(f"{c}: {e}" for c, e in linha["expressoes"].items()))
+
+            if pos in indice["fim_grupo"]:
+                rotulo = "Expandir" if pos in recolhidos else "Recolher"
+                col_acoes.button(rotulo, key=f"pv_grupo_{pos}", on_click=_alternar_grupo, args=(pos,))
+            for ref in linha["referencias"][:MAX_REFERENCIAS_LINHA]:
+                destino = indice["definicoes"].get(ref)
+                col_acoes.button(f"${{{ref}}}", key=f"pv_ref_{pos}_{ref}", disabled=destino is None,
+                                 on_click=_ir_para_linha, args=(indice, destino))
+
+def cli():
+    """Conversão pela linha de comandos (a interface é: streamlit run conversor.py)."""
+    parser = argparse.ArgumentParser(description="Conversor de Excel para XLSForm")
+    parser.add_argument("dados", help="Arquivo principal com os dados")
+    parser.add_argument("grupos", help="Arquivo com a definição dos grupos")
+    parser.add_argument("padroes", help="Arquivo com a definição dos somatorios")
+    parser.add_argument("--saida", help="Arquivo de saída (por omissão formulario.xlsx ou formulario.zip)")
+    parser.add_argument("--abas", nargs="+", help="Construção parcial: só estas abas")
+    parser.add_argument("--prefixos", nargs="+", help="Construção parcial: só nomes com estes prefixos (ex: DGE_SQE_B4)")
+    parser.add_argument("--dividir-por", choices=["bloco", "grupo"], help="Dividir em formulários separados")
+    parser.add_argument("--bloquear-regex-caros", action="store_true",
+                        help="Falhar se algum regex() passar o orçamento de tempo (max_custo_regex_ms)")
+    parser.add_argument("--log-nivel", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Nível de registo (por omissão INFO)")
+    parser.add_argument("--log-jsonl", help="Gravar também o registo estruturado neste arquivo JSONL")
+    args = parser.parse_args()
+    configurar_registo(st, nivel=args.log_nivel, arquivo_jsonl=args.log_jsonl)
+
+    coletor = ColetorMensagens()
+    resultado = None
+    try:
+        with coletar_mensagens(coletor):
+            resultado = convert_to_xlsform(args.dados, args.grupos, args.padroes, dividir_por=args.dividir_por,
+                                           bloquear_regex_caros=args.bloquear_regex_caros,
+                                           abas=args.abas, prefixos=ler_prefixos(",".join(args.prefixos or [])) or None)
+    except ConversaoInterrompida:
+        pass
+    finally:
+        for nivel, texto in coletor.mensagens():
+            print(f"{nivel.upper()}: {texto}" if nivel in ("warning", "error") else texto)
+    if resultado is None:
+        sys.exit(1)
+
+    saida = args.saida or ("formulario.zip" if e_pacote(resultado.getvalue()) else "formulario.xlsx")
+    with open(saida, "wb") as f:
+        f.write(resultado.getvalue())
+    print(f"XLSForm gravado em {saida}")
+
+
+if __name__ == "__main__":
+    # 'streamlit run conversor.py' abre a interface; 'python conversor.py ...' usa a linha de comandos
+    if runtime.exists():
+        main()
+    else:
+        cli()
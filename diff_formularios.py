@@ -0,0 +1,244 @@
+import argparse
+import os
+import re
+import sys
+from bisect import bisect_left
+from io import BytesIO
+
+import pandas as pd
+
+from versao_formulario import valor_canonico
+
+ABAS_COMPARADAS = ["survey", "choices", "settings"]
+COLUNAS_DIFERENCAS = ["aba", "chave", "mudanca", "linha_antes", "linha_depois", "coluna", "antes", "depois"]
+# Referência das comparações na interface: o último formulário marcado como
+# publicado para cada form_id (PASTA_BUILDS/<form_id>.xlsx)
+PASTA_BUILDS = ".cache_builds"
+
+
+def ler_formulario(arquivo):
+    """
+    Lê as abas survey, choices e settings de um XLSForm.
+
+    Parâmetros:
+        arquivo: caminho, bytes ou arquivo aberto (.xlsx)
+
+    Retorna:
+        dict: {aba: pd.DataFrame} (só as abas que existem)
+    """
+    if isinstance(arquivo, bytes):
+        arquivo = BytesIO(arquivo)
+    with pd.ExcelFile(arquivo) as livro:
+        return {aba: livro.parse(aba, dtype=object) for aba in ABAS_COMPARADAS if aba in livro.sheet_names}
+
+
+def _celula(valor):
+    """Valor canónico da célula; booleanos e 'True'/'FALSE' contam como 'true'/'false' do XLSForm."""
+    if isinstance(valor, bool):
+        return "true" if valor else "false"
+    texto = valor_canonico(valor)
+    return texto.lower() if texto.lower() in ("true", "false") else texto
+
+
+def _chaves(aba, df):
+    """
+    Chave e grupo pai de cada linha.
+
+    survey: o name, e para begin/end o tipo e o caminho do grupo (ex: 'end_group grupo_b0/grupo_b1');
+    choices: list_name e name; settings: a única linha. Chaves repetidas levam '#n'.
+    """
+    tipos = df["type"].map(valor_canonico).tolist() if "type" in df.columns else [""] * len(df)
+    nomes = df["name"].map(valor_canonico).tolist() if "name" in df.columns else [""] * len(df)
+    listas = df["list_name"].map(valor_canonico).tolist() if "list_name" in df.columns else [""] * len(df)
+
+    chaves, pais, vistas = [], [], {}
+    pilha = []
+    for pos in range(len(df)):
+        tipo, nome = tipos[pos], nomes[pos]
+        pai = "/".join(pilha)
+        if aba == "settings":
+            chave = "settings"
+        elif aba == "choices":
+            chave = f"{listas[pos]}:{nome}"
+        elif tipo.startswith("begin_"):
+            pilha.append(nome)
+            chave = f"{tipo} {'/'.join(pilha)}"
+        elif tipo.startswith("end_"):
+            chave = f"{tipo} {pai}"
+            if pilha:
+                pilha.pop()
+            pai = "/".join(pilha)
+        else:
+            chave = nome or f"{tipo}:"
+        if chave in vistas:
+            vistas[chave] += 1
+            chave = f"{chave}#{vistas[chave]}"
+        else:
+            vistas[chave] = 1
+        chaves.append(chave)
+        pais.append(pai)
+    return chaves, pais
+
+
+def _fixas(sequencia):
+    """Posições que fazem parte da maior subsequência crescente (as restantes mudaram de ordem)."""
+    finais, indices, anterior = [], [], [None] * len(sequencia)
+    for i, valor in enumerate(sequencia):
+        j = bisect_left(finais, valor)
+        if j == len(finais):
+            finais.append(valor)
+            indices.append(i)
+        else:
+            finais[j] = valor
+            indices[j] = i
+        anterior[i] = indices[j - 1] if j else None
+    fixas = set()
+    i = indices[-1] if indices else None
+    while i is not None:
+        fixas.add(i)
+        i = anterior[i]
+    return fixas
+
+
+def comparar_aba(aba, antes, depois):
+    """
+    Compara uma aba de dois XLSForms.
+
+    Cada linha é identificada pela chave (ver _chaves) e resumida num hash das
+    suas células; só as linhas com hashes diferentes são comparadas coluna a coluna.
+    Uma linha conta como movida se mudou de grupo ou saiu da ordem relativa das restantes.
+
+    Retorna:
+        list: diferenças, como dicts com as colunas de COLUNAS_DIFERENCAS
+    """
+    colunas = list(dict.fromkeys([str(c) for c in antes.columns] + [str(c) for c in depois.columns]))
+    linhas = {}
+    for lado, df in (("antes", antes), ("depois", depois)):
+        df = df.rename(columns=str).reindex(columns=colunas)
+        chaves, pais = _chaves(aba, df)
+        valores = [tuple(_celula(v) for v in linha) for linha in df.itertuples(index=False, name=None)]
+        linhas[lado] = {chave: (pos, pais[pos], hash(valores[pos]), valores[pos]) for pos, chave in enumerate(chaves)}
+
+    antes_, depois_ = linhas["antes"], linhas["depois"]
+    diferencas = []
+    for chave, (pos, _, _, _) in antes_.items():
+        if chave not in depois_:
+            diferencas.append({"aba": aba, "chave": chave, "mudanca": "removida", "linha_antes": pos + 2})
+
+    comuns = [chave for chave in depois_ if chave in antes_]
+    fixas = _fixas([antes_[chave][0] for chave in comuns])
+    for chave, (pos, pai, hash_, valores) in depois_.items():
+        if chave not in antes_:
+            diferencas.append({"aba": aba, "chave": chave, "mudanca": "adicionada", "linha_depois": pos + 2})
+    for i, chave in enumerate(comuns):
+        pos_antes, pai_antes, hash_antes, valores_antes = antes_[chave]
+        pos, pai, hash_, valores = depois_[chave]
+        base = {"aba": aba, "chave": chave, "linha_antes": pos_antes + 2, "linha_depois": pos + 2}
+        if pai != pai_antes:
+            diferencas.append({**base, "mudanca": "movida", "coluna": "grupo", "antes": pai_antes, "depois": pai})
+        elif i not in fixas:
+            diferencas.append({**base, "mudanca": "movida"})
+        if hash_ != hash_antes:
+            for coluna, valor_antes, valor in zip(colunas, valores_antes, valores):
+                if valor != valor_antes:
+                    diferencas.append({**base, "mudanca": "alterada", "coluna": coluna,
+                                       "antes": valor_antes, "depois": valor})
+    return diferencas
+
+
+def comparar_formularios(antes, depois):
+    """
+    Diferenças estruturais entre dois XLSForms (survey, choices e settings).
+
+    Parâmetros:
+        antes, depois: caminhos, bytes ou arquivos abertos (.xlsx)
+
+    Retorna:
+        pd.DataFrame: uma linha por linha adicionada, removida ou movida e por
+        célula alterada, com as linhas do Excel de cada lado
+    """
+    livro_antes, livro_depois = ler_formulario(antes), ler_formulario(depois)
+    diferencas = []
+    for aba in ABAS_COMPARADAS:
+        vazio = pd.DataFrame()
+        if aba in livro_antes or aba in livro_depois:
+            diferencas += comparar_aba(aba, livro_antes.get(aba, vazio), livro_depois.get(aba, vazio))
+    tabela = pd.DataFrame(diferencas, columns=COLUNAS_DIFERENCAS)
+    return tabela.astype({"linha_antes": "Int64", "linha_depois": "Int64"})
+
+
+def resumo_diferencas(tabela):
+    """Número de linhas adicionadas, removidas, movidas e alteradas por aba."""
+    resumo = tabela.drop_duplicates(["aba", "chave", "mudanca"]).groupby(["aba", "mudanca"]).size()
+    return resumo.unstack(fill_value=0).reset_index()
+
+
+def diferencas_para_excel(tabela):
+    """Escreve as diferenças num xlsx com uma aba de detalhe e outra de resumo."""
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        tabela.to_excel(writer, sheet_name="diferencas", index=False)
+        resumo_diferencas(tabela).to_excel(writer, sheet_name="resumo", index=False)
+    output.seek(0)
+    return output
+
+
+def form_id_de(dados):
+    """form_id da aba settings de um XLSForm (vazio se não houver)."""
+    settings = ler_formulario(dados).get("settings")
+    if settings is None or settings.empty or "form_id" not in settings.columns:
+        return ""
+    return valor_canonico(settings["form_id"].iloc[0])
+
+
+def _parte_caminho(texto):
+    return re.sub(r"[^A-Za-z0-9_.\-]", "_", texto).strip(".") or "_"
+
+
+def caminho_build(form_id, pasta=PASTA_BUILDS):
+    """Caminho do formulário publicado de um form_id."""
+    return os.path.join(pasta, f"{_parte_caminho(form_id)}.xlsx")
+
+
+def build_publicado(form_id, pasta=PASTA_BUILDS):
+    """Conteúdo do último formulário marcado como publicado com este form_id, ou None."""
+    caminho = caminho_build(form_id, pasta)
+    if not os.path.exists(caminho):
+        return None
+    with open(caminho, "rb") as f:
+        return f.read()
+
+
+def marcar_publicado(dados, form_id, pasta=PASTA_BUILDS):
+    """
+    Guarda o formulário como o publicado do seu form_id, a referência das
+    comparações seguintes (em qualquer sessão, até ser marcado outro).
+    """
+    caminho = caminho_build(form_id, pasta)
+    os.makedirs(pasta, exist_ok=True)
+    # Escrever ao lado e trocar, para uma comparação em curso nunca ler meio arquivo
+    temporario = f"{caminho}.{os.getpid()}.tmp"
+    with open(temporario, "wb") as f:
+        f.write(dados)
+    os.replace(temporario, caminho)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Diferenças entre dois XLSForms")
+    parser.add_argument("antes", help="XLSForm anterior")
+    parser.add_argument("depois", help="XLSForm novo")
+    parser.add_argument("--saida", help="Gravar as diferenças num xlsx")
+    args = parser.parse_args()
+
+    tabela = comparar_formularios(args.antes, args.depois)
+    if tabela.empty:
+        print("Sem diferenças.")
+        sys.exit(0)
+    print(resumo_diferencas(tabela).to_string(index=False))
+    print()
+    print(tabela.astype(object).fillna("").to_string(index=False, max_colwidth=60))
+    if args.saida:
+        with open(args.saida, "wb") as f:
+            f.write(diferencas_para_excel(tabela).getvalue())
+        print(f"Diferenças gravadas em {args.saida}")
+    sys.exit(1)
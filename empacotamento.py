@@ -0,0 +1,26 @@
+import zipfile
+from io import BytesIO
+
+
+def empacotar_arquivos(arquivos):
+    """
+    Junta os arquivos gerados (XLSForms, media, manifesto) num ZIP,
+    com os arquivos de media ao lado dos formulários.
+    """
+    pacote = BytesIO()
+    with zipfile.ZipFile(pacote, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nome_arquivo, conteudo in arquivos.items():
+            zf.writestr(nome_arquivo, conteudo)
+    pacote.seek(0)
+    return pacote
+
+
+def e_pacote(dados):
+    """
+    Indica se o resultado da conversão é um pacote ZIP (formulário com media ou
+    formulários divididos) e não um só .xlsx — que também é um ZIP por dentro.
+    """
+    if not zipfile.is_zipfile(BytesIO(dados)):
+        return False
+    with zipfile.ZipFile(BytesIO(dados)) as pacote:
+        return "[Content_Types].xml" not in pacote.namelist()
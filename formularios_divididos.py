@@ -0,0 +1,297 @@
+import json
+import re
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import pandas as pd
+
+from validacao_xlsform import COLUNAS_COM_REFERENCIAS, validar_xlsform
+from versao_formulario import versao_por_conteudo
+
+# Linhas de metadados do XLSForm que vão para todas as partes
+TIPOS_METADADOS = {"start", "end", "start-geopoint", "today", "username", "deviceid", "phonenumber", "audit"}
+
+PADRAO_REFERENCIA = re.compile(r"\$\{([^}]+)\}")
+# Tipos que não guardam um valor e por isso não podem ser copiados para outra parte
+TIPOS_SEM_VALOR = {"note", "begin_group", "end_group", "begin_repeat", "end_repeat"}
+
+# Bloco no nome da variável, ex: QEA_DGE_SQE_B4_P5_total -> B4
+PADRAO_BLOCO = re.compile(r"_(B\d+)_P\d+")
+
+
+def _texto(valor):
+    if pd.isna(valor):
+        return ""
+    return str(valor).strip()
+
+
+def _unidades_topo(survey):
+    """
+    Divide o survey em unidades de topo: um grupo de topo completo
+    (begin_group..end_group) ou uma linha solta.
+
+    Retorna:
+        list: [(inicio, fim)] com posições inclusivas
+    """
+    unidades = []
+    profundidade = 0
+    inicio = None
+    for pos, tipo in enumerate(survey["type"].map(_texto)):
+        if tipo == "begin_group":
+            if profundidade == 0:
+                inicio = pos
+            profundidade += 1
+        elif tipo == "end_group" and profundidade > 0:
+            profundidade -= 1
+            if profundidade == 0:
+                unidades.append((inicio, pos))
+        elif profundidade == 0:
+            unidades.append((pos, pos))
+    if profundidade > 0:
+        # Grupo sem end_group: o resto do formulário fica numa só unidade
+        unidades.append((inicio, len(survey) - 1))
+    return unidades
+
+
+def particionar_survey(survey, modo="bloco"):
+    """
+    Atribui cada linha do survey a uma partição, sem partir grupos.
+
+    modo="bloco": pelo bloco B0..Bn do nome (DGE_SQE_B*_P*) da primeira variável
+    de cada unidade de topo; unidades sem bloco ficam com o bloco anterior.
+    modo="grupo": cada grupo de topo é uma partição; linhas soltas ficam com o
+    grupo anterior.
+
+    Retorna:
+        dict: {particao: lista de posições}, pela ordem em que aparecem
+    """
+    survey = survey.reset_index(drop=True)
+    tipos = survey["type"].map(_texto)
+    nomes = survey["name"].map(_texto)
+
+    particoes = {}
+    atual = None
+    pendentes = []  # unidades antes da primeira partição conhecida
+    for inicio, fim in _unidades_topo(survey):
+        posicoes = [p for p in range(inicio, fim + 1) if tipos[p] not in TIPOS_METADADOS]
+        if not posicoes:
+            continue
+        if modo == "grupo":
+            chave = nomes[inicio] if tipos[inicio] == "begin_group" else None
+        else:
+            blocos = (PADRAO_BLOCO.search(nomes[p]) for p in posicoes)
+            chave = next((m.group(1) for m in blocos if m), None)
+
+        if chave is None:
+            chave = atual
+        if chave is None:
+            pendentes.extend(posicoes)
+            continue
+        if atual is None and pendentes:
+            particoes.setdefault(chave, []).extend(pendentes)
+            pendentes = []
+        atual = chave
+        particoes.setdefault(chave, []).extend(posicoes)
+
+    if pendentes:
+        particoes.setdefault("geral", []).extend(pendentes)
+    return particoes
+
+
+def _linhas_identificacao(survey, campos_identificacao, labels_identificacao):
+    """
+    Linhas dos campos de identificação, convertidas em perguntas de entrada.
+
+    Num formulário dividido não há uma parte que gere o identificador (uuid())
+    e o passe às outras: em todas as partes o inquiridor introduz o mesmo
+    código (ex: número do questionário, código da escola), validado pela
+    constraint da regra do campo, e as submissões juntam-se por esses campos.
+    """
+    nomes = survey["name"].map(_texto)
+    linhas = []
+    for sufixo in campos_identificacao:
+        encontrados = survey[nomes.str.endswith(sufixo)]
+        if encontrados.empty:
+            continue
+        linha = encontrados.iloc[0].copy()
+        linha["type"] = "text"
+        linha["calculation"] = ""
+        linha["required"] = "true"
+        linha["relevant"] = ""
+        linha["label::Portugues (pt)"] = labels_identificacao.get(sufixo, sufixo.replace("_", " "))
+        linhas.append(linha)
+    return pd.DataFrame(linhas, columns=survey.columns)
+
+
+def _referencias(linhas):
+    """Nomes referidos com ${...} nas expressões, labels e hints das linhas."""
+    colunas = [c for c in linhas.columns if c in COLUNAS_COM_REFERENCIAS
+               or str(c).startswith(("label", "hint", "constraint_message", "required_message"))]
+    referencias = set()
+    for col in colunas:
+        for expressao in linhas[col].map(_texto):
+            referencias.update(ref.strip() for ref in PADRAO_REFERENCIA.findall(expressao))
+    return referencias
+
+
+def _copias_externas(survey, parte, particao, particao_de):
+    """
+    Copia para a parte as variáveis de outras partes usadas nas suas expressões.
+
+    Um calculate é copiado com o seu cálculo (e, pelo mesmo processo, as
+    variáveis de que depende). Uma pergunta passa a pergunta obrigatória, sem
+    relevant nem constraint, onde o inquiridor repete a resposta dada na parte
+    de origem. Referências a nomes que não existem no formulário ficam para a
+    validação.
+
+    Retorna:
+        tuple: (DataFrame com as linhas copiadas, lista para o manifesto)
+    """
+    nomes = survey["name"].map(_texto)
+    posicao_de = {}
+    for pos, nome in enumerate(nomes):
+        if nome:
+            posicao_de.setdefault(nome, pos)
+    nomes_parte = set(parte["name"].map(_texto))
+
+    copias, manifesto = [], []
+    pendentes = sorted(_referencias(parte) - nomes_parte, reverse=True)
+    while pendentes:
+        nome = pendentes.pop()
+        if nome in nomes_parte or nome not in posicao_de:
+            continue
+        linha = survey.iloc[posicao_de[nome]].copy()
+        tipo = _texto(linha["type"]).split(" ")[0]
+        origem = particao_de.get(nome, "")
+        if tipo in TIPOS_SEM_VALOR:
+            raise ValueError(f"A parte {particao} usa ${{{nome}}}, um '{tipo}' da parte {origem} que não pode "
+                             f"ser copiado. Ajuste a expressão ou divida o formulário de outra forma.")
+        if tipo == "calculate":
+            como = "calculo"
+        else:
+            como = "pergunta"
+            linha["required"] = "true"
+            for col in ("relevant", "constraint", "constraint_message", "calculation", "read_only"):
+                if col in linha.index:
+                    linha[col] = ""
+            label = _texto(linha.get("label::Portugues (pt)")) or nome
+            linha["label::Portugues (pt)"] = f"{label} (mesma resposta da parte {origem})"
+        copias.append(linha)
+        nomes_parte.add(nome)
+        manifesto.append({"name": nome, "particao_origem": str(origem), "como": como})
+        novas = _referencias(pd.DataFrame([linha])) - nomes_parte
+        pendentes.extend(sorted(novas, reverse=True))
+    return pd.DataFrame(copias, columns=survey.columns), manifesto
+
+
+def _listas_usadas(survey):
+    partes = survey["type"].map(_texto).str.extract(r"^(select_one|select_multiple)(_from_file)?\s+(\S+)")
+    listas = set(partes.loc[partes[1].isna(), 2].dropna())
+    arquivos = set(partes.loc[partes[1].notna(), 2].dropna())
+    for col in survey.columns:
+        if str(col).startswith("media::"):
+            arquivos.update(n for n in survey[col].map(_texto) if n)
+    return listas, arquivos
+
+
+def gerar_xlsx(survey, choices, settings):
+    """Escreve as três abas do XLSForm e devolve os bytes do arquivo."""
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        survey.to_excel(writer, sheet_name="survey", index=False)
+        choices.to_excel(writer, sheet_name="choices", index=False)
+        settings.to_excel(writer, sheet_name="settings", index=False)
+    return output.getvalue()
+
+
+def _gerar_parte(argumentos):
+    """Trabalho de cada processo: gera o XLSForm de uma partição."""
+    nome_arquivo, survey, choices, settings = argumentos
+    return nome_arquivo, gerar_xlsx(survey, choices, settings)
+
+
+def construir_formularios_divididos(survey, choices, settings, modo, campos_identificacao,
+                                    labels_identificacao=None, max_processos=None, media=None):
+    """
+    Divide o formulário por bloco ou grupo de topo e gera cada parte em paralelo.
+
+    Cada parte leva as linhas de metadados (start, end, ...), os campos de
+    identificação (id_questionario, codigo_escola) para juntar as submissões,
+    cópias das variáveis de outras partes usadas nas suas expressões e só as
+    listas de choices que usa. A 'version' de cada parte é o hash do seu
+    próprio conteúdo, para que só as partes alteradas sejam descarregadas.
+    Cada parte é validada com validar_xlsform antes de ser gerada.
+
+    Retorna:
+        tuple: ({nome_arquivo: bytes}, incluindo 'manifesto.json';
+                {nome_arquivo: resultado de validar_xlsform})
+    """
+    survey = survey.reset_index(drop=True)
+    if "required" not in survey.columns:
+        survey["required"] = ""  # para os campos de identificação e as cópias obrigatórias
+    tipos = survey["type"].map(_texto)
+    metadados = survey[tipos.isin(TIPOS_METADADOS)]
+    identificacao = _linhas_identificacao(survey, campos_identificacao, labels_identificacao or {})
+    nomes_identificacao = set(identificacao["name"].map(_texto))
+
+    form_id = _texto(settings.at[0, "form_id"])
+    form_title = _texto(settings.at[0, "form_title"])
+
+    particoes = particionar_survey(survey, modo)
+    nomes = survey["name"].map(_texto)
+    particao_de = {nomes[pos]: particao for particao, posicoes in particoes.items() for pos in posicoes if nomes[pos]}
+
+    trabalhos = []
+    validacoes = {}
+    manifesto = {
+        "modo": modo, "form_id_original": form_id,
+        "campos_identificacao": sorted(nomes_identificacao),
+        "juntar_submissoes": "Os campos de identificação são introduzidos pelo inquiridor em todas as partes "
+                             "(o mesmo código em cada parte) e as submissões das várias partes juntam-se por "
+                             "esses campos. As variáveis em 'campos_copiados' repetem-se na parte: os cálculos "
+                             "são refeitos e as perguntas são respondidas de novo com o mesmo valor.",
+        "partes": []
+    }
+    for particao, posicoes in particoes.items():
+        parte = survey.iloc[posicoes]
+        # Os campos de identificação vão no topo de todas as partes, como perguntas de entrada
+        parte = parte[~parte["name"].map(_texto).isin(nomes_identificacao)]
+        parte = pd.concat([metadados, identificacao, parte], ignore_index=True)
+        copias, campos_copiados = _copias_externas(survey, parte, particao, particao_de)
+        if not copias.empty:
+            parte = pd.concat([parte.iloc[:len(metadados) + len(identificacao)], copias,
+                               parte.iloc[len(metadados) + len(identificacao):]], ignore_index=True)
+
+        listas, arquivos_media = _listas_usadas(parte)
+        nomes_variaveis = [n for n in survey["name"].iloc[posicoes].map(_texto) if n]
+        choices_parte = choices[choices["list_name"].isin(listas)].reset_index(drop=True)
+
+        sufixo = re.sub(r"[^0-9a-zA-Z_]", "_", str(particao)).lower()
+        settings_parte = settings.copy()
+        settings_parte["form_id"] = f"{form_id}_{sufixo}"
+        settings_parte["form_title"] = f"{form_title} - {particao}"
+        media_parte = {nome: conteudo for nome, conteudo in (media or {}).items() if nome in arquivos_media}
+        settings_parte["version"] = versao_por_conteudo(parte, choices_parte, settings_parte, media_parte)
+
+        nome_arquivo = f"formulario_{sufixo}.xlsx"
+        validacoes[nome_arquivo] = validar_xlsform(parte, choices_parte, settings_parte, media_parte)
+        trabalhos.append((nome_arquivo, parte, choices_parte, settings_parte))
+        manifesto["partes"].append({
+            "particao": str(particao),
+            "arquivo": nome_arquivo,
+            "form_id": f"{form_id}_{sufixo}",
+            "version": settings_parte.at[0, "version"],
+            "linhas": len(parte),
+            "primeira_variavel": nomes_variaveis[0] if nomes_variaveis else "",
+            "ultima_variavel": nomes_variaveis[-1] if nomes_variaveis else "",
+            "campos_copiados": campos_copiados,
+            "listas_choices": sorted(listas),
+            "media": sorted(arquivos_media),
+            "erros_validacao": len(validacoes[nome_arquivo]["erros"])
+        })
+
+    with ProcessPoolExecutor(max_workers=max_processos) as executor:
+        arquivos = dict(executor.map(_gerar_parte, trabalhos))
+
+    arquivos["manifesto.json"] = json.dumps(manifesto, ensure_ascii=False, indent=2).encode("utf-8")
+    return arquivos, validacoes
@@ -1,40 +1,128 @@
-import re
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-import pandas as pd
+from openpyxl import Workbook, load_workbook
+
+from limpeza_labels import ARQUIVO_REGRAS_PADRAO, carregar_regras_limpeza, limpar_texto
+
+SUFIXO_CORRIGIDO = "_corrigido"
 
 
 def limpar_label(label):
     """
     Remove partes incorretas de um label mantendo os valores dentro de ${}.
+    As regras vêm de limpeza_labels.xlsx (compiladas uma só vez).
     """
-    padrao_corrupto = r'Total de (Qea|Qee|Qepe) .*? (?=\d{1,2} Num|Total)'  # Remover tudo até números ou palavras-chave úteis
-    
-    # Separar texto e variáveis (${...})
-    partes = re.split(r'(\${.*?})', label)
-    
-    # Limpar apenas as partes de texto
-    partes_corrigidas = [re.sub(padrao_corrupto, 'Total ', p) if not p.startswith('${') else p for p in partes]
-    
-    return ''.join(partes_corrigidas)
-
-def corrigir_xlsform(caminho_arquivo):
+    return limpar_texto(label, carregar_regras_limpeza())
+
+def corrigir_xlsform(caminho_arquivo, caminho_regras=ARQUIVO_REGRAS_PADRAO):
     """
-    Lê um arquivo XLSForm, corrige a coluna label::Portugues (pt) e salva um novo arquivo.
+    Lê um arquivo XLSForm e corrige os labels e hints de todas as abas, salvando um novo arquivo.
+
+    O arquivo é lido em modo read-only e escrito em modo write-only do openpyxl,
+    linha a linha, por isso a memória não cresce com o tamanho do formulário e
+    as abas choices e settings são mantidas. Em cada aba, a primeira linha é o
+    cabeçalho; são corrigidas as colunas label/label::* e hint/hint::*.
+
+    Retorna:
+        dict: arquivo, saida, abas corrigidas, células alteradas e tempo em segundos
     """
-    df = pd.read_excel(caminho_arquivo,  header=None)
-    
-    # Verificar se a coluna existe
-    coluna_label = 'label::Portugues (pt)'
-    if coluna_label not in df.columns:
-        raise ValueError(f"A coluna '{coluna_label}' não foi encontrada no arquivo.")
-    
-    # Aplicar a correção
-    df[coluna_label] = df[coluna_label].apply(limpar_label)
-    
-    # Salvar o arquivo corrigido
-    novo_caminho = caminho_arquivo.replace('.xls', '_corrigido.xls')
-    df.to_excel(novo_caminho, index=False)
-    
-    return novo_caminho
-
-corrigir_xlsform("c:\\Users\\a\\Downloads\\FORMULÁRIO GERAL.xlsx")
\ No newline at end of file
+    inicio = time.perf_counter()
+    regras = carregar_regras_limpeza(caminho_regras)
+    base, extensao = os.path.splitext(caminho_arquivo)
+    novo_caminho = f"{base}{SUFIXO_CORRIGIDO}{extensao}"
+
+    origem = load_workbook(caminho_arquivo, read_only=True)
+    destino = Workbook(write_only=True)
+    alteradas = 0
+    abas_corrigidas = []
+    try:
+        for aba in origem.worksheets:
+            saida = destino.create_sheet(aba.title)
+            colunas = []  # (índice, regras que se aplicam à coluna)
+            for n, linha in enumerate(aba.iter_rows(values_only=True)):
+                if n == 0:
+                    for i, cabecalho in enumerate(linha):
+                        nome = str(cabecalho).strip().lower() if cabecalho is not None else ""
+                        if nome in ("label", "hint"):
+                            nome += "::"
+                        regras_col = [regra for regra in regras if nome.startswith(regra[2])]
+                        if regras_col:
+                            colunas.append((i, regras_col))
+                    if colunas:
+                        abas_corrigidas.append(aba.title)
+                    saida.append(linha)
+                    continue
+
+                if colunas:
+                    linha = list(linha)
+                    for i, regras_col in colunas:
+                        if i < len(linha) and isinstance(linha[i], str):
+                            corrigido = limpar_texto(linha[i], regras_col)
+                            if corrigido != linha[i]:
+                                linha[i] = corrigido
+                                alteradas += 1
+                saida.append(linha)
+        destino.save(novo_caminho)
+    finally:
+        origem.close()
+
+    return {
+        "arquivo": caminho_arquivo,
+        "saida": novo_caminho,
+        "abas": abas_corrigidas,
+        "celulas_alteradas": alteradas,
+        "segundos": round(time.perf_counter() - inicio, 3)
+    }
+
+
+def listar_xlsforms(pasta):
+    """Todos os .xlsx da pasta (e subpastas), exceto temporários do Excel e arquivos já corrigidos."""
+    arquivos = []
+    for raiz, _, nomes in os.walk(pasta):
+        for nome in sorted(nomes):
+            base, extensao = os.path.splitext(nome)
+            if extensao.lower() != ".xlsx" or nome.startswith("~$") or base.endswith(SUFIXO_CORRIGIDO):
+                continue
+            arquivos.append(os.path.join(raiz, nome))
+    return arquivos
+
+
+def corrigir_lote(caminhos, caminho_regras=ARQUIVO_REGRAS_PADRAO, max_processos=None):
+    """
+    Corrige vários XLSForms (arquivos ou pastas) em processos paralelos.
+
+    Retorna:
+        list: um resultado de corrigir_xlsform por arquivo; em caso de erro, {'arquivo', 'erro'}
+    """
+    arquivos = []
+    for caminho in caminhos:
+        arquivos.extend(listar_xlsforms(caminho) if os.path.isdir(caminho) else [caminho])
+
+    resultados = []
+    with ProcessPoolExecutor(max_workers=max_processos) as executor:
+        futuros = [(arquivo, executor.submit(corrigir_xlsform, arquivo, caminho_regras)) for arquivo in arquivos]
+        for arquivo, futuro in futuros:
+            try:
+                resultados.append(futuro.result())
+            except Exception as e:
+                resultados.append({"arquivo": arquivo, "erro": str(e)})
+    return resultados
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Corrige labels e hints de XLSForms com as regras de limpeza_labels.xlsx")
+    parser.add_argument("caminhos", nargs="+", help="Arquivos .xlsx ou pastas com XLSForms")
+    parser.add_argument("--regras", default=ARQUIVO_REGRAS_PADRAO, help="Arquivo com as regras de limpeza")
+    parser.add_argument("--processos", type=int, default=None, help="Número de processos paralelos")
+    args = parser.parse_args()
+
+    for resultado in corrigir_lote(args.caminhos, args.regras, args.processos):
+        if "erro" in resultado:
+            print(f"ERRO  {resultado['arquivo']}: {resultado['erro']}")
+        else:
+            print(f"OK    {resultado['arquivo']} -> {resultado['saida']} "
+                  f"({resultado['celulas_alteradas']} células alteradas em {', '.join(resultado['abas']) or 'nenhuma aba'}, "
+                  f"{resultado['segundos']}s)")
@@ -0,0 +1,95 @@
+import os
+import re
+
+import pandas as pd
+
+from analise_regex import risco_backtracking
+
+ARQUIVO_REGRAS_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "limpeza_labels.xlsx")
+
+# Partes ${...} dos labels nunca são alteradas
+PADRAO_VARIAVEL = re.compile(r"(\$\{[^}]*\})")
+
+_cache_regras = {}
+
+
+def carregar_regras_limpeza(caminho=ARQUIVO_REGRAS_PADRAO):
+    """
+    Lê e compila as regras de limpeza de labels (uma só vez por versão do arquivo).
+
+    O arquivo deve ter as colunas 'padrao' e 'substituicao'; a coluna opcional
+    'colunas' restringe a regra a 'label', 'hint' ou ambas (separadas por vírgula).
+
+    Retorna:
+        list: [(regex compilado, substituição, prefixos de coluna)]
+    """
+    chave = (caminho, os.path.getmtime(caminho))
+    if chave in _cache_regras:
+        return _cache_regras[chave]
+
+    regras_df = pd.read_excel(caminho)
+    regras_df.columns = regras_df.columns.str.strip().str.lower()
+    colunas_necessarias = {"padrao", "substituicao"}
+    if not colunas_necessarias.issubset(regras_df.columns):
+        raise ValueError(f"O arquivo {caminho} deve conter as colunas: {colunas_necessarias}")
+
+    regras = []
+    for linha, row in regras_df.iterrows():
+        if pd.isna(row["padrao"]):
+            continue
+        padrao = str(row["padrao"])
+        risco = risco_backtracking(padrao)
+        if risco:
+            raise ValueError(f"Regra {linha + 2} do arquivo {caminho} tem {risco}: {padrao}")
+        substituicao = "" if pd.isna(row["substituicao"]) else str(row["substituicao"])
+        alvo = str(row.get("colunas", "")) if pd.notna(row.get("colunas", None)) else "label,hint"
+        prefixos = tuple(f"{c.strip().lower()}::" for c in alvo.split(",") if c.strip())
+        regras.append((re.compile(padrao), substituicao, prefixos))
+
+    _cache_regras.clear()
+    _cache_regras[chave] = regras
+    return regras
+
+
+def limpar_texto(texto, regras):
+    """Aplica as regras a um texto, preservando as partes ${...}."""
+    partes = PADRAO_VARIAVEL.split(texto)
+    for i in range(0, len(partes), 2):  # índices pares são texto, ímpares são ${...}
+        for regex, substituicao, _ in regras:
+            partes[i] = regex.sub(substituicao, partes[i])
+    return "".join(partes)
+
+
+def limpar_labels(df, regras=None):
+    """
+    Aplica as regras de limpeza a todas as colunas label::* e hint::* do DataFrame.
+
+    As células sem ${...} são tratadas de forma vetorizada com str.replace;
+    só as que têm variáveis passam pela divisão texto/variável.
+
+    Retorna:
+        tuple: (DataFrame limpo, número de células alteradas)
+    """
+    if regras is None:
+        regras = carregar_regras_limpeza()
+    df = df.copy()
+    alteradas = 0
+    for col in df.columns:
+        nome_col = str(col).lower()
+        regras_col = [regra for regra in regras if nome_col.startswith(regra[2])]
+        if not regras_col:
+            continue
+
+        preenchidas = df[col].notna()
+        originais = df.loc[preenchidas, col].astype(str)
+        com_variaveis = originais.str.contains("${", regex=False)
+
+        limpas = originais[~com_variaveis]
+        for regex, substituicao, _ in regras_col:
+            limpas = limpas.str.replace(regex, substituicao, regex=True)
+        limpas_variaveis = originais[com_variaveis].map(lambda texto: limpar_texto(texto, regras_col))
+
+        novos = pd.concat([limpas, limpas_variaveis])[originais.index]
+        alteradas += int((novos != originais).sum())
+        df.loc[preenchidas, col] = novos
+    return df, alteradas
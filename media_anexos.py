@@ -0,0 +1,179 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import pandas as pd
+from PIL import Image, UnidentifiedImageError
+
+EXTENSOES_IMAGEM = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp", ".tif", ".tiff"}
+EXTENSOES_AUDIO = {".mp3", ".wav", ".ogg", ".m4a", ".amr"}
+EXTENSOES_VIDEO = {".mp4", ".3gp", ".avi", ".mov", ".webm"}
+
+
+def _texto(valor):
+    if pd.isna(valor):
+        return ""
+    return str(valor).strip()
+
+
+def coluna_media(extensao, idioma="Portugues (pt)"):
+    """Coluna XLSForm de media para a extensão do arquivo (None se não for imagem, áudio nem vídeo)."""
+    if extensao in EXTENSOES_IMAGEM:
+        tipo = "image"
+    elif extensao in EXTENSOES_AUDIO:
+        tipo = "audio"
+    elif extensao in EXTENSOES_VIDEO:
+        tipo = "video"
+    else:
+        return None
+    return f"media::{tipo}::{idioma}"
+
+
+def ler_pasta_anexos(pasta):
+    """Lê todos os arquivos de uma pasta para {nome_arquivo: bytes}."""
+    anexos = {}
+    for raiz, _, arquivos in os.walk(pasta):
+        for nome in arquivos:
+            with open(os.path.join(raiz, nome), "rb") as f:
+                anexos[nome] = f.read()
+    return anexos
+
+
+def _processar_imagem(argumentos):
+    """
+    Reduz e recomprime uma imagem até ao tamanho alvo (corre num processo à parte).
+
+    Imagens com transparência ficam em PNG otimizado; as restantes em JPEG,
+    baixando a qualidade até caber em 'tamanho_alvo' bytes.
+
+    Retorna:
+        tuple: (extensão final, bytes), ou None se o arquivo não for uma imagem válida
+    """
+    conteudo, max_px, tamanho_alvo = argumentos
+    try:
+        imagem = Image.open(BytesIO(conteudo))
+        imagem.thumbnail((max_px, max_px))
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+
+    saida = BytesIO()
+    transparente = imagem.mode in ("RGBA", "LA") or (imagem.mode == "P" and "transparency" in imagem.info)
+    if transparente:
+        imagem.save(saida, format="PNG", optimize=True)
+        return ".png", saida.getvalue()
+
+    imagem = imagem.convert("RGB")
+    for qualidade in (85, 75, 65, 55, 45, 35):
+        saida = BytesIO()
+        imagem.save(saida, format="JPEG", quality=qualidade, optimize=True, progressive=True)
+        if saida.tell() <= tamanho_alvo:
+            break
+    return ".jpg", saida.getvalue()
+
+
+def processar_anexos(survey, anexos, coluna_origem="media", max_px=1024, tamanho_alvo_kb=200,
+                     pasta_cache=".cache_media", max_processos=None, idioma="Portugues (pt)"):
+    """
+    Resolve os arquivos da coluna 'Anexo' e prepara-os como media do formulário.
+
+    Os arquivos são desduplicados pelo hash do conteúdo; as imagens são reduzidas
+    a 'max_px' e recomprimidas para cerca de 'tamanho_alvo_kb' num pool de
+    processos. O resultado de cada imagem fica em cache (pasta_cache) pelo hash,
+    para que as conversões seguintes não repitam o trabalho. Imagens que não
+    abrem ficam com o arquivo original ('invalidos'); arquivos que não são
+    imagem, áudio nem vídeo não entram no formulário ('nao_suportados').
+
+    Parâmetros:
+        survey (pd.DataFrame): survey com a coluna 'media' vinda de process_sheet
+        anexos (dict): {nome_arquivo: bytes} com os arquivos disponíveis
+
+    Retorna:
+        tuple: (survey com colunas media::image/audio/video, {nome_arquivo: bytes}, relatório)
+    """
+    relatorio = {"referencias": 0, "arquivos_unicos": 0, "em_cache": 0, "processados": 0, "em_falta": [],
+                 "invalidos": [], "nao_suportados": []}
+    if coluna_origem not in survey.columns:
+        return survey, {}, relatorio
+
+    survey = survey.copy()
+    referencias = survey[coluna_origem].map(_texto)
+    relatorio["referencias"] = int(referencias.ne("").sum())
+    anexos_por_nome = {os.path.basename(nome).lower(): conteudo for nome, conteudo in (anexos or {}).items()}
+
+    # Desduplicar pelo conteúdo: vários nomes podem apontar para o mesmo arquivo
+    hash_por_referencia = {}
+    originais = {}
+    for referencia in set(referencias) - {""}:
+        if coluna_media(os.path.splitext(referencia)[1].lower(), idioma) is None:
+            relatorio["nao_suportados"].append(referencia)
+            continue
+        conteudo = anexos_por_nome.get(os.path.basename(referencia.replace("\\", "/")).lower())
+        if conteudo is None:
+            relatorio["em_falta"].append(referencia)
+            continue
+        hash_conteudo = hashlib.sha256(conteudo).hexdigest()
+        hash_por_referencia[referencia] = hash_conteudo
+        originais.setdefault(hash_conteudo, (referencia, conteudo))
+    relatorio["arquivos_unicos"] = len(originais)
+
+    parametros = f"{max_px}_{tamanho_alvo_kb}"
+
+    finais = {}  # hash -> (nome_arquivo, bytes)
+    por_processar = []
+    for hash_conteudo, (referencia, conteudo) in originais.items():
+        extensao = os.path.splitext(referencia)[1].lower()
+        if extensao not in EXTENSOES_IMAGEM:
+            finais[hash_conteudo] = (f"{hash_conteudo[:16]}{extensao}", conteudo)
+            continue
+        em_cache = None
+        for extensao_final in (".jpg", ".png"):
+            caminho = os.path.join(pasta_cache, f"{hash_conteudo}_{parametros}{extensao_final}") if pasta_cache else None
+            if caminho and os.path.exists(caminho):
+                with open(caminho, "rb") as f:
+                    em_cache = (f"{hash_conteudo[:16]}{extensao_final}", f.read())
+                break
+        if em_cache:
+            finais[hash_conteudo] = em_cache
+            relatorio["em_cache"] += 1
+        else:
+            por_processar.append(hash_conteudo)
+
+    if por_processar:
+        trabalhos = [(originais[h][1], max_px, tamanho_alvo_kb * 1024) for h in por_processar]
+        with ProcessPoolExecutor(max_workers=max_processos) as executor:
+            resultados = list(executor.map(_processar_imagem, trabalhos))
+        if pasta_cache:
+            os.makedirs(pasta_cache, exist_ok=True)
+        for hash_conteudo, resultado in zip(por_processar, resultados):
+            referencia, original = originais[hash_conteudo]
+            if resultado is None:
+                # Não é uma imagem que o PIL abra: segue o arquivo original, sem cache
+                relatorio["invalidos"].append(referencia)
+                finais[hash_conteudo] = (f"{hash_conteudo[:16]}{os.path.splitext(referencia)[1].lower()}", original)
+                continue
+            extensao_final, conteudo = resultado
+            finais[hash_conteudo] = (f"{hash_conteudo[:16]}{extensao_final}", conteudo)
+            if pasta_cache:
+                with open(os.path.join(pasta_cache, f"{hash_conteudo}_{parametros}{extensao_final}"), "wb") as f:
+                    f.write(conteudo)
+        relatorio["processados"] = len(por_processar) - len(relatorio["invalidos"])
+
+    # Escrever a coluna media::<tipo>::<idioma> com o nome final de cada arquivo
+    for referencia, hash_conteudo in hash_por_referencia.items():
+        nome_final = finais[hash_conteudo][0]
+        coluna = coluna_media(os.path.splitext(nome_final)[1], idioma)
+        if coluna not in survey.columns:
+            survey[coluna] = ""
+        survey.loc[referencias == referencia, coluna] = nome_final
+
+    # Referências sem arquivo ficam como estão, para serem enviadas à parte para o servidor
+    for referencia in relatorio["em_falta"]:
+        coluna = coluna_media(os.path.splitext(referencia)[1].lower(), idioma)
+        if coluna not in survey.columns:
+            survey[coluna] = ""
+        survey.loc[referencias == referencia, coluna] = referencia
+
+    survey = survey.drop(columns=[coluna_origem])
+    media = dict(finais.values())
+    return survey, media, relatorio
@@ -0,0 +1,157 @@
+import argparse
+import sys
+from collections import Counter
+from io import BytesIO
+
+import pandas as pd
+
+from empacotamento import e_pacote, empacotar_arquivos
+from prevalidacao import prevalidar_planilhas
+from registo import registar_etapa
+from tarefas_conversao import ColetorMensagens, ConversaoInterrompida, coletar_mensagens
+
+
+def prefixo_questionario(nomes):
+    """Prefixo mais comum dos nomes (ex: 'QEA' em 'QEA_DGE_SQE_B0_P1_codigo_escola')."""
+    contagem = Counter(nome.split("_", 1)[0].upper() for nome in nomes if "_" in nome)
+    return contagem.most_common(1)[0][0] if contagem else ""
+
+
+def indice_nomes(nomes_por_questionario):
+    """
+    Índice único sobre todos os questionários: nome sem o prefixo do questionário
+    -> {questionário: nome completo}.
+
+    Parâmetros:
+        nomes_por_questionario (dict): {prefixo do questionário: [nomes pela ordem]}
+
+    Retorna:
+        dict: {nome_base: {questionário: nome}}, pela ordem da primeira ocorrência
+    """
+    indice = {}
+    for questionario, nomes in nomes_por_questionario.items():
+        prefixo = f"{questionario}_".upper()
+        for nome in nomes:
+            base = nome[len(prefixo):] if nome.upper().startswith(prefixo) else nome
+            indice.setdefault(base, {})[questionario] = nome
+    return indice
+
+
+def tabela_partilhadas(indice, questionarios):
+    """
+    Variáveis partilhadas por todos os questionários, por alguns, ou únicas de um.
+
+    Retorna:
+        pd.DataFrame: nome_base, uma coluna por questionário com o nome completo, total e categoria
+    """
+    linhas = []
+    for base, nomes in indice.items():
+        total = len(nomes)
+        if total == len(questionarios):
+            categoria = "todos"
+        elif total == 1:
+            categoria = f"única ({next(iter(nomes))})"
+        else:
+            categoria = "parcial"
+        linhas.append({"nome_base": base, **{q: nomes.get(q, "") for q in questionarios},
+                       "questionarios": total, "categoria": categoria})
+    return pd.DataFrame(linhas, columns=["nome_base", *questionarios, "questionarios", "categoria"])
+
+
+def partilhadas_para_excel(tabela, questionarios):
+    """Escreve o relatório num xlsx com o detalhe e um resumo por questionário."""
+    resumo = pd.DataFrame([{
+        "questionario": q,
+        "variaveis": int((tabela[q] != "").sum()),
+        "em_todos": int(((tabela[q] != "") & (tabela["categoria"] == "todos")).sum()),
+        "unicas": int(((tabela[q] != "") & (tabela["questionarios"] == 1)).sum())
+    } for q in questionarios])
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        tabela.to_excel(writer, sheet_name="variaveis", index=False)
+        resumo.to_excel(writer, sheet_name="resumo", index=False)
+    output.seek(0)
+    return output
+
+
+def converter_questionarios(questionarios, regras_campos=None, **opcoes):
+    """
+    Converte vários questionários (ex: QEA, QEE, QEPE) de uma vez.
+
+    Os nomes de todos são lidos primeiro (leitura rápida da pré-validação) para
+    o relatório de variáveis partilhadas, e essa pré-validação é passada à
+    conversão de cada questionário, que não a repete. As regras de campos são
+    compiladas uma só vez e as tabelas de regras (regex, selects, relevante,
+    Choices) ficam na cache do conversor entre questionários; a aplicação das
+    regras corre por questionário, porque os nomes completos (com o prefixo)
+    são diferentes em cada um. Cada questionário gera o seu XLSForm, com form_id
+    próprio.
+
+    Parâmetros:
+        questionarios (list): [(dados, grupos, padroes), ...] — arquivos de cada questionário
+        regras_campos (dict): regras já compiladas (por omissão regras_campos.yaml)
+        **opcoes: as mesmas opções de convert_to_xlsform
+
+    Retorna:
+        tuple: (BytesIO com o ZIP dos formulários e do relatório, tabela de variáveis partilhadas)
+    """
+    import conversor
+
+    nomes, entradas, prevalidacoes = {}, {}, {}
+    for dados, grupos, padroes in questionarios:
+        prevalidacao = prevalidar_planilhas(dados, abas=opcoes.get("abas"))
+        prefixo = prefixo_questionario(prevalidacao["nomes"]) or f"Q{len(entradas) + 1}"
+        if prefixo in entradas:
+            raise ValueError(f"Dois questionários com o mesmo prefixo '{prefixo}'")
+        nomes[prefixo], entradas[prefixo] = prevalidacao["nomes"], (dados, grupos, padroes)
+        prevalidacoes[prefixo] = prevalidacao
+
+    tabela = tabela_partilhadas(indice_nomes(nomes), list(entradas))
+    registar_etapa("questionarios", "Questionários: %s; %d variáveis comuns a todos, %d únicas de um.",
+                   ", ".join(entradas), int((tabela["categoria"] == "todos").sum()),
+                   int((tabela["questionarios"] == 1).sum()), questionarios=list(entradas))
+
+    if regras_campos is None:
+        regras_campos = conversor.carregar_regras_campos()
+    arquivos = {}
+    for prefixo, (dados, grupos, padroes) in entradas.items():
+        registar_etapa("questionarios", "Questionário %s: a converter.", prefixo, questionario=prefixo)
+        try:
+            resultado = conversor.convert_to_xlsform(
+                dados, grupos, padroes, regras_campos=regras_campos, prevalidacao=prevalidacoes[prefixo],
+                form_id=f"form_pat_{prefixo.lower()}", form_title=f"Formulário PAT {prefixo}", **opcoes
+            )
+        except ConversaoInterrompida:
+            resultado = None  # st.stop() de um questionário não impede os restantes
+        if resultado is None:
+            conversor.st.error(f"Questionário {prefixo}: a conversão falhou.")
+            continue
+        dados_resultado = resultado.getvalue()
+        extensao = "zip" if e_pacote(dados_resultado) else "xlsx"
+        arquivos[f"formulario_{prefixo.lower()}.{extensao}"] = dados_resultado
+
+    arquivos["variaveis_questionarios.xlsx"] = partilhadas_para_excel(tabela, list(entradas)).getvalue()
+    return empacotar_arquivos(arquivos), tabela
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Conversão de vários questionários com as mesmas regras")
+    parser.add_argument("--questionario", nargs=3, action="append", required=True,
+                        metavar=("DADOS", "GRUPOS", "PADROES"), help="Arquivos de um questionário (repetir para cada um)")
+    parser.add_argument("--saida", default="questionarios.zip", help="ZIP com os formulários e o relatório")
+    parser.add_argument("--dividir-por", choices=["bloco", "grupo"], help="Dividir cada formulário em partes")
+    args = parser.parse_args()
+
+    coletor = ColetorMensagens()
+    pacote = None
+    try:
+        with coletar_mensagens(coletor):
+            pacote, tabela = converter_questionarios(args.questionario, dividir_por=args.dividir_por)
+    finally:
+        for nivel, texto in coletor.mensagens():
+            print(f"{nivel.upper()}: {texto}" if nivel in ("warning", "error") else texto)
+    if pacote is None:
+        sys.exit(1)
+    with open(args.saida, "wb") as f:
+        f.write(pacote.getvalue())
+    print(f"Formulários e relatório gravados em {args.saida}")
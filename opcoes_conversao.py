@@ -0,0 +1,11 @@
+# Menor número de termos por soma parcial: com 1 cada passagem não encurta a soma
+MIN_TERMOS_SOMA = 2
+
+
+def validar_max_termos(max_termos):
+    """Aceita None ou 0 (desativado) ou um inteiro >= MIN_TERMOS_SOMA; senão ValueError."""
+    if max_termos in (None, 0):
+        return
+    if isinstance(max_termos, bool) or not isinstance(max_termos, int) or max_termos < MIN_TERMOS_SOMA:
+        raise ValueError(f"max_termos_soma deve ser 0 (desativado) ou um inteiro >= {MIN_TERMOS_SOMA}, "
+                         f"não {max_termos!r}")
@@ -0,0 +1,159 @@
+import re
+import unicodedata
+import zipfile
+from bisect import bisect_left
+from functools import lru_cache
+from io import BytesIO
+
+import pandas as pd
+
+from empacotamento import e_pacote
+from renomear_variaveis import PADRAO_REFERENCIA
+
+COLUNAS_TEXTO = ["name", "label::Portugues (pt)", "hint::Portugues (pt)", "relevant", "calculation",
+                 "constraint", "choice_filter"]
+COLUNAS_EXPRESSAO = ["relevant", "calculation", "constraint", "choice_filter"]
+PADRAO_TOKEN = re.compile(r"[a-z0-9_]+")
+
+
+def _texto(valor):
+    if valor is None or (isinstance(valor, float) and pd.isna(valor)):
+        return ""
+    return str(valor).strip()
+
+
+def _normalizar(texto):
+    texto = texto.lower()
+    if texto.isascii():
+        return texto
+    return "".join(c for c in unicodedata.normalize("NFD", texto) if unicodedata.category(c) != "Mn")
+
+
+@lru_cache(maxsize=65536)
+def _tokens(texto):
+    """Tokens em minúsculas e sem acentos; nomes com '_' também entram por partes."""
+    tokens = set()
+    for token in PADRAO_TOKEN.findall(_normalizar(texto)):
+        tokens.add(token)
+        tokens.update(parte for parte in token.split("_") if parte)
+    return frozenset(tokens)
+
+
+def surveys_do_resultado(dados):
+    """
+    XLSForms contidos no resultado da conversão (xlsx, ou os .xlsx de um ZIP).
+
+    Retorna:
+        dict: {nome_arquivo: bytes}
+    """
+    if e_pacote(dados):
+        with zipfile.ZipFile(BytesIO(dados)) as pacote:
+            return {nome: pacote.read(nome) for nome in pacote.namelist() if nome.lower().endswith(".xlsx")}
+    return {"formulario.xlsx": dados}
+
+
+def indexar_survey(survey):
+    """
+    Prepara o survey para a pré-visualização: uma entrada por linha com o nível
+    de grupo, o grupo pai e as referências ${...}; um índice nome -> linha e um
+    índice invertido de tokens (nome, label, hint e expressões) -> linhas.
+
+    Retorna:
+        dict: linhas, definicoes, tokens (ordenados, para procurar por prefixo), posicoes, fim_grupo
+    """
+    colunas = [c for c in COLUNAS_TEXTO if c in survey.columns]
+    valores = {c: survey[c].tolist() for c in colunas}
+    tipos = survey["type"].tolist() if "type" in survey.columns else [""] * len(survey)
+
+    linhas, definicoes, indice, fim_grupo = [], {}, {}, {}
+    pilha = []
+    for pos in range(len(survey)):
+        tipo = _texto(tipos[pos])
+        nome = _texto(valores["name"][pos]) if "name" in valores else ""
+        if tipo.startswith("end_"):
+            if pilha:
+                fim_grupo[pilha.pop()] = pos
+        textos = {c: _texto(valores[c][pos]) for c in colunas}
+        expressoes = {c: textos[c] for c in COLUNAS_EXPRESSAO if textos.get(c)}
+        referencias = []
+        for expressao in expressoes.values():
+            for ref in PADRAO_REFERENCIA.findall(expressao):
+                if ref.strip() not in referencias:
+                    referencias.append(ref.strip())
+        linhas.append({
+            "pos": pos,
+            "nivel": len(pilha),
+            "pai": pilha[-1] if pilha else None,
+            "tipo": tipo,
+            "nome": nome,
+            "label": textos.get("label::Portugues (pt)", ""),
+            "expressoes": expressoes,
+            "referencias": referencias
+        })
+        if nome and nome not in definicoes:
+            definicoes[nome] = pos
+        for texto in textos.values():
+            if texto:
+                for token in _tokens(texto):
+                    indice.setdefault(token, set()).add(pos)
+        if tipo.startswith("begin_"):
+            pilha.append(pos)
+
+    tokens = sorted(indice)
+    return {"linhas": linhas, "definicoes": definicoes, "tokens": tokens,
+            "posicoes": [indice[t] for t in tokens], "fim_grupo": fim_grupo}
+
+
+def procurar(indice, consulta):
+    """
+    Linhas que contêm todos os termos da consulta. Termos com '_' procuram-se
+    pelas partes (ex: 'dge_sqe_b4') e o último pode estar incompleto
+    (procura por prefixo no índice ordenado).
+
+    Retorna:
+        list: posições das linhas, por ordem
+    """
+    partes = [parte for palavra in PADRAO_TOKEN.findall(_normalizar(consulta)) for parte in palavra.split("_") if parte]
+    if not partes:
+        return []
+    tokens, posicoes = indice["tokens"], indice["posicoes"]
+
+    resultado = None
+    for n, parte in enumerate(partes):
+        encontradas = set()
+        i = bisect_left(tokens, parte)
+        if n == len(partes) - 1:
+            while i < len(tokens) and tokens[i].startswith(parte):
+                encontradas |= posicoes[i]
+                i += 1
+        elif i < len(tokens) and tokens[i] == parte:
+            encontradas = posicoes[i]
+        resultado = set(encontradas) if resultado is None else resultado & encontradas
+        if not resultado:
+            return []
+    return sorted(resultado)
+
+
+def linhas_visiveis(indice, recolhidos):
+    """Posições das linhas à vista, saltando o conteúdo dos grupos recolhidos."""
+    visiveis = []
+    fim_grupo = indice["fim_grupo"]
+    pos = 0
+    total = len(indice["linhas"])
+    while pos < total:
+        visiveis.append(pos)
+        if pos in recolhidos and pos in fim_grupo:
+            pos = fim_grupo[pos]
+            visiveis.append(pos)
+        pos += 1
+    return visiveis
+
+
+def antepassados(indice, pos):
+    """Grupos que contêm a linha (do mais interno para o mais externo)."""
+    grupos = []
+    pai = indice["linhas"][pos]["pai"]
+    while pai is not None:
+        grupos.append(pai)
+        pai = indice["linhas"][pai]["pai"]
+    return grupos
@@ -0,0 +1,141 @@
+import re
+import time
+import unicodedata
+
+from openpyxl import load_workbook
+
+COLUNAS_OBRIGATORIAS = ["Nome", "Tipo", "Rótulo (Label)", "Valores", "Anexo"]
+# Linhas onde se espera o cabeçalho (linha com 'Nome' e 'Tipo'); mais abaixo a
+# procura continua até ao fim da aba, como em find_header_row, mas com um aviso
+MAX_LINHAS_CABECALHO = 50
+
+
+def erros_nome_variavel(nome):
+    """
+    Erros de sintaxe de um nome de variável.
+
+    Retorna:
+        list: [(nome com o erro destacado, descrição do erro)]
+    """
+    if nome == "":
+        return [("(ERRO->Vazio)", "Nome da variável está vazio ou nulo")]
+    erros = []
+    if re.match(r'^\d', nome):
+        erros.append((f"(ERRO->{nome[0]})" + nome[1:], f"Nome não pode começar com número ('{nome[0]}')"))
+    for char in re.finditer(r'[^a-zA-Z0-9_]', nome):
+        pos = char.start()
+        erros.append((nome[:pos] + f"(ERRO->{char.group()})" + nome[pos + 1:], f"Caractere inválido '{char.group()}'"))
+    if ' ' in nome:
+        pos = nome.find(" ")
+        erros.append((nome[:pos] + "(ERRO-> )" + nome[pos + 1:], "Nome contém espaços"))
+    return erros
+
+
+def _normalizar_nome(valor):
+    """O mesmo tratamento que process_sheet/remove_line_breaks dão à coluna Nome."""
+    texto = "".join(c for c in unicodedata.normalize("NFD", str(valor)) if unicodedata.category(c) != "Mn")
+    return re.sub(r"[\n\r]", "", texto).strip()
+
+
+def _cabecalho(linha):
+    return [str(v).strip() if isinstance(v, str) else v for v in linha]
+
+
+def prevalidar_planilhas(arquivo, max_linhas_cabecalho=MAX_LINHAS_CABECALHO, abas=None):
+    """
+    Verificação rápida do arquivo de dados antes da conversão.
+
+    Cada aba é lida em modo read-only do openpyxl, linha a linha, e só o
+    cabeçalho e a coluna Nome são analisados. São verificados:
+    abas sem as colunas obrigatórias (que a conversão vai ignorar), nomes
+    inválidos e nomes repetidos, também entre abas diferentes.
+
+    Parâmetros:
+        arquivo: caminho ou arquivo aberto (.xlsx)
+        max_linhas_cabecalho (int): um cabeçalho mais abaixo gera um aviso (a aba continua a ser usada)
+        abas (list): só verificar estas abas (construção parcial)
+
+    Retorna:
+        dict: erros (bloqueiam a conversão), avisos, nomes por aba, nomes (pela ordem) e tempo em segundos
+    """
+    inicio = time.perf_counter()
+    if hasattr(arquivo, "seek"):
+        arquivo.seek(0)
+    livro = load_workbook(arquivo, read_only=True, data_only=True)
+    erros, avisos, nomes_por_aba, nomes = [], [], {}, []
+    vistos = {}  # nome -> (aba, linha)
+    try:
+        for aba in livro.worksheets:
+            if abas and aba.title not in abas:
+                continue
+            linhas = aba.iter_rows(values_only=True)
+            coluna_nome = coluna_tipo = None
+            numero = 0
+            for numero, linha in enumerate(linhas, start=1):
+                valores = [str(v).replace(" ", "") if isinstance(v, str) else v for v in linha]
+                if "Nome" in valores and "Tipo" in valores:
+                    cabecalho = _cabecalho(linha)
+                    em_falta = [col for col in COLUNAS_OBRIGATORIAS if col not in cabecalho]
+                    if em_falta:
+                        avisos.append(f"Aba '{aba.title}': colunas em falta {em_falta}; a aba será ignorada.")
+                    else:
+                        coluna_nome, coluna_tipo = cabecalho.index("Nome"), cabecalho.index("Tipo")
+                    if numero > max_linhas_cabecalho:
+                        avisos.append(f"Aba '{aba.title}': cabeçalho só na linha {numero} "
+                                      f"(esperado nas primeiras {max_linhas_cabecalho}).")
+                    break
+            else:
+                avisos.append(f"Aba '{aba.title}': sem linha de cabeçalho com Nome e Tipo; a aba será ignorada.")
+            if coluna_nome is None:
+                continue
+
+            nomes_por_aba[aba.title] = 0
+            for numero, linha in enumerate(linhas, start=numero + 1):
+                if all(v is None or (isinstance(v, str) and not v.strip()) for v in linha):
+                    continue  # linhas vazias são descartadas pela conversão
+                valor = linha[coluna_nome] if coluna_nome < len(linha) else None
+                nome = "" if valor is None else _normalizar_nome(valor)
+                if not nome and (coluna_tipo >= len(linha) or linha[coluna_tipo] is None):
+                    avisos.append(f"Aba '{aba.title}', linha {numero}: linha sem Nome nem Tipo.")
+                    continue
+                nomes_por_aba[aba.title] += 1
+                for nome_formatado, erro in erros_nome_variavel(nome):
+                    erros.append({"aba": aba.title, "linha": numero, "nome": nome,
+                                  "nome_formatado": nome_formatado, "erro": erro})
+                if not nome:
+                    continue
+                if nome in vistos:
+                    aba_anterior, linha_anterior = vistos[nome]
+                    erros.append({"aba": aba.title, "linha": numero, "nome": nome, "nome_formatado": nome,
+                                  "erro": f"Nome repetido (já usado na aba '{aba_anterior}', linha {linha_anterior})"})
+                else:
+                    vistos[nome] = (aba.title, numero)
+                    nomes.append(nome)
+    finally:
+        livro.close()
+        if hasattr(arquivo, "seek"):
+            arquivo.seek(0)
+
+    if not nomes_por_aba:
+        erros.append({"aba": "", "linha": 0, "nome": "", "nome_formatado": "",
+                      "erro": "Nenhuma aba com as colunas Nome, Tipo, Rótulo (Label), Valores e Anexo"})
+    return {"erros": erros, "avisos": avisos, "nomes_por_aba": nomes_por_aba, "nomes": nomes,
+            "segundos": round(time.perf_counter() - inicio, 3)}
+
+
+def mensagem_erros(erros):
+    """Texto dos erros da pré-validação, no formato das mensagens de check_variable_names."""
+    mensagem = "ERRO: Problemas encontrados no arquivo de dados:\n\n"
+    for erro in erros:
+        if erro["aba"]:
+            mensagem += f"Aba {erro['aba']}, linha {erro['linha']}: {erro['nome']}\n"
+        mensagem += f"  → Erro: {erro['erro']}\n"
+        if erro["nome_formatado"] and erro["nome_formatado"] != erro["nome"]:
+            mensagem += f"  → Nome ajustado: {erro['nome_formatado']}\n"
+        mensagem += "\n"
+    mensagem += "\nRegras para nomes válidos:\n"
+    mensagem += "- Sem espaços, acentos ou caracteres especiais\n"
+    mensagem += "- Somente letras, números e underscores\n"
+    mensagem += "- Não pode começar com número\n"
+    mensagem += "- Cada nome só pode ser usado uma vez em todo o questionário\n"
+    return mensagem
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import sys
+
+NOME_LOGGER = "conversor"
+# Como cada nível aparece na página (st.write/st.warning/st.error)
+METODOS_STREAMLIT = {"DEBUG": "write", "INFO": "write", "WARNING": "warning", "ERROR": "error", "CRITICAL": "error"}
+
+LOGGER = logging.getLogger(NOME_LOGGER)
+LOGGER.propagate = False
+
+
+class Preguicoso:
+    """
+    Adia o cálculo de um argumento de mensagem até ela ser mesmo escrita, ex:
+    LOGGER.debug("Nomes: %s", Preguicoso(lambda: df["name"].tolist())) não
+    percorre a coluna quando o nível DEBUG está desligado.
+    """
+
+    def __init__(self, funcao):
+        self.funcao = funcao
+
+    def __str__(self):
+        return str(self.funcao())
+
+
+class HandlerStreamlit(logging.Handler):
+    """Envia os registos para o st do conversor (a página, ou o coletor da tarefa/serviço)."""
+
+    def __init__(self, st, nivel=logging.NOTSET):
+        super().__init__(nivel)
+        self.st = st
+
+    def emit(self, record):
+        try:
+            getattr(self.st, METODOS_STREAMLIT.get(record.levelname, "write"))(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class FormatadorJsonl(logging.Formatter):
+    """Uma linha JSON por registo, com a etapa e os dados estruturados (extra={"etapa": ..., "dados": {...}})."""
+
+    def format(self, record):
+        linha = {
+            "ts": round(record.created, 3),
+            "nivel": record.levelname,
+            "etapa": getattr(record, "etapa", None),
+            "mensagem": record.getMessage(),
+            **getattr(record, "dados", {})
+        }
+        return json.dumps(linha, ensure_ascii=False, default=str)
+
+
+def configurar_registo(st=None, nivel=None, destinos=None, arquivo_jsonl=None):
+    """
+    (Re)configura o logger do conversor.
+
+    Por omissão o nível é INFO (uma linha de resumo por etapa); as mensagens por
+    linha ou por variável são DEBUG e ficam desligadas.
+
+    Parâmetros:
+        st: módulo streamlit (ou SaidaStreamlit) para o destino 'streamlit'
+        nivel (str): DEBUG, INFO, WARNING, ... (por omissão $CONVERSOR_LOG_NIVEL ou INFO)
+        destinos (list): 'consola' e/ou 'streamlit' (por omissão $CONVERSOR_LOG_DESTINOS ou 'streamlit')
+        arquivo_jsonl (str): também grava em JSONL neste arquivo (por omissão $CONVERSOR_LOG_JSONL)
+    """
+    nivel = (nivel or os.environ.get("CONVERSOR_LOG_NIVEL") or "INFO").upper()
+    if destinos is None:
+        destinos = [d.strip() for d in os.environ.get("CONVERSOR_LOG_DESTINOS", "streamlit").split(",") if d.strip()]
+    arquivo_jsonl = arquivo_jsonl or os.environ.get("CONVERSOR_LOG_JSONL")
+    # getLevelName devolve o número para um nome conhecido (getLevelNamesMapping só existe a partir do 3.11)
+    if not isinstance(logging.getLevelName(nivel), int):
+        raise ValueError(f"Nível de registo desconhecido: {nivel}")
+
+    for handler in list(LOGGER.handlers):
+        LOGGER.removeHandler(handler)
+        handler.close()
+    LOGGER.setLevel(nivel)
+    for destino in destinos:
+        if destino == "consola":
+            handler = logging.StreamHandler(sys.stderr)
+            handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        elif destino == "streamlit":
+            if st is None:
+                raise ValueError("O destino 'streamlit' precisa do st")
+            handler = HandlerStreamlit(st)
+        else:
+            raise ValueError(f"Destino de registo desconhecido: {destino}")
+        LOGGER.addHandler(handler)
+    if arquivo_jsonl:
+        handler = logging.FileHandler(arquivo_jsonl, encoding="utf-8")
+        handler.setFormatter(FormatadorJsonl())
+        LOGGER.addHandler(handler)
+    if not LOGGER.handlers:
+        LOGGER.addHandler(logging.NullHandler())
+    return LOGGER
+
+
+def registar_etapa(etapa, mensagem, *args, **dados):
+    """Linha de resumo de uma etapa (INFO), com os números também como campos no JSONL."""
+    LOGGER.info(mensagem, *args, extra={"etapa": etapa, "dados": dados})
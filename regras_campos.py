@@ -0,0 +1,139 @@
+import os
+import re
+import time
+
+import pandas as pd
+import yaml
+
+ARQUIVO_REGRAS_CAMPOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regras_campos.yaml")
+
+# Chaves da regra que não são colunas do survey
+CHAVES_ESPECIAIS = {"nota", "rotulo"}
+PADRAO_MARCADOR = re.compile(r"\{(nome|prefixo|sufixo)\}")
+
+_cache_regras = {}
+
+
+def compilar_regras_campos(dados, origem="regras_campos.yaml"):
+    """
+    Compila as regras de campos (já lidas do YAML) em tabelas de consulta.
+
+    Parâmetros:
+        dados (dict): {'exatos': {nome: regra}, 'sufixos': {sufixo: regra}}
+        origem (str): nome do arquivo, para as mensagens de erro
+
+    Retorna:
+        dict: exatos e sufixos (dicionários) e os comprimentos de sufixo distintos,
+              do maior para o menor, para procurar cada nome só por hash
+    """
+    dados = dados or {}
+    desconhecidas = set(dados) - {"exatos", "sufixos"}
+    if desconhecidas:
+        raise ValueError(f"O arquivo {origem} só pode ter as secções 'exatos' e 'sufixos' (encontrado: {', '.join(sorted(desconhecidas))})")
+
+    compiladas = {}
+    for seccao in ("exatos", "sufixos"):
+        regras = {}
+        for chave, regra in (dados.get(seccao) or {}).items():
+            if not isinstance(regra, dict) or not regra:
+                raise ValueError(f"Regra '{chave}' em '{seccao}' do arquivo {origem} deve ser um mapa coluna: valor")
+            regras[str(chave).strip()] = {str(col): "" if valor is None else str(valor) for col, valor in regra.items()}
+        compiladas[seccao] = regras
+
+    compiladas["comprimentos"] = sorted({len(sufixo) for sufixo in compiladas["sufixos"]}, reverse=True)
+    return compiladas
+
+
+def carregar_regras_campos(caminho=ARQUIVO_REGRAS_CAMPOS):
+    """Lê e compila o arquivo de regras (uma só vez por versão do arquivo)."""
+    chave = (caminho, os.path.getmtime(caminho))
+    if chave in _cache_regras:
+        return _cache_regras[chave]
+
+    with open(caminho, encoding="utf-8") as f:
+        regras = compilar_regras_campos(yaml.safe_load(f), os.path.basename(caminho))
+
+    _cache_regras.clear()
+    _cache_regras[chave] = regras
+    return regras
+
+
+def _preencher(valor, nome, sufixo):
+    partes = {"nome": nome, "sufixo": sufixo, "prefixo": nome[:len(nome) - len(sufixo)]}
+    return PADRAO_MARCADOR.sub(lambda m: partes[m.group(1)], valor)
+
+
+def aplicar_regras_campos(df, regras):
+    """
+    Aplica as regras de campos numa única passagem pelos nomes do survey.
+
+    Cada nome é procurado no dicionário de regras exatas e, para cada
+    comprimento de sufixo existente, no dicionário de sufixos; uma regra de
+    sufixo só se aplica à primeira variável que termina com ele. As escritas
+    são juntadas por coluna e feitas de uma vez; as notas são inseridas logo
+    abaixo da variável.
+
+    O tempo de cada regra é o da sua aplicação, mais a parte das escritas por
+    coluna proporcional às células que escreveu e uma parte igual da passagem
+    pelos nomes (as consultas custam o mesmo para todas as regras).
+
+    Retorna:
+        tuple: (DataFrame, {('exatos'|'sufixos', chave): {"nomes": [...], "colunas": [...], "segundos": float}})
+            com uma entrada por regra, mesmo as que não correspondem a nenhuma variável
+    """
+    inicio_total = time.perf_counter()
+    df = df.copy()
+    exatos, sufixos, comprimentos = regras["exatos"], regras["sufixos"], regras["comprimentos"]
+    aplicadas = {
+        (seccao, chave): {"nomes": [], "colunas": [c for c in regra if c not in CHAVES_ESPECIAIS], "segundos": 0.0}
+        for seccao in ("exatos", "sufixos") for chave, regra in regras[seccao].items()
+    }
+    escritas = {}  # coluna -> {índice: valor}
+    autores = {}   # coluna -> {índice: regra que escreveu o valor final}
+    notas = []
+
+    for idx, nome in df["name"].items():
+        if not isinstance(nome, str):
+            continue
+        aplicar = []
+        for n in comprimentos:
+            sufixo = nome[-n:]
+            if len(nome) >= n and sufixo in sufixos and not aplicadas[("sufixos", sufixo)]["nomes"]:
+                aplicar.append(("sufixos", sufixo, sufixos[sufixo]))
+        if nome in exatos:
+            aplicar.append(("exatos", nome, exatos[nome]))  # por último: o nome exato prevalece
+
+        for seccao, chave, regra in aplicar:
+            inicio = time.perf_counter()
+            aplicada = aplicadas[(seccao, chave)]
+            aplicada["nomes"].append(nome)
+            sufixo = chave if seccao == "sufixos" else ""
+            for coluna in aplicada["colunas"]:
+                escritas.setdefault(coluna, {})[idx] = _preencher(regra[coluna], nome, sufixo)
+                autores.setdefault(coluna, {})[idx] = (seccao, chave)
+            if "nota" in regra:
+                notas.append((idx + 0.5, {
+                    "type": "note",
+                    "name": f"show_aux_{chave}",
+                    "label::Portugues (pt)": _preencher(regra["nota"], nome, sufixo),
+                    "required": "false"
+                }))
+            aplicada["segundos"] += time.perf_counter() - inicio
+
+    tempo_regras = sum(aplicada["segundos"] for aplicada in aplicadas.values())
+    passagem = time.perf_counter() - inicio_total - tempo_regras
+    for coluna, valores in escritas.items():
+        inicio = time.perf_counter()
+        if coluna not in df.columns:
+            df[coluna] = ""
+        df.loc[list(valores), coluna] = list(valores.values())
+        por_celula = (time.perf_counter() - inicio) / len(valores)
+        for regra in autores[coluna].values():
+            aplicadas[regra]["segundos"] += por_celula
+    for aplicada in aplicadas.values():
+        aplicada["segundos"] += passagem / max(1, len(aplicadas))
+
+    if notas:
+        linhas_notas = pd.DataFrame([linha for _, linha in notas], index=[pos for pos, _ in notas])
+        df = pd.concat([df, linhas_notas]).sort_index()
+    return df.reset_index(drop=True), aplicadas
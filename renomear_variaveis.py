@@ -0,0 +1,113 @@
+import re
+
+import pandas as pd
+
+# Um único padrão para todas as referências; o novo nome sai de um dicionário,
+# por isso o custo não depende do número de entradas do mapa
+PADRAO_REFERENCIA = re.compile(r"\$\{([^}]+)\}")
+PADRAO_NOME_VALIDO = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def expandir_mapa(nomes, regras):
+    """
+    Transforma regras de renomeação num mapa nome antigo -> nome novo.
+
+    Uma regra 'QEA_*' -> 'QEE_*' troca o prefixo de todos os nomes que
+    começam por 'QEA_'; as restantes regras são nomes exatos.
+
+    Parâmetros:
+        nomes (iterable): nomes existentes no formulário
+        regras (dict): {antigo: novo}
+
+    Retorna:
+        dict: {nome_antigo: nome_novo}
+    """
+    mapa = {}
+    prefixos = []
+    for antigo, novo in regras.items():
+        antigo, novo = str(antigo).strip(), str(novo).strip()
+        if antigo.endswith("*") and novo.endswith("*"):
+            prefixos.append((antigo[:-1], novo[:-1]))
+        elif antigo and antigo != novo:
+            mapa[antigo] = novo
+    if prefixos:
+        for nome in nomes:
+            if nome in mapa:
+                continue
+            for antigo, novo in prefixos:
+                if nome.startswith(antigo):
+                    mapa[nome] = novo + nome[len(antigo):]
+                    break
+    return mapa
+
+
+def verificar_colisoes(nomes, mapa):
+    """
+    Lista os problemas que impedem a renomeação: nomes novos repetidos,
+    nomes novos que já existem e não são renomeados, e nomes inválidos.
+    """
+    existentes = set(nomes)
+    problemas = []
+    destinos = {}
+    for antigo, novo in mapa.items():
+        if not PADRAO_NOME_VALIDO.match(novo):
+            problemas.append(f"'{antigo}' -> '{novo}': nome inválido")
+        if novo in destinos:
+            problemas.append(f"'{antigo}' e '{destinos[novo]}' seriam ambos renomeados para '{novo}'")
+        destinos[novo] = antigo
+        if novo in existentes and novo not in mapa:
+            problemas.append(f"'{antigo}' -> '{novo}': já existe uma variável com esse nome")
+    return problemas
+
+
+def renomear_variaveis(survey, regras, colunas_ignoradas=("type",)):
+    """
+    Renomeia variáveis e reescreve todas as referências ${...} numa só passagem.
+
+    São alteradas a coluna 'name' (incluindo nomes de grupos) e todas as
+    colunas de texto do survey (labels, hints, relevant, calculation,
+    constraint, choice_filter, ...). A renomeação é recusada se criar colisões.
+
+    Retorna:
+        tuple: (survey renomeado, número de células alteradas)
+    """
+    nomes = survey["name"].dropna().astype(str).str.strip()
+    mapa = expandir_mapa(nomes.unique(), regras)
+    if not mapa:
+        return survey, 0
+
+    problemas = verificar_colisoes(nomes.unique(), mapa)
+    if problemas:
+        raise ValueError("Renomeação recusada:\n" + "\n".join(problemas))
+
+    def substituir(match):
+        nome = match.group(1)
+        novo = mapa.get(nome.strip())
+        return f"${{{novo}}}" if novo else match.group(0)
+
+    survey = survey.copy()
+    alteradas = 0
+    for col in survey.columns:
+        if col in colunas_ignoradas or pd.api.types.is_numeric_dtype(survey[col]):
+            continue
+        preenchidas = survey[col].map(lambda v: isinstance(v, str))
+        originais = survey.loc[preenchidas, col]
+        if col == "name":
+            novos = originais.map(lambda nome: mapa.get(nome.strip(), nome))
+        else:
+            com_referencias = originais.str.contains("${", regex=False)
+            novos = originais.copy()
+            novos[com_referencias] = originais[com_referencias].str.replace(PADRAO_REFERENCIA, substituir, regex=True)
+        alteradas += int((novos != originais).sum())
+        survey.loc[preenchidas, col] = novos
+    return survey, alteradas
+
+
+def ler_regras_renomeacao(arquivo):
+    """Lê um Excel com as colunas 'antigo' e 'novo' para {antigo: novo}."""
+    regras_df = pd.read_excel(arquivo)
+    regras_df.columns = regras_df.columns.str.strip().str.lower()
+    if not {"antigo", "novo"}.issubset(regras_df.columns):
+        raise ValueError("O arquivo de renomeação deve conter as colunas: antigo, novo")
+    regras_df = regras_df.dropna(subset=["antigo", "novo"])
+    return dict(zip(regras_df["antigo"].astype(str), regras_df["novo"].astype(str)))
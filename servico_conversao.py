@@ -0,0 +1,365 @@
+import argparse
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib import request as urllib_request
+from urllib.error import HTTPError
+
+from empacotamento import e_pacote
+from opcoes_conversao import validar_max_termos
+from tarefas_conversao import ColetorMensagens, coletar_mensagens
+
+PASTA_CONVERSOR = os.path.dirname(os.path.abspath(__file__))
+PORTA_PADRAO = 8765
+MAX_PEDIDO_MB = 200
+
+# Tabelas de regras lidas pelo conversor: entram na chave da cache de resultados
+ARQUIVOS_REGRAS = ("regex.xlsx", "selects.xlsx", "relevante.xlsx", "Choices.xlsx",
+                   "regras_campos.yaml", "limpeza_labels.xlsx")
+ARQUIVOS_OBRIGATORIOS = ("dados", "grupos", "padroes")
+OPCOES_PERMITIDAS = {
+    "deduplicar_choices", "limite_csv_externo", "subtotais_hierarquicos", "max_termos_soma",
+    "elevar_relevants", "limites_desempenho", "max_perguntas_pagina", "max_custo_pagina",
+    "dividir_por", "limpar_labels_regras", "renomear", "max_px_imagem", "tamanho_alvo_imagem_kb",
+    "abas", "prefixos", "bloquear_regex_caros", "form_id", "form_title"
+}
+
+
+class FilaCheia(Exception):
+    """O serviço já tem o máximo de conversões à espera."""
+
+    def __init__(self, segundos=5):
+        super().__init__(f"Fila de conversões cheia; tente de novo dentro de {segundos} s")
+        self.segundos = segundos
+
+
+def _aquecer(pasta):
+    """
+    Inicializa um processo do serviço: carrega pandas e o conversor e lê as
+    tabelas de regras uma vez, para que cada conversão comece já com tudo em memória.
+    """
+    os.chdir(pasta)
+    import conversor
+    from limpeza_labels import carregar_regras_limpeza
+
+    for arquivo in ("regex.xlsx", "selects.xlsx", "relevante.xlsx"):
+        conversor.ler_tabela_regras(arquivo)
+    conversor.ler_tabela_regras("Choices.xlsx", sheet_name="choices")
+    conversor.carregar_regras_campos()
+    carregar_regras_limpeza()
+
+
+def _pronto():
+    return os.getpid()
+
+
+def _executar(pedido):
+    """Corre uma conversão num processo do serviço (o pedido vem já validado)."""
+    import yaml
+
+    import conversor
+
+    coletor = ColetorMensagens()
+    arquivos = {nome: base64.b64decode(valor) for nome, valor in pedido["arquivos"].items()}
+    anexos = {nome: base64.b64decode(valor) for nome, valor in (pedido.get("anexos") or {}).items()}
+    try:
+        with coletar_mensagens(coletor):
+            regras_campos = None
+            if "regras_campos" in arquivos:
+                regras_campos = conversor.compilar_regras_campos(yaml.safe_load(arquivos["regras_campos"]))
+            resultado = conversor.convert_to_xlsform(
+                BytesIO(arquivos["dados"]), BytesIO(arquivos["grupos"]), BytesIO(arquivos["padroes"]),
+                anexos=anexos, regras_campos=regras_campos, **(pedido.get("opcoes") or {})
+            )
+        if resultado is None:
+            raise ValueError("Nenhuma planilha do arquivo de dados pôde ser processada")
+        return {"resultado": resultado.getvalue(), "erro": None, "mensagens": coletor.mensagens(),
+                "chamadas": coletor.serializar()}
+    except Exception as e:
+        return {"resultado": None, "erro": str(e), "mensagens": coletor.mensagens(), "chamadas": coletor.serializar()}
+
+
+def _impressao_regras(pasta):
+    """Identifica a versão das tabelas de regras (caminho, tamanho e data de cada uma)."""
+    partes = []
+    for arquivo in ARQUIVOS_REGRAS:
+        caminho = os.path.join(pasta, arquivo)
+        if os.path.exists(caminho):
+            info = os.stat(caminho)
+            partes.append(f"{arquivo}:{info.st_size}:{info.st_mtime_ns}")
+    return "|".join(partes)
+
+
+def validar_pedido(pedido):
+    """Confirma que o pedido tem os arquivos obrigatórios e só opções conhecidas."""
+    if not isinstance(pedido, dict):
+        raise ValueError("O pedido deve ser um objeto JSON")
+    arquivos = pedido.get("arquivos") or {}
+    em_falta = [nome for nome in ARQUIVOS_OBRIGATORIOS if nome not in arquivos]
+    if em_falta:
+        raise ValueError(f"Arquivos em falta no pedido: {', '.join(em_falta)}")
+    desconhecidas = set(pedido.get("opcoes") or {}) - OPCOES_PERMITIDAS
+    if desconhecidas:
+        raise ValueError(f"Opções desconhecidas: {', '.join(sorted(desconhecidas))}")
+    # Com 1 termo por soma parcial a divisão nunca termina e prenderia um processo do pool
+    validar_max_termos((pedido.get("opcoes") or {}).get("max_termos_soma"))
+
+
+class ServicoConversao:
+    """
+    Conversões num pool de processos já aquecidos, com uma fila limitada à
+    frente e uma cache dos resultados recentes.
+
+    Parâmetros:
+        processos (int): processos de conversão (por omissão, um por CPU)
+        fila_maxima (int): conversões à espera ou a correr antes de recusar pedidos
+        cache_maxima (int): resultados guardados para pedidos repetidos
+        pasta (str): pasta com as tabelas de regras do conversor
+    """
+
+    def __init__(self, processos=None, fila_maxima=8, cache_maxima=32, pasta=PASTA_CONVERSOR):
+        self.processos = processos or os.cpu_count() or 1
+        self.fila_maxima = fila_maxima
+        self.cache_maxima = cache_maxima
+        self.pasta = pasta
+        self.executor = ProcessPoolExecutor(max_workers=self.processos, initializer=_aquecer, initargs=(pasta,))
+        # Arrancar já todos os processos, para o primeiro pedido não pagar o arranque
+        for futuro in [self.executor.submit(_pronto) for _ in range(self.processos)]:
+            futuro.result()
+
+        self._lock = threading.Lock()
+        self._trabalhos = OrderedDict()  # id -> estado do trabalho
+        self._em_curso = {}  # chave do pedido -> id
+        self._cache = OrderedDict()  # chave do pedido -> resultado de _executar
+
+    def _chave(self, pedido):
+        conteudo = json.dumps(pedido, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(conteudo + _impressao_regras(self.pasta).encode("utf-8")).hexdigest()
+
+    def _novo_trabalho(self, chave, estado):
+        id_trabalho = uuid.uuid4().hex
+        self._trabalhos[id_trabalho] = {"id": id_trabalho, "chave": chave, "estado": estado,
+                                        "criado": time.time(), "segundos": None, "em_cache": False}
+        while len(self._trabalhos) > 4 * self.cache_maxima:
+            antigo_id, antigo = next(iter(self._trabalhos.items()))
+            if antigo["estado"] not in ("concluido", "erro"):
+                break
+            del self._trabalhos[antigo_id]
+        return self._trabalhos[id_trabalho]
+
+    def submeter(self, pedido):
+        """
+        Põe um pedido na fila, ou responde logo com a cache.
+
+        Retorna:
+            dict: estado do trabalho (id, estado, ...)
+        """
+        validar_pedido(pedido)
+        chave = self._chave(pedido)
+        with self._lock:
+            if chave in self._cache:
+                self._cache.move_to_end(chave)
+                trabalho = self._novo_trabalho(chave, "concluido")
+                trabalho.update(segundos=0.0, em_cache=True)
+                return self.estado(trabalho["id"])
+            if chave in self._em_curso:
+                return self.estado(self._em_curso[chave])
+            if len(self._em_curso) >= self.fila_maxima:
+                raise FilaCheia()
+
+            trabalho = self._novo_trabalho(chave, "na_fila")
+            self._em_curso[chave] = trabalho["id"]
+            futuro = self.executor.submit(_executar, pedido)
+            trabalho["futuro"] = futuro
+        futuro.add_done_callback(lambda f, t=trabalho: self._concluir(t, f))
+        return self.estado(trabalho["id"])
+
+    def _concluir(self, trabalho, futuro):
+        try:
+            resultado = futuro.result()
+        except Exception as e:  # processo morto, pedido não serializável, ...
+            resultado = {"resultado": None, "erro": str(e), "mensagens": [], "chamadas": []}
+        with self._lock:
+            self._em_curso.pop(trabalho["chave"], None)
+            trabalho["segundos"] = round(time.time() - trabalho["criado"], 3)
+            if resultado["erro"]:
+                trabalho.update(estado="erro", erro=resultado["erro"], mensagens=resultado["mensagens"],
+                                chamadas=resultado["chamadas"])
+                return
+            trabalho["estado"] = "concluido"
+            self._cache[trabalho["chave"]] = resultado
+            while len(self._cache) > self.cache_maxima:
+                self._cache.popitem(last=False)
+
+    def estado(self, id_trabalho):
+        """Estado público de um trabalho, ou None se não existir."""
+        trabalho = self._trabalhos.get(id_trabalho)
+        if trabalho is None:
+            return None
+        resultado = self._cache.get(trabalho["chave"]) if trabalho["estado"] == "concluido" else None
+        estado = trabalho["estado"]
+        if estado == "na_fila" and trabalho["futuro"].running():
+            estado = "a_converter"
+        return {
+            "id": trabalho["id"],
+            "estado": estado,
+            "segundos": trabalho["segundos"],
+            "em_cache": trabalho["em_cache"],
+            "erro": trabalho.get("erro"),
+            "mensagens": resultado["mensagens"] if resultado else trabalho.get("mensagens", []),
+            # Todas as chamadas st.* (tabelas e downloads incluídos), só quando a conversão terminou
+            "chamadas": resultado["chamadas"] if resultado else trabalho.get("chamadas", [])
+        }
+
+    def resultado(self, id_trabalho):
+        """Bytes do XLSForm (ou ZIP) de um trabalho concluído; None se não houver."""
+        trabalho = self._trabalhos.get(id_trabalho)
+        if trabalho is None or trabalho["estado"] != "concluido":
+            return None
+        resultado = self._cache.get(trabalho["chave"])
+        return resultado["resultado"] if resultado else None
+
+    def resumo(self):
+        return {"processos": self.processos, "em_curso": len(self._em_curso),
+                "fila_maxima": self.fila_maxima, "resultados_em_cache": len(self._cache)}
+
+    def fechar(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+def criar_handler(servico):
+    """Handler HTTP com os endpoints do serviço."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _responder_json(self, codigo, corpo, cabecalhos=None):
+            dados = json.dumps(corpo, ensure_ascii=False).encode("utf-8")
+            self.send_response(codigo)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(dados)))
+            for nome, valor in (cabecalhos or {}).items():
+                self.send_header(nome, valor)
+            self.end_headers()
+            self.wfile.write(dados)
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/conversoes":
+                return self._responder_json(404, {"erro": "Endpoint desconhecido"})
+            tamanho = int(self.headers.get("Content-Length") or 0)
+            if tamanho > MAX_PEDIDO_MB * 1024 * 1024:
+                return self._responder_json(413, {"erro": f"Pedido maior que {MAX_PEDIDO_MB} MB"})
+            try:
+                pedido = json.loads(self.rfile.read(tamanho))
+                estado = servico.submeter(pedido)
+            except FilaCheia as e:
+                return self._responder_json(429, {"erro": str(e)}, {"Retry-After": str(e.segundos)})
+            except ValueError as e:
+                return self._responder_json(400, {"erro": str(e)})
+            self._responder_json(200 if estado["estado"] == "concluido" else 202, estado)
+
+        def do_GET(self):
+            partes = [p for p in self.path.split("/") if p]
+            if partes == ["estado"]:
+                return self._responder_json(200, servico.resumo())
+            if len(partes) < 2 or partes[0] != "conversoes":
+                return self._responder_json(404, {"erro": "Endpoint desconhecido"})
+
+            estado = servico.estado(partes[1])
+            if estado is None:
+                return self._responder_json(404, {"erro": "Conversão desconhecida"})
+            if len(partes) == 2:
+                return self._responder_json(200, estado)
+            if partes[2:] != ["resultado"]:
+                return self._responder_json(404, {"erro": "Endpoint desconhecido"})
+
+            dados = servico.resultado(partes[1])
+            if dados is None:
+                return self._responder_json(409, {"erro": f"Conversão em estado '{estado['estado']}'"})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip" if e_pacote(dados) else
+                             "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            self.send_header("Content-Length", str(len(dados)))
+            self.end_headers()
+            self.wfile.write(dados)
+
+        def log_message(self, formato, *args):
+            pass
+
+    return Handler
+
+
+# ---------------------------------------------------------------------------
+# Cliente (usado pela página Streamlit)
+
+def _pedido_http(url, metodo="GET", corpo=None, tempo_limite=30):
+    dados = json.dumps(corpo).encode("utf-8") if corpo is not None else None
+    pedido = urllib_request.Request(url, data=dados, method=metodo,
+                                    headers={"Content-Type": "application/json"} if dados else {})
+    try:
+        with urllib_request.urlopen(pedido, timeout=tempo_limite) as resposta:
+            return resposta.read()
+    except HTTPError as e:
+        if e.code == 429:
+            raise FilaCheia(int(e.headers.get("Retry-After") or 5))
+        try:
+            mensagem = json.loads(e.read()).get("erro")
+        except ValueError:
+            mensagem = None
+        raise ValueError(mensagem or f"Erro {e.code} do serviço de conversão")
+
+
+def enviar_conversao(url, arquivos, anexos=None, opcoes=None):
+    """
+    Envia uma conversão ao serviço.
+
+    Parâmetros:
+        url (str): endereço do serviço (ex: http://127.0.0.1:8765)
+        arquivos (dict): bytes de 'dados', 'grupos', 'padroes' e opcionalmente 'regras_campos'
+        anexos (dict): {nome_arquivo: bytes}
+        opcoes (dict): argumentos de convert_to_xlsform
+
+    Retorna:
+        dict: estado do trabalho
+    """
+    corpo = {
+        "arquivos": {nome: base64.b64encode(valor).decode("ascii") for nome, valor in arquivos.items()},
+        "anexos": {nome: base64.b64encode(valor).decode("ascii") for nome, valor in (anexos or {}).items()},
+        "opcoes": opcoes or {}
+    }
+    return json.loads(_pedido_http(f"{url.rstrip('/')}/conversoes", "POST", corpo, tempo_limite=120))
+
+
+def estado_conversao(url, id_trabalho):
+    return json.loads(_pedido_http(f"{url.rstrip('/')}/conversoes/{id_trabalho}"))
+
+
+def baixar_resultado(url, id_trabalho):
+    return _pedido_http(f"{url.rstrip('/')}/conversoes/{id_trabalho}/resultado", tempo_limite=120)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serviço local de conversão para XLSForm")
+    parser.add_argument("--porta", type=int, default=PORTA_PADRAO)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--processos", type=int, default=None, help="Processos de conversão (por omissão, um por CPU)")
+    parser.add_argument("--fila", type=int, default=8, help="Conversões em curso antes de recusar pedidos")
+    parser.add_argument("--cache", type=int, default=32, help="Resultados guardados para pedidos repetidos")
+    args = parser.parse_args()
+
+    servico = ServicoConversao(args.processos, args.fila, args.cache)
+    servidor = ThreadingHTTPServer((args.host, args.porta), criar_handler(servico))
+    print(f"Serviço de conversão em http://{args.host}:{args.porta} ({servico.processos} processos)")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        servico.fechar()
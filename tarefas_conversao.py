@@ -0,0 +1,214 @@
+import base64
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from io import BytesIO, StringIO
+
+import pandas as pd
+
+NIVEIS_TEXTO = ("write", "info", "success", "warning", "error")
+# Marca, nas chamadas guardadas, o fim do bloco de um st.expander
+FIM_EXPANDER = "_fim_expander"
+
+_local = threading.local()
+
+
+class ConversaoInterrompida(Exception):
+    """A conversão chamou st.stop() (ex: nomes de variáveis inválidos)."""
+
+
+class ConversaoCancelada(Exception):
+    """O utilizador cancelou a conversão."""
+
+
+def _para_json(valor):
+    """Converte um argumento de uma chamada st.* em JSON (tabelas e bytes marcados)."""
+    if isinstance(valor, pd.DataFrame):
+        return {"__dataframe__": valor.to_json(orient="split", date_format="iso", default_handler=str)}
+    if isinstance(valor, BytesIO):
+        valor = valor.getvalue()
+    if isinstance(valor, bytes):
+        return {"__bytes__": base64.b64encode(valor).decode("ascii")}
+    if isinstance(valor, (list, tuple)):
+        return [_para_json(v) for v in valor]
+    if isinstance(valor, dict):
+        return {str(chave): _para_json(v) for chave, v in valor.items()}
+    if valor is None or isinstance(valor, (str, int, float, bool)):
+        return valor
+    if hasattr(valor, "item"):  # escalares numpy
+        return valor.item()
+    return str(valor)
+
+
+def _de_json(valor):
+    if isinstance(valor, dict):
+        if "__dataframe__" in valor:
+            return pd.read_json(StringIO(valor["__dataframe__"]), orient="split", dtype=False, convert_dates=False)
+        if "__bytes__" in valor:
+            return base64.b64decode(valor["__bytes__"])
+        return {chave: _de_json(v) for chave, v in valor.items()}
+    if isinstance(valor, list):
+        return [_de_json(v) for v in valor]
+    return valor
+
+
+class ColetorMensagens:
+    """
+    Guarda as chamadas st.* feitas fora da página (tarefa em segundo plano ou
+    processo do serviço) para as mostrar depois; st.stop() passa a ser um erro.
+    """
+
+    def __init__(self):
+        self.chamadas = []
+
+    def __getattr__(self, nome):
+        if nome.startswith("_"):
+            raise AttributeError(nome)
+
+        def guardar(*args, **kwargs):
+            self.chamadas.append((nome, args, kwargs))
+        return guardar
+
+    def stop(self):
+        raise ConversaoInterrompida("Conversão interrompida")
+
+    @contextmanager
+    def expander(self, *args, **kwargs):
+        # Guarda a abertura e o fecho, para as chamadas do bloco voltarem a ficar dentro do expander
+        self.chamadas.append(("expander", args, kwargs))
+        try:
+            yield self
+        finally:
+            self.chamadas.append((FIM_EXPANDER, (), {}))
+
+    def spinner(self, *args, **kwargs):
+        return nullcontext()
+
+    def empty(self):
+        return self
+
+    def mensagens(self):
+        """Só as mensagens de texto, como [(nível, texto)]."""
+        return [(nome, str(args[0]) if args else "") for nome, args, _ in list(self.chamadas) if nome in NIVEIS_TEXTO]
+
+    def serializar(self):
+        """Todas as chamadas em JSON, para o serviço as devolver ao cliente."""
+        return [[nome, _para_json(list(args)), _para_json(kwargs)] for nome, args, kwargs in list(self.chamadas)]
+
+    @classmethod
+    def de_serializado(cls, chamadas):
+        """Coletor com as chamadas devolvidas por serializar(), pronto para reproduzir()."""
+        coletor = cls()
+        coletor.chamadas = [(nome, tuple(_de_json(args)), _de_json(kwargs)) for nome, args, kwargs in chamadas]
+        return coletor
+
+    def reproduzir(self, st):
+        """
+        Mostra na página todas as chamadas guardadas (mensagens, tabelas, botões
+        de download), com as feitas num st.expander dentro do mesmo expander.
+        """
+        abertos = []  # expanders abertos (uma tarefa ainda a correr pode ter um por fechar)
+        try:
+            for nome, args, kwargs in list(self.chamadas):
+                if nome == "expander":
+                    expander = st.expander(*args, **kwargs)
+                    expander.__enter__()
+                    abertos.append(expander)
+                elif nome == FIM_EXPANDER:
+                    if abertos:
+                        abertos.pop().__exit__(None, None, None)
+                else:
+                    if isinstance(kwargs.get("data"), BytesIO):
+                        kwargs = {**kwargs, "data": kwargs["data"].getvalue()}
+                    getattr(st, nome)(*args, **kwargs)
+        finally:
+            while abertos:
+                abertos.pop().__exit__(None, None, None)
+
+
+class SaidaStreamlit:
+    """
+    Substitui o módulo streamlit no conversor: as chamadas vão para o coletor
+    ativo na thread atual, se houver, ou para o streamlit.
+    """
+
+    def __init__(self, st):
+        self._st = st
+
+    def __getattr__(self, nome):
+        coletor = getattr(_local, "coletor", None)
+        return getattr(coletor if coletor is not None else self._st, nome)
+
+
+@contextmanager
+def coletar_mensagens(coletor):
+    """Enquanto ativo, as chamadas st.* do conversor nesta thread vão para o coletor."""
+    anterior = getattr(_local, "coletor", None)
+    _local.coletor = coletor
+    try:
+        yield coletor
+    finally:
+        _local.coletor = anterior
+
+
+class TarefaConversao:
+    """
+    Conversão numa thread em segundo plano, guardada em st.session_state para
+    sobreviver aos reruns da página.
+
+    A função recebe o argumento 'progresso(etapa, fracao)', que atualiza a
+    etapa mostrada e interrompe a conversão quando foi pedido o cancelamento.
+
+    Parâmetros:
+        funcao (callable): convert_to_xlsform ou converter_no_servico
+        assinatura (str): identifica as entradas; outra assinatura é outra tarefa
+    """
+
+    def __init__(self, funcao, *args, assinatura=None, **kwargs):
+        self.assinatura = assinatura
+        self.coletor = ColetorMensagens()
+        self.estado = "a_correr"
+        self.etapa = "A iniciar"
+        self.fracao = 0.0
+        self.resultado = None
+        self.erro = None
+        self.inicio = time.time()
+        self.fim = None
+        self._cancelar = threading.Event()
+        self._thread = threading.Thread(target=self._correr, args=(funcao, args, kwargs), daemon=True)
+        self._thread.start()
+
+    def _progresso(self, etapa, fracao=None):
+        if self._cancelar.is_set():
+            raise ConversaoCancelada()
+        self.etapa = etapa
+        if fracao is not None:
+            self.fracao = min(max(fracao, 0.0), 1.0)
+
+    def _correr(self, funcao, args, kwargs):
+        with coletar_mensagens(self.coletor):
+            try:
+                resultado = funcao(*args, progresso=self._progresso, **kwargs)
+                if resultado is None:
+                    self.estado, self.erro = "erro", "A conversão não produziu nenhum formulário"
+                else:
+                    self.resultado = resultado.getvalue()
+                    self.estado, self.fracao = "concluida", 1.0
+            except ConversaoCancelada:
+                self.estado = "cancelada"
+            except Exception as e:
+                self.estado, self.erro = "erro", str(e)
+            finally:
+                self.fim = time.time()
+
+    @property
+    def a_correr(self):
+        return self.estado == "a_correr"
+
+    @property
+    def segundos(self):
+        return (self.fim or time.time()) - self.inicio
+
+    def cancelar(self):
+        """Pede o cancelamento; a conversão para na próxima etapa."""
+        self._cancelar.set()
@@ -0,0 +1,209 @@
+import re
+import time
+
+import pandas as pd
+
+from renomear_variaveis import PADRAO_REFERENCIA
+
+TIPOS_SIMPLES = {
+    "integer", "decimal", "range", "text", "note", "geopoint", "geotrace", "geoshape", "date", "time",
+    "dateTime", "image", "audio", "background-audio", "video", "file", "barcode", "calculate",
+    "acknowledge", "hidden", "xml-external", "csv-external", "start", "end", "today", "deviceid",
+    "subscriberid", "simserial", "phonenumber", "username", "email", "audit", "start-geopoint",
+    "begin_group", "end_group", "begin_repeat", "end_repeat"
+}
+TIPOS_COM_LISTA = {"select_one", "select_multiple", "rank"}
+TIPOS_COM_ARQUIVO = {"select_one_from_file", "select_multiple_from_file"}
+# Colunas do survey onde ${...} tem de apontar para uma variável existente
+COLUNAS_COM_REFERENCIAS = ["relevant", "calculation", "constraint", "choice_filter", "required", "read_only",
+                           "repeat_count", "default", "trigger"]
+PADRAO_NOME_XML = re.compile(r"^[A-Za-z_][A-Za-z0-9_.\-]*$")
+PADRAO_FORM_ID = re.compile(r"^[A-Za-z_][A-Za-z0-9_.\-]*$")
+
+
+def _texto(valor):
+    if valor is None or (not isinstance(valor, str) and pd.isna(valor)):
+        return ""
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor).strip()
+
+
+def _problema(aba, linha, nome, erro, severidade="erro"):
+    return {"aba": aba, "linha": linha, "name": nome, "erro": erro, "severidade": severidade}
+
+
+def validar_xlsform(survey, choices, settings, media=None):
+    """
+    Valida o XLSForm sem o enviar ao servidor.
+
+    Uma só passagem pelo survey recolhe os nomes, as listas usadas, os grupos
+    abertos e as referências ${...}; as verificações que dependem do conjunto
+    (listas inexistentes, referências soltas) são feitas no fim contra esses índices.
+
+    Parâmetros:
+        survey, choices, settings (pd.DataFrame): abas do formulário
+        media (dict): arquivos que acompanham o formulário (CSVs de select_*_from_file)
+
+    Retorna:
+        dict: {"erros": [...], "avisos": [...], "segundos": float}
+    """
+    inicio = time.perf_counter()
+    problemas = []
+
+    colunas = list(survey.columns)
+    for obrigatoria in ("type", "name"):
+        if obrigatoria not in colunas:
+            problemas.append(_problema("survey", None, "", f"Coluna '{obrigatoria}' em falta"))
+    if problemas:
+        return _resultado(problemas, inicio)
+    colunas_labels = [c for c in colunas if c == "label" or str(c).startswith("label::")]
+    colunas_refs = [c for c in colunas if c in COLUNAS_COM_REFERENCIAS or c in colunas_labels
+                    or str(c).startswith(("hint", "constraint_message", "required_message"))]
+    i_tipo, i_nome = colunas.index("type"), colunas.index("name")
+    i_calculo = colunas.index("calculation") if "calculation" in colunas else None
+    i_refs = [(colunas.index(c), c) for c in colunas_refs]
+
+    nomes = {}             # name -> primeira linha
+    listas_usadas = {}     # list_name -> primeira linha
+    arquivos_usados = {}   # arquivo -> primeira linha
+    referencias = []       # (linha, name, coluna, referência)
+    pilha = []             # (tipo de fecho esperado, linha, name)
+
+    for pos, valores in enumerate(survey.itertuples(index=False, name=None)):
+        linha = pos + 2
+        tipo, nome = _texto(valores[i_tipo]), _texto(valores[i_nome])
+        if not tipo:
+            if nome:
+                problemas.append(_problema("survey", linha, nome, "Linha sem 'type'"))
+            continue
+        partes = tipo.split()
+        base = partes[0]
+
+        if base in TIPOS_COM_LISTA:
+            if len(partes) < 2:
+                problemas.append(_problema("survey", linha, nome, f"'{tipo}' sem o nome da lista"))
+            else:
+                listas_usadas.setdefault(partes[1], linha)
+        elif base in TIPOS_COM_ARQUIVO:
+            if len(partes) < 2:
+                problemas.append(_problema("survey", linha, nome, f"'{tipo}' sem o nome do arquivo"))
+            else:
+                arquivos_usados.setdefault(partes[1], linha)
+        elif base not in TIPOS_SIMPLES or len(partes) > 1:
+            problemas.append(_problema("survey", linha, nome, f"Tipo desconhecido '{tipo}'"))
+
+        if base in ("begin_group", "begin_repeat"):
+            pilha.append((base.replace("begin_", "end_"), linha, nome))
+        elif base in ("end_group", "end_repeat"):
+            if not pilha:
+                problemas.append(_problema("survey", linha, nome, f"'{base}' sem o begin correspondente"))
+            else:
+                esperado, linha_inicio, nome_inicio = pilha.pop()
+                if esperado != base:
+                    problemas.append(_problema("survey", linha, nome, f"'{base}' fecha '{nome_inicio}' "
+                                               f"(linha {linha_inicio}), que precisa de '{esperado}'"))
+            continue  # as linhas end_* não precisam de nome
+
+        if not nome:
+            problemas.append(_problema("survey", linha, nome, f"Linha '{tipo}' sem 'name'"))
+        elif not PADRAO_NOME_XML.match(nome):
+            problemas.append(_problema("survey", linha, nome, "Nome inválido em XML"))
+        elif nome in nomes:
+            problemas.append(_problema("survey", linha, nome, f"Nome repetido (linha {nomes[nome]})"))
+        else:
+            nomes[nome] = linha
+
+        if base == "calculate" and (i_calculo is None or not _texto(valores[i_calculo])):
+            problemas.append(_problema("survey", linha, nome, "'calculate' sem 'calculation'"))
+
+        for i, coluna in i_refs:
+            valor = valores[i]
+            if isinstance(valor, str) and "${" in valor:
+                for ref in dict.fromkeys(ref.strip() for ref in PADRAO_REFERENCIA.findall(valor)):
+                    referencias.append((linha, nome, coluna, ref))
+
+    for esperado, linha, nome in pilha:
+        problemas.append(_problema("survey", linha, nome, f"Grupo sem '{esperado}'"))
+    for linha, nome, coluna, ref in referencias:
+        if ref not in nomes:
+            problemas.append(_problema("survey", linha, nome, f"'{coluna}' refere ${{{ref}}}, que não existe"))
+
+    permitir_duplicados = False
+    if settings is not None and not settings.empty:
+        permitir_duplicados = _texto(settings.iloc[0].get("allow_choice_duplicates")).lower() == "yes"
+        problemas += _validar_settings(settings.iloc[0], colunas_labels)
+    problemas += _validar_choices(choices, listas_usadas, permitir_duplicados)
+
+    for arquivo, linha in arquivos_usados.items():
+        if media is not None and arquivo not in media:
+            problemas.append(_problema("survey", linha, "", f"Arquivo '{arquivo}' não acompanha o formulário"))
+    return _resultado(problemas, inicio)
+
+
+def _validar_choices(choices, listas_usadas, permitir_duplicados):
+    """Listas em falta, choices sem nome ou label e nomes repetidos na mesma lista."""
+    problemas = []
+    if choices is None or choices.empty:
+        for lista, linha in listas_usadas.items():
+            problemas.append(_problema("survey", linha, "", f"Lista '{lista}' não existe nas choices"))
+        return problemas
+    for obrigatoria in ("list_name", "name"):
+        if obrigatoria not in choices.columns:
+            return [_problema("choices", None, "", f"Coluna '{obrigatoria}' em falta")]
+    colunas_labels = [c for c in choices.columns if c == "label" or str(c).startswith("label::")]
+
+    listas, vistos = set(), set()
+    campos = ["list_name", "name"] + colunas_labels
+    for pos, valores in enumerate(choices[campos].itertuples(index=False, name=None)):
+        linha = pos + 2
+        lista, nome = _texto(valores[0]), _texto(valores[1])
+        if not lista:
+            continue
+        listas.add(lista)
+        if not nome:
+            problemas.append(_problema("choices", linha, lista, "Choice sem 'name'"))
+            continue
+        if colunas_labels and not any(_texto(v) for v in valores[2:]):
+            problemas.append(_problema("choices", linha, f"{lista}:{nome}", "Choice sem label", "aviso"))
+        if (lista, nome) in vistos and not permitir_duplicados:
+            problemas.append(_problema("choices", linha, f"{lista}:{nome}", "Choice repetida na mesma lista "
+                                       "(ou definir allow_choice_duplicates = yes)"))
+        vistos.add((lista, nome))
+
+    for lista, linha in listas_usadas.items():
+        if lista not in listas:
+            problemas.append(_problema("survey", linha, "", f"Lista '{lista}' não existe nas choices"))
+    return problemas
+
+
+def _validar_settings(settings, colunas_labels):
+    """form_id, form_title, version, allow_choice_duplicates e default_language."""
+    problemas = []
+    form_id = _texto(settings.get("form_id"))
+    if not form_id:
+        problemas.append(_problema("settings", 2, "form_id", "form_id vazio"))
+    elif not PADRAO_FORM_ID.match(form_id):
+        problemas.append(_problema("settings", 2, "form_id", f"form_id '{form_id}' com caracteres inválidos"))
+    if not _texto(settings.get("form_title")):
+        problemas.append(_problema("settings", 2, "form_title", "form_title vazio", "aviso"))
+    versao = _texto(settings.get("version"))
+    if versao and (len(versao) > 255 or re.search(r"\s", versao)):
+        problemas.append(_problema("settings", 2, "version", f"version '{versao}' inválida"))
+    duplicados = _texto(settings.get("allow_choice_duplicates")).lower()
+    if duplicados and duplicados not in ("yes", "no"):
+        problemas.append(_problema("settings", 2, "allow_choice_duplicates",
+                                   f"allow_choice_duplicates deve ser yes ou no, não '{duplicados}'"))
+    idioma = _texto(settings.get("default_language"))
+    if idioma and f"label::{idioma}" not in colunas_labels:
+        problemas.append(_problema("settings", 2, "default_language",
+                                   f"default_language '{idioma}' sem coluna label::{idioma}", "aviso"))
+    return problemas
+
+
+def _resultado(problemas, inicio):
+    return {
+        "erros": [p for p in problemas if p["severidade"] == "erro"],
+        "avisos": [p for p in problemas if p["severidade"] == "aviso"],
+        "segundos": round(time.perf_counter() - inicio, 3)
+    }
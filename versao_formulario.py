@@ -0,0 +1,48 @@
+import hashlib
+
+import pandas as pd
+
+
+def valor_canonico(valor):
+    """Representação estável de uma célula (NaN -> '', 121.0 -> '121', texto sem espaços nas pontas)."""
+    if valor is None or (not isinstance(valor, str) and pd.isna(valor)):
+        return ""
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor).strip()
+
+
+def _atualizar_com_aba(hash_, nome_aba, df):
+    """Junta ao hash uma aba com as colunas por ordem alfabética e as linhas pela ordem do formulário."""
+    hash_.update(f"\x1d{nome_aba}\x1d".encode("utf-8"))
+    if df is None or df.empty:
+        return
+    colunas = sorted(str(col) for col in df.columns)
+    df = df.rename(columns=str)[colunas]
+    # Colunas totalmente vazias não mudam o formulário (ex: 'constraint' sem valores)
+    colunas = [col for col in colunas if df[col].map(valor_canonico).ne("").any()]
+    hash_.update("\x1f".join(colunas).encode("utf-8"))
+    for linha in df[colunas].itertuples(index=False, name=None):
+        hash_.update(("\x1e" + "\x1f".join(valor_canonico(v) for v in linha)).encode("utf-8"))
+
+
+def versao_por_conteudo(survey, choices, settings=None, media=None, tamanho=12):
+    """
+    Calcula a 'version' do formulário a partir de um hash canónico do conteúdo.
+
+    O mesmo conteúdo (survey, choices, settings sem 'version' e arquivos de
+    media) dá sempre a mesma versão, pelo que os dispositivos só voltam a
+    descarregar formulários que mudaram.
+
+    Retorna:
+        str: prefixo hexadecimal do SHA-256
+    """
+    hash_ = hashlib.sha256()
+    _atualizar_com_aba(hash_, "survey", survey)
+    _atualizar_com_aba(hash_, "choices", choices)
+    if settings is not None:
+        _atualizar_com_aba(hash_, "settings", settings.drop(columns=["version"], errors="ignore"))
+    for nome_arquivo in sorted(media or {}):
+        hash_.update(f"\x1dmedia\x1d{nome_arquivo}\x1f".encode("utf-8"))
+        hash_.update(hashlib.sha256(media[nome_arquivo]).digest())
+    return hash_.hexdigest()[:tamanho]